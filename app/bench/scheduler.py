@@ -0,0 +1,181 @@
+# app/bench/scheduler.py
+"""
+Симуляция очереди задач: FIFO против DRR-планировщика (app/services/scheduler.py)
+на смешанной нагрузке — хвосты ожидания по классам задач и типам пользователей.
+
+Нагрузка (время модельное, секунды):
+  * «тяжёлый» пользователь в t=0 ставит пачку публикаций (bulk) и серию генераций по 4 кадра;
+  * light-пользователи приходят пуассоновским потоком и ставят короткие текстовые задачи
+    (interactive) или генерации по 1 кадру.
+
+Запуск (JSON в stdout или в --out):
+    python -m app.bench.scheduler --workers 4 --light-users 20 --duration 600
+"""
+from __future__ import annotations
+
+import argparse
+import heapq
+import json
+import random
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from app.bench.storage import _git_rev, _pct
+from app.services.scheduler import (
+    PRIORITY_BULK, PRIORITY_INTERACTIVE, PRIORITY_NORMAL, Candidate, DrrScheduler, parse_caps,
+)
+
+HEAVY = "heavy"
+
+
+@dataclass
+class SimJob:
+    job_id: int
+    user: str
+    provider: str
+    priority: int
+    cost: float
+    service_s: float
+    arrival: float
+    cls: str
+    started: Optional[float] = None
+
+
+def _workload(rnd: random.Random, light_users: int, duration: float, bulk: int, heavy_gens: int) -> List[SimJob]:
+    jobs: List[SimJob] = []
+
+    def add(user: str, provider: str, priority: int, cost: float, service: float, at: float, cls: str) -> None:
+        jobs.append(SimJob(len(jobs) + 1, user, provider, priority, cost, service, at, cls))
+
+    for _ in range(heavy_gens):
+        add(HEAVY, "tensorart", PRIORITY_NORMAL, 4, rnd.uniform(30, 50), 0.0, "image")
+    for _ in range(bulk):
+        add(HEAVY, "deviantart", PRIORITY_BULK, 1, rnd.uniform(5, 10), 0.0, "bulk")
+
+    arrivals: List[tuple[float, str]] = []
+    for u in range(light_users):
+        t = rnd.expovariate(1 / 60)  # в среднем раз в минуту на пользователя
+        while t < duration:
+            arrivals.append((t, f"light{u}"))
+            t += rnd.expovariate(1 / 60)
+    for t, user in sorted(arrivals):
+        if rnd.random() < 0.6:
+            add(user, "openai", PRIORITY_INTERACTIVE, 1, rnd.uniform(1, 3), t, "text")
+        else:
+            add(user, "tensorart", PRIORITY_NORMAL, 1, rnd.uniform(8, 15), t, "image")
+    return jobs
+
+
+def _simulate(jobs: List[SimJob], workers: int, scheduler: Optional[DrrScheduler]) -> List[SimJob]:
+    """Дискретные события: приходы и завершения; после каждого события свободные воркеры берут задачи."""
+    pending = sorted(jobs, key=lambda j: (j.arrival, j.job_id))
+    queue: Dict[int, SimJob] = {}
+    running: List[tuple[float, int, SimJob]] = []  # (время завершения, id, задача)
+    by_user: Dict[str, int] = {}
+    by_provider: Dict[str, int] = {}
+    now, i = 0.0, 0
+
+    def pick() -> Optional[SimJob]:
+        if not queue:
+            return None
+        if scheduler is None:  # FIFO: самая старая задача, без лимитов
+            return queue[min(queue)]
+        heads: Dict[tuple, SimJob] = {}
+        for j in queue.values():
+            key = (j.user, j.priority, j.provider)
+            if key not in heads or j.job_id < heads[key].job_id:
+                heads[key] = j
+        c = scheduler.pick(
+            [Candidate(j.job_id, j.user, j.provider, j.priority, j.cost) for j in heads.values()],
+            by_user, by_provider,
+        )
+        return queue[c.job_id] if c else None
+
+    while i < len(pending) or queue or running:
+        t_arr = pending[i].arrival if i < len(pending) else float("inf")
+        t_done = running[0][0] if running else float("inf")
+        now = min(t_arr, t_done)
+        if now == float("inf"):
+            break  # в очереди остались задачи, которые никогда не пройдут лимиты
+        if t_done <= t_arr:
+            _, _, j = heapq.heappop(running)
+            by_user[j.user] -= 1
+            by_provider[j.provider] -= 1
+        else:
+            queue[pending[i].job_id] = pending[i]
+            i += 1
+        while len(running) < workers:
+            j = pick()
+            if j is None:
+                break
+            del queue[j.job_id]
+            j.started = now
+            by_user[j.user] = by_user.get(j.user, 0) + 1
+            by_provider[j.provider] = by_provider.get(j.provider, 0) + 1
+            heapq.heappush(running, (now + j.service_s, j.job_id, j))
+    return jobs
+
+
+def _summary(jobs: List[SimJob]) -> Dict[str, Any]:
+    groups: Dict[str, List[float]] = {}
+    for j in jobs:
+        if j.started is None:
+            continue
+        wait = j.started - j.arrival
+        who = HEAVY if j.user == HEAVY else "light"
+        groups.setdefault(f"{who}:{j.cls}", []).append(wait)
+        groups.setdefault(f"all:{j.cls}", []).append(wait)
+    out: Dict[str, Any] = {}
+    for name, waits in sorted(groups.items()):
+        waits.sort()
+        out[name] = {
+            "jobs": len(waits),
+            "p50_s": _pct(waits, 0.50),
+            "p95_s": _pct(waits, 0.95),
+            "p99_s": _pct(waits, 0.99),
+            "max_s": round(waits[-1], 4),
+        }
+    out["unscheduled"] = sum(1 for j in jobs if j.started is None)
+    return out
+
+
+def main(argv: List[str] | None = None) -> Dict[str, Any]:
+    ap = argparse.ArgumentParser(description="job scheduler simulation: FIFO vs DRR")
+    ap.add_argument("--workers", type=int, default=4)
+    ap.add_argument("--light-users", type=int, default=20)
+    ap.add_argument("--duration", type=float, default=600.0, help="окно прихода light-задач, с")
+    ap.add_argument("--bulk", type=int, default=60, help="публикаций в пачке тяжёлого пользователя")
+    ap.add_argument("--heavy-gens", type=int, default=20, help="генераций по 4 кадра у тяжёлого пользователя")
+    ap.add_argument("--max-per-user", type=int, default=2)
+    ap.add_argument("--provider-caps", default="tensorart=4,openai=8,replicate=4")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--out", default="", help="файл для JSON (по умолчанию stdout)")
+    args = ap.parse_args(argv)
+
+    def fresh() -> List[SimJob]:
+        return _workload(random.Random(args.seed), args.light_users, args.duration, args.bulk, args.heavy_gens)
+
+    result: Dict[str, Any] = {
+        "bench": "scheduler",
+        "git": _git_rev(),
+        "started_at": int(time.time()),
+        "params": vars(args),
+        "policies": {
+            "fifo": _summary(_simulate(fresh(), args.workers, None)),
+            "drr": _summary(_simulate(fresh(), args.workers, DrrScheduler(
+                max_per_user=args.max_per_user, provider_caps=parse_caps(args.provider_caps),
+            ))),
+        },
+    }
+    payload = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.out:
+        Path(args.out).write_text(payload, encoding="utf-8")
+    else:
+        print(payload)
+    return result
+
+
+if __name__ == "__main__":
+    main()
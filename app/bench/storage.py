@@ -0,0 +1,237 @@
+# app/bench/storage.py
+"""
+Микробенчмарк пер-юзерного хранилища (user_state): галереи, автопост
+и настройки генерации на 1k/10k/100k синтетических пользователей, плюс журнал
+предпросмотров (app/services/preview_store.py) — там они живут с тех пор, как ушли из user_state.
+
+Для каждого namespace меряет get/set/patch (p50/p99 в мс и ops/s) при 1/8/64
+параллельных asyncio-задачах и считает потерянные обновления: наивный
+get → изменить → set против транзакционного update(). Для журнала — get/put
+теми же обёртками, что и бот (aget/aput).
+
+Запуск (результат — JSON в stdout или в --out, удобно сравнивать между коммитами):
+    python -m app.bench.storage --users 1000,10000 --concurrency 1,8,64 --ops 2000
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List
+
+from app.services.io_pool import run_io, run_write, shutdown_io_pool
+from app.services.journal import Journal
+from app.services.preview_store import KIND_POST, _key
+from app.services.user_state import (
+    NS_AUTOPOST, NS_GALLERY, NS_SETTINGS, UserStateStore,
+)
+
+FILL_BATCH = 5000
+
+
+# ---------- синтетические документы в формате живых сторов ----------
+def _gallery_doc(i: int) -> Dict[str, Any]:
+    ids = [f"{i:08x}-0000-0000-0000-{k:012x}" for k in range(3)]
+    return {"ids": ids, "names": [f"Gallery {k}" for k in range(3)]}
+
+
+def _autopost_doc(i: int) -> Dict[str, Any]:
+    return {
+        "images": [f"AgACAgIAAxkBAAI{i:x}{k}" for k in range(4)],
+        "raw_name": f"Char{i}", "title": f"Char{i}", "keywords": "cute, pastel, fox",
+        "pack": {"title": f"Char{i}", "description": "x" * 400, "hashtags": ["adoptable", "fox", "oc"]},
+        "gallery_ids": [], "ts": int(time.time()),
+    }
+
+
+def _preview_text(i: int) -> str:
+    # предпросмотр обычного постинга (preview_store, KIND_POST)
+    return f"<b>preview {i}</b> " + "y" * 300
+
+
+def _settings_doc(i: int) -> Dict[str, Any]:
+    # настройки генерации (generation/settings_panel)
+    return {
+        "width": 768, "height": 1152, "steps": 30, "cfg_scale": 7.0, "sampler": "DPM++ 2M Karras",
+        "active_gen_id": i, "n": 0,
+        "last_image_urls": [f"https://cdn.example/{i}/{k}.png" for k in range(4)],
+    }
+
+
+NAMESPACES: Dict[str, Callable[[int], Dict[str, Any]]] = {
+    NS_GALLERY: _gallery_doc,
+    NS_AUTOPOST: _autopost_doc,
+    NS_SETTINGS: _settings_doc,
+}
+
+
+def _fill(store: UserStateStore, journal: Journal, users: int) -> float:
+    t0 = time.perf_counter()
+    for ns, make in NAMESPACES.items():
+        for start in range(0, users, FILL_BATCH):
+            store.set_many({i: make(i) for i in range(start, min(users, start + FILL_BATCH))}, ns)
+    for i in range(users):
+        journal.put(_key(KIND_POST, i), _preview_text(i))
+    return time.perf_counter() - t0
+
+
+# ---------- замеры ----------
+def _pct(sorted_ms: List[float], q: float) -> float:
+    if not sorted_ms:
+        return 0.0
+    idx = min(len(sorted_ms) - 1, int(round(q * (len(sorted_ms) - 1))))
+    return round(sorted_ms[idx], 4)
+
+
+async def _measure(op: Callable[[int], Awaitable[Any]], users: int, ops: int, concurrency: int) -> Dict[str, Any]:
+    lat: List[float] = []
+    per_task = max(1, ops // concurrency)
+    rnd = random.Random(concurrency)
+
+    async def worker() -> None:
+        for _ in range(per_task):
+            uid = rnd.randrange(users)
+            t = time.perf_counter()
+            await op(uid)
+            lat.append((time.perf_counter() - t) * 1000)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    wall = time.perf_counter() - t0
+    lat.sort()
+    return {
+        "ops": len(lat),
+        "p50_ms": _pct(lat, 0.50),
+        "p99_ms": _pct(lat, 0.99),
+        "max_ms": round(lat[-1], 4) if lat else 0.0,
+        "ops_per_s": round(len(lat) / wall, 1) if wall else 0.0,
+    }
+
+
+async def _lost_updates(store: UserStateStore, concurrency: int, rounds: int) -> Dict[str, int]:
+    """
+    concurrency задач по rounds раз увеличивают счётчик одного пользователя.
+    naive — get + set через пул (так работали JSON-сторы), atomic — update() под run_write.
+    """
+    expected = concurrency * rounds
+    res: Dict[str, int] = {"expected": expected}
+    resource = str(store.path)
+
+    store.set("race", {"n": 0}, NS_SETTINGS)
+
+    async def naive() -> None:
+        for _ in range(rounds):
+            doc = await run_io(store.get, "race", NS_SETTINGS)
+            doc["n"] = int(doc.get("n") or 0) + 1
+            await asyncio.sleep(0)  # точка переключения, как await между чтением и записью в хендлере
+            await run_io(store.set, "race", doc, NS_SETTINGS)
+
+    await asyncio.gather(*(naive() for _ in range(concurrency)))
+    res["naive_lost"] = expected - int(store.get("race", NS_SETTINGS).get("n") or 0)
+
+    store.set("race", {"n": 0}, NS_SETTINGS)
+
+    def _inc(doc: Dict[str, Any]) -> None:
+        doc["n"] = int(doc.get("n") or 0) + 1
+
+    async def atomic() -> None:
+        for _ in range(rounds):
+            await run_write(resource, store.update, "race", _inc, NS_SETTINGS)
+
+    await asyncio.gather(*(atomic() for _ in range(concurrency)))
+    res["atomic_lost"] = expected - int(store.get("race", NS_SETTINGS).get("n") or 0)
+    return res
+
+
+async def bench_users(users: int, concurrency: List[int], ops: int, race_rounds: int) -> Dict[str, Any]:
+    with tempfile.TemporaryDirectory(prefix="bench_state_") as tmp:
+        store = UserStateStore(Path(tmp) / "user_state.db")
+        journal = Journal(Path(tmp) / "previews.journal")
+        try:
+            fill_s = _fill(store, journal, users)
+            resource = str(store.path)
+            out: Dict[str, Any] = {
+                "users": users,
+                "fill_s": round(fill_s, 3),
+                "db_bytes": store.path.stat().st_size,
+                "namespaces": {},
+                "lost_updates": {},
+            }
+            for ns, make in NAMESPACES.items():
+                ops_map: Dict[str, Callable[[int], Awaitable[Any]]] = {
+                    "get": lambda uid, ns=ns: run_io(store.get, uid, ns),
+                    "set": lambda uid, ns=ns, make=make: run_write(resource, store.set, uid, make(uid), ns),
+                    "patch": lambda uid, ns=ns: run_write(resource, store.patch, uid, {"ts": int(time.time())}, ns),
+                }
+                ns_out: Dict[str, Any] = {}
+                for name, op in ops_map.items():
+                    ns_out[name] = {str(c): await _measure(op, users, ops, c) for c in concurrency}
+                out["namespaces"][ns] = ns_out
+            previews: Dict[str, Callable[[int], Awaitable[Any]]] = {
+                "get": lambda uid: journal.aget(_key(KIND_POST, uid)),
+                "put": lambda uid: journal.aput(_key(KIND_POST, uid), _preview_text(uid)),
+            }
+            out["previews"] = {name: {str(c): await _measure(op, users, ops, c) for c in concurrency}
+                               for name, op in previews.items()}
+            out["previews"]["journal_bytes"] = journal.path.stat().st_size
+            out["previews"]["garbage_bytes"] = journal.garbage_bytes()
+            for c in concurrency:
+                out["lost_updates"][str(c)] = await _lost_updates(store, c, race_rounds)
+            return out
+        finally:
+            store.close()
+            journal.close()
+
+
+def _git_rev() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=5,
+        ).stdout.strip()
+    except Exception:
+        return ""
+
+
+async def main(argv: List[str] | None = None) -> Dict[str, Any]:
+    ap = argparse.ArgumentParser(description="user_state storage micro-benchmark")
+    ap.add_argument("--users", default="1000,10000,100000", help="размеры наборов через запятую")
+    ap.add_argument("--concurrency", default="1,8,64", help="число параллельных задач через запятую")
+    ap.add_argument("--ops", type=int, default=2000, help="операций на замер")
+    ap.add_argument("--race-rounds", type=int, default=50, help="инкрементов на задачу в тесте потерянных обновлений")
+    ap.add_argument("--out", default="", help="файл для JSON (по умолчанию stdout)")
+    args = ap.parse_args(argv)
+
+    result: Dict[str, Any] = {
+        "bench": "storage",
+        "git": _git_rev(),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "started_at": int(time.time()),
+        "runs": [],
+    }
+    concurrency = [int(x) for x in args.concurrency.split(",") if x.strip()]
+    for users in [int(x) for x in args.users.split(",") if x.strip()]:
+        print(f"bench: {users} users…", file=sys.stderr)
+        result["runs"].append(await bench_users(users, concurrency, args.ops, args.race_rounds))
+
+    payload = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.out:
+        Path(args.out).write_text(payload, encoding="utf-8")
+    else:
+        print(payload)
+    return result
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    finally:
+        shutdown_io_pool()
@@ -1,8 +1,8 @@
 import asyncio
+import logging
 from aiohttp import web
 
 from aiogram import Bot, Dispatcher
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 
 from aiogram.client.bot import DefaultBotProperties
@@ -10,12 +10,26 @@ from aiogram.enums import ParseMode
 
 from app.routers import da_gallery
 from app.config import settings
+from app.middlewares import PerUserLockMiddleware, UserResolverMiddleware
+from app.services.fsm_storage import SQLAlchemyStorage
 from app.db import init_db
+from app.migrations import check_hot_queries
 from app.routers import start, profile, generation, publish
-from app.services.queue import start_workers
+from app.services.queue import job_context, start_workers, stop_workers
+from app.services.user_state import migrate_legacy_json
+from app.services.gen_settings import import_legacy_gen_settings
+from app.services.autopost_store import start_autopost_flusher, stop_autopost_flusher
+from app.services.loop_monitor import start_loop_monitor, stop_loop_monitor
+from app.services.io_pool import shutdown_io_pool
+from app.services.journal import start_journal_compactor, stop_journal_compactor
+from app.services.preview_store import migrate_previews_from_state, previews
+from app.services.retention import start_retention_sweeper, stop_retention_sweeper
+from app.services.sqlite_maintenance import start_sqlite_maintenance, stop_sqlite_maintenance
+from app.services.db_writer import start_db_writer, stop_db_writer
 from app.routers import da_diag
 from app.routers import settings_panel
 from app.routers import autopost
+from app.routers import history
 
 
 # Если хочешь — можно убрать, т.к. .env уже грузится в app/config.py
@@ -29,7 +43,9 @@ bot = Bot(
 )
 
 # Диспетчер и роутеры
-dp = Dispatcher(storage=MemoryStorage())
+dp = Dispatcher(storage=SQLAlchemyStorage())  # FSM в БД: переживает рестарт, записи с TTL
+dp.update.outer_middleware(PerUserLockMiddleware())  # апдейты одного юзера — по очереди
+dp.update.outer_middleware(UserResolverMiddleware())  # data["user"]: User из БД (LRU-кэш)
 dp.include_router(start.router)
 dp.include_router(profile.router)
 dp.include_router(settings_panel.router)
@@ -38,11 +54,23 @@ dp.include_router(publish.router)
 dp.include_router(da_diag.router) 
 dp.include_router(da_gallery.router)
 dp.include_router(autopost.router)
+dp.include_router(history.router)
 
 async def main():
     # Инициализация БД и фоновых воркеров
     await init_db()
-    start_workers(3)
+    start_db_writer()  # DB_SINGLE_WRITER=1: запись через одну задачу-писателя
+    await check_hot_queries()  # предупреждение в лог, если горячий запрос пошёл полным сканом
+    migrate_legacy_json()  # однократный импорт старых JSON-хранилищ в user_state
+    await import_legacy_gen_settings()  # однократно: настройки генерации из user_state поверх UserSettings
+    migrate_previews_from_state()  # однократный перенос предпросмотров в журнал
+    job_context["bot"] = bot  # задачи очереди (генерация Tensor.Art) шлют сообщения сами
+    await start_workers()  # сначала вернёт в очередь задачи с истёкшей арендой
+    start_autopost_flusher()
+    start_loop_monitor()
+    start_journal_compactor(previews)
+    start_retention_sweeper()
+    start_sqlite_maintenance()  # PRAGMA optimize + checkpoint(TRUNCATE) WAL в простое
 
     if settings.WEBHOOK_URL:
         # ------ РЕЖИМ ВЕБХУКА ------
@@ -67,6 +95,14 @@ async def main():
             await asyncio.Event().wait()
         finally:
             await runner.cleanup()
+            await stop_workers()
+            await stop_autopost_flusher()
+            await stop_loop_monitor()
+            await stop_journal_compactor()
+            await stop_retention_sweeper()
+            await stop_sqlite_maintenance()
+            await stop_db_writer()
+            shutdown_io_pool()
             await bot.session.close()
 
     else:
@@ -78,8 +114,17 @@ async def main():
                 allowed_updates=dp.resolve_used_update_types(),
             )
         finally:
+            await stop_workers()
+            await stop_autopost_flusher()
+            await stop_loop_monitor()
+            await stop_journal_compactor()
+            await stop_retention_sweeper()
+            await stop_sqlite_maintenance()
+            await stop_db_writer()
+            shutdown_io_pool()
             await bot.session.close()
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
     asyncio.run(main())
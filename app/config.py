@@ -25,6 +25,92 @@ class Settings:
     OPENAI_API_KEY: str = os.getenv("OPENAI_API_KEY", "")
     OPENAI_API_BASE: str | None = os.getenv("OPENAI_API_BASE") or None
 
+    # Autopost store: write-behind кэш (секунды между сбросами / число «грязных» юзеров для сброса сразу)
+    AUTOPOST_FLUSH_INTERVAL: float = float(os.getenv("AUTOPOST_FLUSH_INTERVAL", "2.0"))
+    AUTOPOST_FLUSH_THRESHOLD: int = int(os.getenv("AUTOPOST_FLUSH_THRESHOLD", "50"))
+
+    # Файловый/SQLite I/O вне event loop + замер задержки loop
+    IO_POOL_WORKERS: int = int(os.getenv("IO_POOL_WORKERS", "4"))
+    LOOP_LAG_INTERVAL: float = float(os.getenv("LOOP_LAG_INTERVAL", "0.1"))
+    LOOP_LAG_REPORT_INTERVAL: float = float(os.getenv("LOOP_LAG_REPORT_INTERVAL", "60"))
+    LOOP_LAG_WARN_MS: float = float(os.getenv("LOOP_LAG_WARN_MS", "100"))
+
+    # Журнал предпросмотров: компакция, когда мусора >= RATIO от файла и >= MIN_BYTES
+    JOURNAL_COMPACT_RATIO: float = float(os.getenv("JOURNAL_COMPACT_RATIO", "0.5"))
+    JOURNAL_COMPACT_MIN_BYTES: int = int(os.getenv("JOURNAL_COMPACT_MIN_BYTES", str(256 * 1024)))
+    JOURNAL_COMPACT_INTERVAL: float = float(os.getenv("JOURNAL_COMPACT_INTERVAL", "60"))
+
+    # Ретеншн черновиков: старше DRAFT_TTL_DAYS — удаляются фоновым sweeper-ом
+    DRAFT_TTL_DAYS: float = float(os.getenv("DRAFT_TTL_DAYS", "14"))
+    GEN_DRAFT_TTL_DAYS: float = float(os.getenv("GEN_DRAFT_TTL_DAYS", "7"))  # брошенные черновики генераций
+    GEN_ARCHIVE_DAYS: float = float(os.getenv("GEN_ARCHIVE_DAYS", "30"))  # старше — в generations_archive, 0 — выкл.
+    GEN_ARCHIVE_BATCH: int = int(os.getenv("GEN_ARCHIVE_BATCH", "500"))
+    RETENTION_SWEEP_INTERVAL: float = float(os.getenv("RETENTION_SWEEP_INTERVAL", "3600"))
+    PREVIEW_MAX_CHARS: int = int(os.getenv("PREVIEW_MAX_CHARS", "4096"))  # лимит сообщения Telegram
+
+    # Кэш расшифрованных кредов (user_id, service)
+    CREDS_CACHE_TTL: float = float(os.getenv("CREDS_CACHE_TTL", "300"))
+    CREDS_CACHE_SIZE: int = int(os.getenv("CREDS_CACHE_SIZE", "10000"))
+
+    # LRU-кэш tg_id -> User (middleware UserResolverMiddleware)
+    USER_CACHE_SIZE: int = int(os.getenv("USER_CACHE_SIZE", "10000"))
+
+    # FSM-состояние в БД: запись без активности дольше FSM_TTL_SECONDS считается пустой
+    FSM_TTL_SECONDS: int = int(os.getenv("FSM_TTL_SECONDS", str(3 * 86400)))
+
+    # SQLite: профиль PRAGMA на каждое соединение (бот и FastAPI делят один data.db)
+    SQLITE_CACHE_SIZE_KB: int = int(os.getenv("SQLITE_CACHE_SIZE_KB", "65536"))  # cache_size = -N (KiB)
+    SQLITE_MMAP_SIZE: int = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))  # байт, 0 — без mmap
+    SQLITE_TEMP_STORE: str = os.getenv("SQLITE_TEMP_STORE", "MEMORY")
+    SQLITE_WAL_AUTOCHECKPOINT: int = int(os.getenv("SQLITE_WAL_AUTOCHECKPOINT", "1000"))  # страниц
+    # постоянный пул соединений: PRAGMA выполняются один раз на соединение, кэш страниц живёт между сессиями
+    SQLITE_POOL_SIZE: int = int(os.getenv("SQLITE_POOL_SIZE", "5"))
+    SQLITE_MAX_OVERFLOW: int = int(os.getenv("SQLITE_MAX_OVERFLOW", "5"))
+    # обслуживание: PRAGMA optimize раз в N секунд, checkpoint(TRUNCATE) после DB_IDLE_SECONDS без запросов
+    SQLITE_OPTIMIZE_INTERVAL: float = float(os.getenv("SQLITE_OPTIMIZE_INTERVAL", "3600"))
+    DB_IDLE_SECONDS: float = float(os.getenv("DB_IDLE_SECONDS", "30"))
+    DB_MAINTENANCE_INTERVAL: float = float(os.getenv("DB_MAINTENANCE_INTERVAL", "15"))
+
+    # Запись в БД через одну задачу-писателя на процесс (app/services/db_writer.py), 1 — вкл.
+    DB_SINGLE_WRITER: bool = os.getenv("DB_SINGLE_WRITER", "0").strip().lower() in ("1", "true", "yes", "on")
+    DB_WRITE_BATCH: int = int(os.getenv("DB_WRITE_BATCH", "32"))  # операций в одной транзакции
+    DB_WRITE_BATCH_WINDOW_MS: float = float(os.getenv("DB_WRITE_BATCH_WINDOW_MS", "2"))  # добор пачки
+    DB_BUSY_RETRIES: int = int(os.getenv("DB_BUSY_RETRIES", "5"))
+    DB_BUSY_BACKOFF: float = float(os.getenv("DB_BUSY_BACKOFF", "0.05"))  # секунды, удваивается
+
+    # Пул соединений Postgres / asyncpg (DB_POOL_TIMEOUT — и для SQLite)
+    DB_POOL_SIZE: int = int(os.getenv("DB_POOL_SIZE", "10"))
+    DB_MAX_OVERFLOW: int = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+    DB_POOL_RECYCLE: int = int(os.getenv("DB_POOL_RECYCLE", "1800"))  # сек, до таймаутов pgbouncer/балансировщика
+    DB_POOL_TIMEOUT: float = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+    DB_STATEMENT_CACHE_SIZE: int = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "500"))  # 0 — за pgbouncer (transaction)
+    # пинг соединения при выдаче из пула, только если оно простаивало дольше N секунд (-1 — никогда)
+    DB_PRE_PING_IDLE: float = float(os.getenv("DB_PRE_PING_IDLE", "30"))
+
+    # Очередь фоновых задач в БД (app/services/queue.py)
+    JOB_LEASE_SECONDS: float = float(os.getenv("JOB_LEASE_SECONDS", "60"))  # аренда продлевается каждую треть
+    JOB_POLL_INTERVAL: float = float(os.getenv("JOB_POLL_INTERVAL", "1.0"))  # задачи от других процессов
+    JOB_MAX_ATTEMPTS: int = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+    JOB_RETRY_BACKOFF: float = float(os.getenv("JOB_RETRY_BACKOFF", "5"))  # сек, удваивается с попыткой
+    JOB_KEEP_DAYS: float = float(os.getenv("JOB_KEEP_DAYS", "7"))  # done/failed старше — удаляет sweeper
+    # справедливое планирование: DRR по пользователям внутри класса приоритета + лимиты одновременных задач
+    JOB_MAX_PER_USER: int = int(os.getenv("JOB_MAX_PER_USER", "2"))
+    JOB_PROVIDER_CAPS: str = os.getenv("JOB_PROVIDER_CAPS", "tensorart=4,openai=8,replicate=4")  # provider=N через запятую
+    JOB_DRR_QUANTUM: float = float(os.getenv("JOB_DRR_QUANTUM", "1.0"))
+    # пул воркеров: растёт, когда все заняты и ожидание в очереди выше SLO; лишние уходят после простоя
+    JOB_WORKERS_MIN: int = int(os.getenv("JOB_WORKERS_MIN", "2"))
+    JOB_WORKERS_MAX: int = int(os.getenv("JOB_WORKERS_MAX", "16"))
+    JOB_WAIT_SLO: float = float(os.getenv("JOB_WAIT_SLO", "5"))  # сек, p95 ожидания до старта задачи
+    JOB_WORKER_IDLE_GRACE: float = float(os.getenv("JOB_WORKER_IDLE_GRACE", "60"))
+    JOB_SCALE_INTERVAL: float = float(os.getenv("JOB_SCALE_INTERVAL", "2"))
+
+    # Лимиты запросов к провайдерам — на API-ключ (app/services/rate_limits.py)
+    RATE_LIMITS: str = os.getenv("RATE_LIMITS", "openai=60/60,tensorart=30/60,replicate=30/60")  # provider=N/сек
+    RATE_LIMITER_CACHE_SIZE: int = int(os.getenv("RATE_LIMITER_CACHE_SIZE", "1024"))
+    RATE_LIMITER_IDLE_SECONDS: float = float(os.getenv("RATE_LIMITER_IDLE_SECONDS", "3600"))
+    RATE_LIMIT_DEFAULT_BLOCK: float = float(os.getenv("RATE_LIMIT_DEFAULT_BLOCK", "10"))  # 429 без Retry-After
+    RATE_LIMIT_MAX_BLOCK: float = float(os.getenv("RATE_LIMIT_MAX_BLOCK", "300"))
+
     # Optional
     REDIS_URL: str | None = os.getenv("REDIS_URL") or None
 
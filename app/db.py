@@ -1,33 +1,112 @@
 # app/db.py
 from __future__ import annotations
 
-from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
-from sqlalchemy import event
+import time
+
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine, async_sessionmaker, AsyncSession
+from sqlalchemy import event, exc
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from app.config import settings
 from app.db_base import Base  # <-- берем Base из db_base, НЕ из models
 
 _IS_SQLITE = settings.DATABASE_URL.startswith("sqlite")
 
-connect_args = {}
-if _IS_SQLITE:
-    connect_args = {"timeout": 30}  # сек, для aiosqlite
 
-engine = create_async_engine(
-    settings.DATABASE_URL,
-    echo=False,
-    pool_pre_ping=True,
-    connect_args=connect_args,
-    future=True,
-)
+def _sqlite_on_connect(dbapi_connection, connection_record):
+    cur = dbapi_connection.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA busy_timeout=5000")
+    cur.execute("PRAGMA synchronous=NORMAL")
+    # профиль производительности (см. SQLITE_* в config)
+    cur.execute(f"PRAGMA cache_size=-{int(settings.SQLITE_CACHE_SIZE_KB)}")
+    cur.execute(f"PRAGMA mmap_size={int(settings.SQLITE_MMAP_SIZE)}")
+    if settings.SQLITE_TEMP_STORE.upper() in ("DEFAULT", "FILE", "MEMORY"):
+        cur.execute(f"PRAGMA temp_store={settings.SQLITE_TEMP_STORE.upper()}")
+    cur.execute(f"PRAGMA wal_autocheckpoint={int(settings.SQLITE_WAL_AUTOCHECKPOINT)}")
+    cur.close()
+
+# время последнего запроса к БД из этого процесса — по нему sqlite_maintenance понимает, что бот простаивает.
+# Фоновые опросы (очередь задач) помечают запросы execution_options(db_background=True) и не считаются:
+# воркеры ходят в БД каждую секунду, и иначе idle-чекпоинт не наступил бы никогда.
+last_activity = time.monotonic()
+_TXN_CONTROL = ("BEGIN", "SAVEPOINT", "RELEASE", "ROLLBACK", "COMMIT")
+
+def _mark_activity(conn, cursor, statement, parameters, context, executemany):
+    global last_activity
+    if context is not None and context.execution_options.get("db_background"):
+        return
+    # служебные BEGIN/SAVEPOINT (писатель, вложенные транзакции) — не активность сами по себе
+    if statement.lstrip()[:16].upper().startswith(_TXN_CONTROL):
+        return
+    last_activity = time.monotonic()
+
+def _install_idle_ping(eng: AsyncEngine) -> None:
+    """
+    Вместо pool_pre_ping (лишний round trip на каждый checkout) пингуем соединение,
+    только если оно пролежало в пуле дольше DB_PRE_PING_IDLE секунд. Мёртвое —
+    DisconnectionError, пул заменит его новым.
+    """
+    if settings.DB_PRE_PING_IDLE < 0:
+        return
+
+    @event.listens_for(eng.sync_engine, "checkin")
+    def _on_checkin(dbapi_connection, connection_record):
+        connection_record.info["idle_since"] = time.monotonic()
+
+    @event.listens_for(eng.sync_engine, "checkout")
+    def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+        since = connection_record.info.get("idle_since")
+        if since is None or time.monotonic() - since < settings.DB_PRE_PING_IDLE:
+            return
+        try:
+            eng.dialect.do_ping(dbapi_connection)
+        except Exception as e:
+            raise exc.DisconnectionError() from e
+
+
+def build_engine(url: str, **overrides) -> AsyncEngine:
+    """
+    AsyncEngine с профилем под диалект: SQLite — постоянный пул (по умолчанию aiosqlite
+    берёт NullPool и открывает соединение на каждую сессию, теряя PRAGMA-профиль и кэш страниц)
+    и PRAGMA на соединение; Postgres (asyncpg) — размер пула, recycle, кэш подготовленных выражений.
+    """
+    is_sqlite = url.startswith("sqlite")
+    kw = dict(echo=False, future=True, pool_pre_ping=False)
+    if is_sqlite:
+        kw.update(
+            poolclass=AsyncAdaptedQueuePool,
+            pool_size=settings.SQLITE_POOL_SIZE,
+            max_overflow=settings.SQLITE_MAX_OVERFLOW,
+            pool_timeout=settings.DB_POOL_TIMEOUT,
+            pool_use_lifo=True,  # горячие соединения (с прогретым кэшем) — первыми
+            connect_args={"timeout": 30},  # сек, для aiosqlite
+        )
+    else:
+        kw.update(
+            pool_size=settings.DB_POOL_SIZE,
+            max_overflow=settings.DB_MAX_OVERFLOW,
+            pool_recycle=settings.DB_POOL_RECYCLE,
+            pool_timeout=settings.DB_POOL_TIMEOUT,
+            pool_use_lifo=True,  # горячие соединения переиспользуются, лишние простаивают и уходят по recycle
+        )
+        if "+asyncpg" in url:
+            kw["connect_args"] = {"prepared_statement_cache_size": settings.DB_STATEMENT_CACHE_SIZE}
+    kw.update(overrides)
+    eng = create_async_engine(url, **kw)
+    if is_sqlite:
+        event.listen(eng.sync_engine, "connect", _sqlite_on_connect)
+    _install_idle_ping(eng)
+    event.listen(eng.sync_engine, "before_cursor_execute", _mark_activity)
+    return eng
+
+
+engine = build_engine(settings.DATABASE_URL)
+
+
+def idle_seconds() -> float:
+    """Сколько секунд этот процесс не обращался к БД."""
+    return time.monotonic() - last_activity
 
-if _IS_SQLITE:
-    @event.listens_for(engine.sync_engine, "connect")
-    def _sqlite_on_connect(dbapi_connection, connection_record):
-        cur = dbapi_connection.cursor()
-        cur.execute("PRAGMA journal_mode=WAL")
-        cur.execute("PRAGMA busy_timeout=5000")
-        cur.execute("PRAGMA synchronous=NORMAL")
-        cur.close()
 
 async_session = async_sessionmaker(
     engine,
@@ -36,9 +115,41 @@ async_session = async_sessionmaker(
     autoflush=False,
 )
 
+def create_writer_engine():
+    """
+    Engine на одно соединение для db_writer. На SQLite транзакция берёт блокировку записи
+    сразу (BEGIN IMMEDIATE) — без SQLITE_BUSY при «повышении» чтения до записи, —
+    а драйвер не управляет транзакциями сам, иначе SAVEPOINT не работают.
+    """
+    # пул задаём явно: у aiosqlite по умолчанию NullPool, который не принимает pool_size
+    eng = build_engine(settings.DATABASE_URL, poolclass=AsyncAdaptedQueuePool, pool_size=1, max_overflow=0)
+    if _IS_SQLITE:
+        @event.listens_for(eng.sync_engine, "connect")
+        def _writer_on_connect(dbapi_connection, connection_record):
+            dbapi_connection.isolation_level = None
+
+        @event.listens_for(eng.sync_engine, "begin")
+        def _begin_immediate(conn):
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+    return eng
+
+def dialect_insert(table):
+    """insert() текущего диалекта — с on_conflict_do_nothing/do_update (SQLite и Postgres)."""
+    if engine.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert(table)
+
+
 # app/db.py (оставь как у тебя, только проверь init_db)
 async def init_db():
     import app.models  # регистрируем модели
+    from app.migrations import run_migrations
+
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+    # миграции сами управляют транзакциями (по одной на шаг)
+    async with engine.connect() as conn:
+        await conn.run_sync(run_migrations)
 
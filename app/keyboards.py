@@ -11,6 +11,7 @@ def main_menu_kb() -> InlineKeyboardMarkup:
         [InlineKeyboardButton(text="🧬 Создать персонажа", callback_data="gen:new")],
         [InlineKeyboardButton(text="🤖 Автопост", callback_data="custom:auto")],
         [InlineKeyboardButton(text="⚙️ Настройки генерации", callback_data="settings:open")],
+        [InlineKeyboardButton(text="📜 История", callback_data="history:open")],
         [InlineKeyboardButton(text="👤 Профиль", callback_data="profile:open")],
         [InlineKeyboardButton(text="ℹ️ Помощь", callback_data="help:open")],
     ])
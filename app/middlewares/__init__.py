@@ -0,0 +1,4 @@
+from app.middlewares.user_lock import PerUserLockMiddleware
+from app.middlewares.user_resolver import UserResolverMiddleware
+
+__all__ = ["PerUserLockMiddleware", "UserResolverMiddleware"]
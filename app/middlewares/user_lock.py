@@ -0,0 +1,52 @@
+# app/middlewares/user_lock.py
+from __future__ import annotations
+
+import asyncio
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, User
+
+
+class PerUserLockMiddleware(BaseMiddleware):
+    """
+    Апдейты одного пользователя обрабатываются строго по очереди (keyed lock по user id),
+    апдейты разных пользователей — параллельно. Убирает гонки get_data()/update_data()
+    и read-modify-write при быстрых кликах и альбомах.
+    Регистрировать как outer-middleware на dp.update.
+    """
+
+    def __init__(self) -> None:
+        self._locks: Dict[int, asyncio.Lock] = {}
+        self._waiters: Dict[int, int] = {}
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        user: User | None = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+
+        key = user.id
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            async with lock:
+                return await handler(event, data)
+        finally:
+            # замок живёт, пока на нём кто-то есть — словарь не растёт с числом юзеров
+            left = self._waiters[key] - 1
+            if left:
+                self._waiters[key] = left
+            else:
+                del self._waiters[key]
+                del self._locks[key]
+
+    @property
+    def active_users(self) -> int:
+        return len(self._locks)
@@ -0,0 +1,27 @@
+# app/middlewares/user_resolver.py
+from __future__ import annotations
+
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, User as TgUser
+
+from app.services.users import resolve_user
+
+
+class UserResolverMiddleware(BaseMiddleware):
+    """
+    Один раз на апдейт находит (или создаёт) User из БД и кладёт его в data["user"] —
+    хендлеры получают его аргументом `user: User`. Регистрировать как outer-middleware на dp.update.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        tg_user: TgUser | None = data.get("event_from_user")
+        if tg_user is not None:
+            data["user"] = await resolve_user(tg_user.id, tg_user.username)
+        return await handler(event, data)
@@ -0,0 +1,172 @@
+# app/migrations.py
+"""
+Версионные миграции схемы поверх create_all.
+
+create_all создаёт отсутствующие таблицы, но не трогает существующие — новые колонки
+и индексы для уже живых БД добавляются здесь. Применённые версии пишутся в schema_version;
+init_db() прогоняет недостающие шаги по порядку, каждый — в своей транзакции.
+Шаги идемпотентны (IF NOT EXISTS / проверка колонки): на свежей БД create_all уже всё создал.
+
+Ручной запуск и проверка планов горячих запросов:
+    python -m app.migrations          # применить
+    python -m app.migrations --check  # EXPLAIN QUERY PLAN горячих запросов
+"""
+from __future__ import annotations
+
+import logging
+import time
+from typing import Callable, List, Tuple
+
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Connection
+
+log = logging.getLogger(__name__)
+
+Step = Callable[[Connection], None]
+
+
+def _exec(*statements: str) -> Step:
+    def run(conn: Connection) -> None:
+        for sql in statements:
+            conn.execute(text(sql))
+    return run
+
+
+def has_column(conn: Connection, table: str, column: str) -> bool:
+    return any(c["name"] == column for c in inspect(conn).get_columns(table))
+
+
+def _tg_id_bigint(conn: Connection) -> None:
+    # SQLite хранит INTEGER 64-битным и ALTER COLUMN не умеет — только Postgres
+    if conn.dialect.name == "postgresql":
+        conn.execute(text("ALTER TABLE users ALTER COLUMN tg_id TYPE BIGINT"))
+
+
+def _jobs_scheduling_columns(conn: Connection) -> None:
+    # таблица jobs могла быть создана create_all до появления этих колонок
+    for col, ddl in (
+        ("user_id", "INTEGER"),
+        ("priority", "INTEGER NOT NULL DEFAULT 10"),
+        ("cost", "FLOAT NOT NULL DEFAULT 1.0"),
+    ):
+        if not has_column(conn, "jobs", col):
+            conn.execute(text(f"ALTER TABLE jobs ADD COLUMN {col} {ddl}"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_jobs_fair ON jobs (status, user_id, priority, provider)"))
+
+
+# (версия, имя, шаг). Новые шаги — только в конец, номера не переиспользуются.
+MIGRATIONS: List[Tuple[int, str, Step]] = [
+    (1, "hot-path indexes", _exec(
+        # «последняя генерация юзера»: WHERE user_id = ? ORDER BY id DESC LIMIT 1
+        "CREATE INDEX IF NOT EXISTS ix_generations_user_recent ON generations (user_id, id DESC)",
+        # одноколоночный индекс — префикс нового, только удорожает вставки
+        "DROP INDEX IF EXISTS ix_generations_user",
+    )),
+    (2, "users.tg_id bigint", _tg_id_bigint),
+    (3, "jobs scheduling columns", _jobs_scheduling_columns),
+    # креды ищутся по (user_id, service) — это покрывает uq_user_service; индекс оставался у БД,
+    # где миграция 1 уже прошла со старым списком
+    (4, "drop ix_api_creds_service_user", _exec("DROP INDEX IF EXISTS ix_api_creds_service_user")),
+]
+
+
+def _ensure_version_table(conn: Connection) -> None:
+    conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS schema_version ("
+        " version INTEGER PRIMARY KEY,"
+        " name VARCHAR(128) NOT NULL,"
+        " applied_at FLOAT NOT NULL)"
+    ))
+
+
+def current_version(conn: Connection) -> int:
+    _ensure_version_table(conn)
+    return int(conn.execute(text("SELECT COALESCE(MAX(version), 0) FROM schema_version")).scalar() or 0)
+
+
+def run_migrations(conn: Connection) -> List[int]:
+    """Применяет недостающие миграции (sync, для conn.run_sync). Возвращает применённые версии."""
+    done = current_version(conn)
+    if conn.in_transaction():
+        conn.commit()
+    applied: List[int] = []
+    for version, name, step in MIGRATIONS:
+        if version <= done:
+            continue
+        with conn.begin():
+            step(conn)
+            conn.execute(
+                text("INSERT INTO schema_version (version, name, applied_at) VALUES (:v, :n, :t)"),
+                {"v": version, "n": name, "t": time.time()},
+            )
+        log.info("schema migration %d applied: %s", version, name)
+        applied.append(version)
+    return applied
+
+
+# ---------- проверка планов горячих запросов ----------
+HOT_QUERIES: List[Tuple[str, str, dict]] = [
+    (
+        "latest generation for user",
+        "SELECT id FROM generations WHERE user_id = :uid ORDER BY id DESC LIMIT 1",
+        {"uid": 1},
+    ),
+    (
+        "credentials by service and user",
+        "SELECT id FROM api_credentials WHERE service = :svc AND user_id = :uid",
+        {"svc": "deviantart", "uid": 1},
+    ),
+    (
+        "user by tg_id",
+        "SELECT id FROM users WHERE tg_id = :tg",
+        {"tg": 1},
+    ),
+]
+
+
+def check_query_plans(conn: Connection) -> List[dict]:
+    """
+    EXPLAIN QUERY PLAN для HOT_QUERIES (SQLite). Запрос «плохой», если в плане есть
+    полный проход таблицы (SCAN без индекса) или сортировка во временном B-дереве.
+    """
+    if conn.dialect.name != "sqlite":
+        return []
+    report: List[dict] = []
+    for name, sql, params in HOT_QUERIES:
+        rows = conn.execute(text("EXPLAIN QUERY PLAN " + sql), params).fetchall()
+        details = [str(r[-1]) for r in rows]
+        full_scan = any(d.startswith("SCAN") and "INDEX" not in d for d in details)
+        temp_sort = any("TEMP B-TREE" in d for d in details)
+        report.append({"query": name, "plan": details, "ok": not (full_scan or temp_sort)})
+    return report
+
+
+async def check_hot_queries() -> List[dict]:
+    from app.db import engine
+
+    async with engine.connect() as conn:
+        report = await conn.run_sync(check_query_plans)
+    for r in report:
+        if not r["ok"]:
+            log.warning("hot query %r does not use an index: %s", r["query"], "; ".join(r["plan"]))
+    return report
+
+
+if __name__ == "__main__":
+    import asyncio
+    import json
+    import sys
+
+    from app.db import init_db
+
+    logging.basicConfig(level=logging.INFO)
+
+    async def _main() -> int:
+        await init_db()
+        if "--check" in sys.argv:
+            report = await check_hot_queries()
+            print(json.dumps(report, ensure_ascii=False, indent=2))
+            return 0 if all(r["ok"] for r in report) else 1
+        return 0
+
+    sys.exit(asyncio.run(_main()))
@@ -5,8 +5,8 @@ from datetime import datetime
 from typing import Optional
 
 from sqlalchemy import (
-    Integer, String, ForeignKey, Text, Float, UniqueConstraint,
-    Index, Boolean
+    Integer, BigInteger, String, ForeignKey, Text, Float, UniqueConstraint,
+    Index, Boolean, LargeBinary
 )
 from sqlalchemy.types import JSON
 from sqlalchemy.orm import relationship, Mapped, mapped_column
@@ -19,7 +19,8 @@ class User(Base):
     __tablename__ = "users"
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
-    tg_id: Mapped[int] = mapped_column(Integer, unique=True, index=True, nullable=False)
+    # Telegram id давно вышли за int32 — в Postgres нужен BIGINT (SQLite всё равно)
+    tg_id: Mapped[int] = mapped_column(BigInteger, unique=True, index=True, nullable=False)
     username: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)
     created_at: Mapped[datetime] = mapped_column(default=datetime.utcnow, nullable=False)
 
@@ -59,7 +60,6 @@ class ApiCredentials(Base):
 # ---------- Generation ----------
 class Generation(Base):
     __tablename__ = "generations"
-    __table_args__ = (Index("ix_generations_user", "user_id"),)
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     user_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
@@ -82,6 +82,29 @@ class Generation(Base):
     user: Mapped["User"] = relationship("User", back_populates="generations")
 
 
+# «последняя генерация юзера» — WHERE user_id = ? ORDER BY id DESC (см. app/migrations.py)
+Index("ix_generations_user_recent", Generation.user_id, Generation.id.desc())
+
+
+# ---------- GenerationArchive ----------
+class GenerationArchive(Base):
+    """
+    Холодный архив старых генераций (app/services/generation_archive.py): id тот же, что был
+    в generations; текстовые поля — zlib-сжатый JSON в payload.
+    """
+    __tablename__ = "generations_archive"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=False)
+    user_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    status: Mapped[str] = mapped_column(String(32), nullable=False)
+    created_at: Mapped[datetime] = mapped_column(nullable=False)
+    archived_at: Mapped[datetime] = mapped_column(default=datetime.utcnow, nullable=False)
+    payload: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+
+
+Index("ix_generations_archive_user_recent", GenerationArchive.user_id, GenerationArchive.id.desc())
+
+
 # ---------- UserSettings ----------
 class UserSettings(Base):
     __tablename__ = "user_settings"
@@ -128,3 +151,52 @@ class UserLora(Base):
     enabled: Mapped[bool] = mapped_column(Boolean, default=True, nullable=False)
 
     user: Mapped["User"] = relationship("User", back_populates="loras")
+
+
+# ---------- FSM ----------
+class FsmRecord(Base):
+    """Состояние/данные aiogram FSM по ключу StorageKey (см. app/services/fsm_storage.py)."""
+    __tablename__ = "fsm_state"
+    __table_args__ = (Index("ix_fsm_state_expires", "expires_at"),)
+
+    key: Mapped[str] = mapped_column(String(255), primary_key=True)
+    state: Mapped[Optional[str]] = mapped_column(String(255), nullable=True)
+    data_json: Mapped[str] = mapped_column(Text, default="{}", nullable=False)
+    expires_at: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
+
+
+# ---------- Jobs ----------
+class Job(Base):
+    """
+    Фоновая задача (app/services/queue.py): kind — зарегистрированный обработчик, payload — JSON
+    с args/kwargs. Воркер забирает задачу арендой (lease) и продлевает её, пока работает;
+    просроченная аренда возвращает задачу в очередь.
+    """
+    __tablename__ = "jobs"
+    __table_args__ = (
+        Index("ix_jobs_claim", "status", "run_after", "id"),
+        Index("ix_jobs_lease", "status", "lease_expires_at"),
+        Index("ix_jobs_fair", "status", "user_id", "priority", "provider"),
+    )
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    kind: Mapped[str] = mapped_column(String(64), nullable=False)
+    provider: Mapped[Optional[str]] = mapped_column(String(32), nullable=True)
+    payload_json: Mapped[str] = mapped_column(Text, default="{}", nullable=False)
+
+    # планирование (app/services/scheduler.py): чей это job, класс приоритета (меньше — раньше), вес
+    user_id: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    priority: Mapped[int] = mapped_column(Integer, default=10, nullable=False)
+    cost: Mapped[float] = mapped_column(Float, default=1.0, nullable=False)
+
+    status: Mapped[str] = mapped_column(String(16), default="queued", nullable=False)  # queued/running/done/failed
+    attempts: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    max_attempts: Mapped[int] = mapped_column(Integer, default=3, nullable=False)
+    run_after: Mapped[float] = mapped_column(Float, default=0.0, nullable=False)  # для ретраев с паузой
+
+    leased_by: Mapped[Optional[str]] = mapped_column(String(128), nullable=True)
+    lease_expires_at: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
+    last_error: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+
+    created_at: Mapped[float] = mapped_column(Float, nullable=False)
+    updated_at: Mapped[float] = mapped_column(Float, nullable=False)
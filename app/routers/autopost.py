@@ -10,14 +10,13 @@ from aiogram.types import CallbackQuery, Message, InlineKeyboardMarkup, InlineKe
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.fsm.context import FSMContext
 from aiogram.exceptions import TelegramBadRequest
-from sqlalchemy import select
 
-from app.db import async_session
-from app.models import User, ApiCredentials
-from app.crypto import fernet_decrypt
+from app.models import User
 from app.services.deviantart import DeviantArtClient, DeviantArtError
 from app.services.custom_pack import generate_custom_pack
 from app.services.gallery_prefs import get_galleries
+from app.services.preview_render import MODE_AUTOPOST, preview_fields, render_preview
+from app.services.user_state import us_run
 from app.services.autopost_store import (
     ap_clear, ap_add_image, ap_set_name, ap_set_keywords,
     ap_set_pack, ap_set_preview, ap_get,
@@ -82,34 +81,6 @@ def _safe_ack(cb: CallbackQuery):
         return None
 
 
-async def _get_user(tg_id: int, username: str | None) -> User:
-    async with async_session() as s:
-        r = await s.execute(select(User).where(User.tg_id == tg_id))
-        u = r.scalar_one_or_none()
-        if not u:
-            u = User(tg_id=tg_id, username=username)
-            s.add(u)
-            await s.commit()
-            await s.refresh(u)
-        return u
-
-
-async def _get_da_client_for_user(user_id: int) -> DeviantArtClient | None:
-    async with async_session() as s:
-        r = await s.execute(
-            select(ApiCredentials).where(
-                ApiCredentials.user_id == user_id,
-                ApiCredentials.service == "deviantart",
-            )
-        )
-        cred = r.scalar_one_or_none()
-    if not cred:
-        return None
-    access = fernet_decrypt(cred.access_token_enc)
-    refresh = fernet_decrypt(getattr(cred, "refresh_token_enc", None))
-    return DeviantArtClient(access_token=access, refresh_token=refresh, user_id=user_id)
-
-
 async def _download_tg_file(bot: Bot, file_id: str) -> Tuple[bytes, str]:
     file = await bot.get_file(file_id)
     bio = await bot.download_file(file.file_path)
@@ -120,7 +91,7 @@ async def _download_tg_file(bot: Bot, file_id: str) -> Tuple[bytes, str]:
 @router.callback_query(F.data == "custom:auto")
 async def start_autopost(cb: CallbackQuery, state: FSMContext):
     await _safe_ack(cb)
-    ap_clear(cb.from_user.id)
+    await ap_clear(cb.from_user.id)
     await state.set_state(AutopostStates.waiting_images)
     await state.update_data(photos=[])
     await cb.message.answer(
@@ -137,7 +108,7 @@ async def receive_photo(msg: Message, state: FSMContext):
     fid = msg.photo[-1].file_id
     photos.append(fid)
     await state.update_data(photos=photos)
-    ap_add_image(msg.from_user.id, fid)
+    await ap_add_image(msg.from_user.id, fid)
     await msg.answer(
         f"✅ Картинка добавлена. Сейчас {len(photos)} шт.\nДобавьте ещё или нажмите «✅ Готово».",
         reply_markup=_image_input_kb()
@@ -155,7 +126,7 @@ async def receive_document(msg: Message, state: FSMContext):
     fid = msg.document.file_id
     photos.append(fid)
     await state.update_data(photos=photos)
-    ap_add_image(msg.from_user.id, fid)
+    await ap_add_image(msg.from_user.id, fid)
     await msg.answer(
         f"✅ Файл-изображение добавлен. Сейчас {len(photos)} шт.\nДобавьте ещё или нажмите «✅ Готово».",
         reply_markup=_image_input_kb()
@@ -177,7 +148,7 @@ async def done_images(cb: CallbackQuery, state: FSMContext):
 async def cancel_autopost(cb: CallbackQuery, state: FSMContext):
     await _safe_ack(cb)
     await state.clear()
-    ap_clear(cb.from_user.id)
+    await ap_clear(cb.from_user.id)
     await cb.message.answer("❌ Автопост отменён. Вернитесь в меню.")
 
 
@@ -187,7 +158,7 @@ async def receive_name(msg: Message, state: FSMContext):
     if not name:
         await msg.answer("⚠️ Имя не должно быть пустым. Введите ещё раз.")
         return
-    ap_set_name(msg.from_user.id, name)
+    await ap_set_name(msg.from_user.id, name)
     await state.set_state(AutopostStates.waiting_keywords)
     await msg.answer("📝 Напишите ключевые слова для описания (через запятую).")
 
@@ -195,38 +166,29 @@ async def receive_name(msg: Message, state: FSMContext):
 @router.message(AutopostStates.waiting_keywords)
 async def receive_keywords(msg: Message, state: FSMContext):
     keywords = (msg.text or "").strip()
-    ap_set_keywords(msg.from_user.id, keywords)
+    await ap_set_keywords(msg.from_user.id, keywords)
 
-    store = ap_get(msg.from_user.id)
+    store = await ap_get(msg.from_user.id)
     pack = await generate_custom_pack(store.get("raw_name", "") or "Adoptable", keywords)
 
     tags_norm = _normalize_hashtags(pack.get("hashtags") or [])
     pack["hashtags"] = tags_norm
     pack["title"] = store.get("title") or pack.get("title") or "Adoptable"
-    ap_set_pack(msg.from_user.id, pack)
+    await ap_set_pack(msg.from_user.id, pack)
 
     imgs = store.get("images") or []
-    tags_preview = " ".join(tags_norm)
-    preview = f"""<b>DeviantArt — предпросмотр кастомного поста</b>
-<b>Кадров в пачке:</b> {len(imgs)}
-<b>Title (нумерация при публикации):</b> {html.escape(pack['title'])} (1), (2), …
-
-<b>Description:</b>
-<code>{html.escape((pack.get('description') or '')[:2000])}</code>
-
-<b>Hashtags ({len(tags_norm)}):</b> {tags_preview}"""
-    ap_set_preview(msg.from_user.id, preview)
+    preview = preview_fields(pack, len(imgs), MODE_AUTOPOST)
+    await ap_set_preview(msg.from_user.id, preview)
 
     await state.clear()
-    await msg.answer(preview, reply_markup=_preview_kb())
+    await msg.answer(render_preview(preview), reply_markup=_preview_kb())
 
 
 @router.callback_query(F.data == "autopost:do_publish")
-async def autopost_publish(cb: CallbackQuery, bot: Bot):
+async def autopost_publish(cb: CallbackQuery, bot: Bot, user: User):
     await _safe_ack(cb)
 
-    u = await _get_user(cb.from_user.id, cb.from_user.username)
-    client = await _get_da_client_for_user(u.id)
+    client = await DeviantArtClient.for_user(user.id)
     if not client:
         await cb.message.answer("❌ DeviantArt не подключён.")
         return
@@ -238,7 +200,7 @@ async def autopost_publish(cb: CallbackQuery, bot: Bot):
         await client.aclose()
         return
 
-    store = ap_get(cb.from_user.id)
+    store = await ap_get(cb.from_user.id)
     images: List[str] = list(store.get("images") or [])
     pack = dict(store.get("pack") or {})
     if not images or not pack:
@@ -248,7 +210,7 @@ async def autopost_publish(cb: CallbackQuery, bot: Bot):
     tags_norm = _normalize_hashtags(pack.get("hashtags") or [])
     pack["hashtags"] = tags_norm
 
-    prefs = get_galleries(u.id)
+    prefs = await us_run(get_galleries, user.id)
     gallery_ids: List[str] = list(store.get("gallery_ids") or []) or list(prefs.get("ids") or [])
 
     results: List[str] = []
@@ -316,6 +278,6 @@ async def autopost_publish(cb: CallbackQuery, bot: Bot):
         if errors:
             txt += "\n⚠️ Ошибки:\n" + "\n".join(errors)
         await cb.message.answer(txt)
-        ap_clear(cb.from_user.id)
+        await ap_clear(cb.from_user.id)
     else:
         await cb.message.answer("❌ Публикация не удалась.\n" + ("\n".join(errors) if errors else ""))
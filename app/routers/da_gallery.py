@@ -1,6 +1,5 @@
 from __future__ import annotations
 
-import html
 from typing import Dict, List, Set
 
 from aiogram import Router, F
@@ -8,15 +7,14 @@ from aiogram.types import CallbackQuery, InlineKeyboardMarkup, InlineKeyboardBut
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.exceptions import TelegramBadRequest
-from sqlalchemy import select
 
-from app.db import async_session
-from app.models import User, ApiCredentials
-from app.crypto import fernet_decrypt
+from app.models import User
 from app.services.deviantart import DeviantArtClient
 from app.services.gallery_prefs import get_galleries, set_galleries
-from app.services.autopost_store import ap_set_gallery_ids, ap_get  # для автопоста
-from app.user_storage import read_preview  # НОВАЯ система предпросмотра (app/data/post_preview.json)
+from app.services.autopost_store import ap_set_gallery_ids, ap_get, ap_get_preview  # для автопоста
+from app.services.preview_render import MODE_AUTOPOST, preview_fields, render_preview
+from app.services.user_state import us_run, us_run_write
+from app.user_storage import read_preview  # НОВАЯ система предпросмотра (журнал previews.journal)
 from app.routers.publish import _prepub_kb as _normal_prepub_kb  # клавиатура обычного предпросмотра
 
 router = Router()
@@ -33,34 +31,6 @@ def _safe_ack(cb: CallbackQuery):
         return None
 
 
-async def _get_user(tg_id: int, username: str | None) -> User:
-    async with async_session() as s:
-        r = await s.execute(select(User).where(User.tg_id == tg_id))
-        u = r.scalar_one_or_none()
-        if not u:
-            u = User(tg_id=tg_id, username=username)
-            s.add(u)
-            await s.commit()
-            await s.refresh(u)
-        return u
-
-
-async def _get_da_client_for_user(user_id: int) -> DeviantArtClient | None:
-    async with async_session() as s:
-        r = await s.execute(
-            select(ApiCredentials).where(
-                ApiCredentials.user_id == user_id,
-                ApiCredentials.service == "deviantart",
-            )
-        )
-        cred = r.scalar_one_or_none()
-    if not cred:
-        return None
-    access = fernet_decrypt(cred.access_token_enc)
-    refresh = fernet_decrypt(getattr(cred, "refresh_token_enc", "") or "") if getattr(cred, "refresh_token_enc", None) else None
-    return DeviantArtClient(access_token=access, refresh_token=refresh)
-
-
 def _kb(items: List[tuple[str, str, bool]], offset: int, limit: int, has_more: bool, mode: str) -> InlineKeyboardMarkup:
     rows: List[List[InlineKeyboardButton]] = []
     for fid, name, selected in items:
@@ -88,23 +58,13 @@ def _preview_actions_kb_custom() -> InlineKeyboardMarkup:
 
 
 async def _show_autopost_preview(cb: CallbackQuery) -> None:
-    store = ap_get(cb.from_user.id)
-    preview = store.get("last_preview") or ""
+    store = await ap_get(cb.from_user.id)
+    preview = await ap_get_preview(cb.from_user.id)
 
     if not preview:
+        # предпросмотр ещё не сохранён — собираем из пачки тем же рендерером
         imgs = store.get("images") or []
-        pack = store.get("pack") or {}
-        title = pack.get("title") or "Adoptable"
-        desc = (pack.get("description") or "")[:2000]
-        tags = " ".join((pack.get("hashtags") or [])[:30])
-        preview = (
-            "<b>DeviantArt — предпросмотр кастомного поста</b>\n"
-            f"<b>Кадров в пачке:</b> {len(imgs)}\n"
-            f"<b>Title:</b> {html.escape(title)}\n\n"
-            "<b>Description:</b>\n"
-            f"<code>{html.escape(desc)}</code>\n\n"
-            f"<b>Hashtags:</b> {tags}"
-        )
+        preview = render_preview(preview_fields(store.get("pack") or {}, len(imgs), MODE_AUTOPOST))
 
     try:
         await cb.message.edit_text(preview, reply_markup=_preview_actions_kb_custom())
@@ -113,8 +73,8 @@ async def _show_autopost_preview(cb: CallbackQuery) -> None:
 
 
 async def _show_normal_preview(cb: CallbackQuery) -> None:
-    """Возврат к последнему предпросмотру обычного постинга (из нового JSON)."""
-    preview = read_preview(cb.from_user.id)
+    """Возврат к последнему предпросмотру обычного постинга (из журнала предпросмотров)."""
+    preview = await read_preview(cb.from_user.id)
     try:
         await cb.message.edit_text(preview, reply_markup=_normal_prepub_kb())
     except TelegramBadRequest:
@@ -122,10 +82,9 @@ async def _show_normal_preview(cb: CallbackQuery) -> None:
 
 
 @router.callback_query(F.data.in_(["da:pick_gallery", "custom:pick_gallery"]))
-async def pick_gallery(cb: CallbackQuery, state: FSMContext):
+async def pick_gallery(cb: CallbackQuery, state: FSMContext, user: User):
     await _safe_ack(cb)
-    user = await _get_user(cb.from_user.id, cb.from_user.username)
-    client = await _get_da_client_for_user(user.id)
+    client = await DeviantArtClient.for_user(user.id)
     if not client:
         await cb.message.answer("❌ DeviantArt не подключён.")
         return
@@ -136,10 +95,15 @@ async def pick_gallery(cb: CallbackQuery, state: FSMContext):
         await client.aclose()
 
     mode = "custom" if cb.data.startswith("custom:") else "normal"
+    # в FSM кладём только то, что нужно для страниц, а не весь ответ API
+    raw_results = {
+        "results": [{"folderid": it["folderid"], "name": it["name"]} for it in folders.get("results", [])],
+        "has_more": bool(folders.get("has_more")),
+    }
     await state.set_state(GalleryStates.picking)
-    await state.update_data(mode=mode, raw_results=folders, offset=0, limit=10)
+    await state.update_data(mode=mode, raw_results=raw_results, offset=0, limit=10)
 
-    prefs = get_galleries(user.id)
+    prefs = await us_run(get_galleries, user.id)
     selected: Set[str] = set(prefs.get("ids", []))
     names = dict(zip(prefs.get("ids", []), prefs.get("names", [])))
     await state.update_data(sel=selected, names=names)
@@ -205,7 +169,7 @@ async def toggle(cb: CallbackQuery, state: FSMContext):
 
 
 @router.callback_query(GalleryStates.picking, F.data.startswith("da:save:"))
-async def save(cb: CallbackQuery, state: FSMContext):
+async def save(cb: CallbackQuery, state: FSMContext, user: User):
     await _safe_ack(cb)
     sd = await state.get_data()
     mode = str(sd.get("mode"))
@@ -213,13 +177,12 @@ async def save(cb: CallbackQuery, state: FSMContext):
     names_map: Dict[str, str] = dict(sd.get("names") or {})
     names = [names_map.get(fid, fid) for fid in selected]
 
-    user = await _get_user(cb.from_user.id, cb.from_user.username)
-    set_galleries(user.id, selected, names)
+    await us_run_write(set_galleries, user.id, selected, names)
 
     await state.clear()
 
     if mode == "custom":
-        ap_set_gallery_ids(user.id, selected)
+        await ap_set_gallery_ids(user.id, selected)
         await _show_autopost_preview(cb)
     else:
         await _show_normal_preview(cb)
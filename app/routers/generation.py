@@ -2,7 +2,9 @@ from __future__ import annotations
 
 import os
 import html
+import uuid
 import asyncio
+import logging
 from typing import Optional, Tuple, List
 
 from aiogram import Router, F
@@ -17,7 +19,7 @@ from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.exceptions import TelegramBadRequest
 
-from sqlalchemy import select, insert, update
+from sqlalchemy import select
 
 from app.keyboards import (
     prompt_editor_kb,
@@ -27,20 +29,23 @@ from app.keyboards import (
     count_kb,
 )
 from app.db import async_session
-from app.models import User, Generation, ApiCredentials, UserSettings
+from app.models import User, Generation
 from app.services.ai_text import OpenAITextClient, DummyTextClient
+from app.services.credentials import Creds, get_creds
+from app.services.gen_settings import get_gen_settings
+from app.services.generations import reuse_or_create_draft, update_generation
 from app.services.tensorart import (
     TensorArtClient,
     TensorArtError,
     build_txt2img_stages,
 )
-from app.crypto import fernet_decrypt
 from app.config import settings
+from app.services.queue import job_context, job_kind, submit_job
+from app.services.scheduler import PRIORITY_NORMAL
+from app.services.user_state import us_aget, us_apatch, us_aupdate, us_patch, us_run_write
 
-from pathlib import Path
-from types import SimpleNamespace
-import json
 
+log = logging.getLogger(__name__)
 router = Router()
 
 # ====== БАЗЫ для SD ======
@@ -128,196 +133,74 @@ def _get_ai_client():
         return OpenAITextClient(api_key=api_key, base_url=base, model=model)
     return DummyTextClient()
 
-# ---------- JSON storage for user settings (+ active_gen_id) ----------
-SETTINGS_JSON = Path(__file__).resolve().parent.parent / "user_settings.json"
-
-def _json_read_all() -> dict:
+# ---------- пер-юзерное состояние (настройки + active_gen_id) ----------
+# Всё I/O хранилища идёт через async-фасад (пул потоков), а не на event loop.
+async def _state_upsert(user_key: int, patch: dict):
     try:
-        if SETTINGS_JSON.exists():
-            return json.loads(SETTINGS_JSON.read_text(encoding="utf-8"))
-    except Exception:
-        pass
-    return {}
-
-def _json_write_all(data: dict) -> None:
-    try:
-        SETTINGS_JSON.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+        await us_apatch(user_key, patch)
     except Exception:
         # в проде можно залогировать
         pass
 
-def _json_upsert(user_key: int, patch: dict):
-    data = _json_read_all()
-    key = str(user_key)
-    cur = data.get(key) or {}
-    cur.update(patch)
-    data[key] = cur
-    _json_write_all(data)
-
-def _json_get_active_gen_id(user_key: int) -> Optional[int]:
+async def _state_get_active_gen_id(user_key: int) -> Optional[int]:
     try:
-        data = _json_read_all()
-        node = data.get(str(user_key)) or {}
-        v = node.get("active_gen_id")
+        v = (await us_aget(user_key)).get("active_gen_id")
         return int(v) if v is not None else None
     except Exception:
         return None
 
-def _json_set_active_gen_id_for_both(tg_user_id: int | None, db_user_id: int | None, gen_id: int):
-    if tg_user_id is not None:
-        _json_upsert(tg_user_id, {"active_gen_id": gen_id})
-    if db_user_id is not None:
-        _json_upsert(db_user_id, {"active_gen_id": gen_id})
+def _set_active_gen_id_sync(keys: list[int], gen_id: int) -> None:
+    for k in keys:
+        us_patch(k, {"active_gen_id": gen_id})
 
-def _json_get_settings_by_key(key: int) -> Optional[SimpleNamespace]:
+async def _state_set_active_gen_id_for_both(tg_user_id: int | None, db_user_id: int | None, gen_id: int):
+    keys = [k for k in (tg_user_id, db_user_id) if k is not None]
     try:
-        data = _json_read_all()
-        u = data.get(str(key))
-        if u:
-            return SimpleNamespace(
-                width=int(u.get("width", 768)),
-                height=int(u.get("height", 1152)),
-                steps=min(int(u.get("steps", 20)), 20),
-                cfg_scale=min(float(u.get("cfg_scale", 4.0)), 10.0),
-                model_id=u.get("model_id"),
-                sd_model_id=u.get("sd_model_id"),
-                clip_skip=u.get("clip_skip"),
-                active_gen_id=u.get("active_gen_id"),
-            )
+        # оба ключа — одной задачей в пуле
+        await us_run_write(_set_active_gen_id_sync, keys, gen_id)
     except Exception:
         pass
-    return None
-
-# ---------- БАЗОВЫЕ DAO ----------
-async def get_user(tg_id: int, username: Optional[str]):
-    async with async_session() as s:
-        r = await s.execute(select(User).where(User.tg_id == tg_id))
-        u = r.scalar_one_or_none()
-        if not u:
-            u = User(tg_id=tg_id, username=username)
-            s.add(u)
-            await s.commit()
-            await s.refresh(u)
-        return u
-
-# ======= дефолты и нормализация =======
-ALLOWED_SIZES = {(768, 1152), (1024, 1024)}
-DEFAULT_WIDTH = 768
-DEFAULT_HEIGHT = 1152
-DEFAULT_STEPS = 20
-DEFAULT_CFG = 4.0
-
-def _normalize_values(width: int, height: int, steps: int, cfg: float) -> tuple[int, int, int, float]:
-    w, h = int(width or 0), int(height or 0)
-    if (w, h) not in ALLOWED_SIZES:
-        if w == 768:
-            w, h = 768, 1152
-        elif w == 1024:
-            w, h = 1024, 1024
-        else:
-            w, h = DEFAULT_WIDTH, DEFAULT_HEIGHT
-    s = max(1, min(int(steps or DEFAULT_STEPS), 20))
-    c = max(1.0, min(float(cfg or DEFAULT_CFG), 10.0))
-    return w, h, s, c
-
-async def get_or_create_user_settings(user_id: int) -> UserSettings:
-    async with async_session() as s:
-        r = await s.execute(select(UserSettings).where(UserSettings.user_id == user_id))
-        st = r.scalar_one_or_none()
-        if not st:
-            env_w = getattr(settings, "TENSORART_WIDTH", None)
-            env_h = getattr(settings, "TENSORART_HEIGHT", None)
-            env_steps = getattr(settings, "TENSORART_STEPS", None)
-            env_cfg = getattr(settings, "TENSORART_CFG", None)
-            w = int(env_w) if env_w is not None else DEFAULT_WIDTH
-            h = int(env_h) if env_h is not None else DEFAULT_HEIGHT
-            stp = int(env_steps) if env_steps is not None else DEFAULT_STEPS
-            cfg = float(env_cfg) if env_cfg is not None else DEFAULT_CFG
-            w, h, stp, cfg = _normalize_values(w, h, stp, cfg)
-            st = UserSettings(
-                user_id=user_id,
-                width=w,
-                height=h,
-                steps=stp,
-                cfg_scale=cfg,
-                model_id=getattr(settings, "TENSORART_MODEL_ID", None),
-            )
-            s.add(st)
-            await s.commit()
-            await s.refresh(st)
-            return st
-
-        w2, h2, stp2, cfg2 = _normalize_values(st.width, st.height, st.steps, float(st.cfg_scale))
-        if (st.width, st.height, st.steps, float(st.cfg_scale)) != (w2, h2, stp2, cfg2):
-            st.width = w2
-            st.height = h2
-            st.steps = stp2
-            st.cfg_scale = cfg2
-            s.add(st)
-            await s.commit()
-            await s.refresh(st)
-        return st
 
 async def set_current_gen(state: FSMContext, gen_id: int):
     data = await state.get_data()
     data["current_gen_id"] = gen_id
     await state.set_data(data)
 
-async def get_current_gen_id(state: FSMContext, user_key: int) -> Optional[int]:
-    """user_key может быть как DB user_id, так и tg_id.
-    Порядок: FSM -> JSON(active_gen_id) -> БД(последняя)."""
+ARCHIVED_MSG = "Эта генерация уже в архиве — её можно посмотреть в /history."
+
+
+async def _load_generation(gen_id: int, user_id: int) -> Optional[Generation]:
+    """Генерация юзера из горячей таблицы; None — её уже перенесли в архив (или она чужая)."""
+    async with async_session() as s:
+        r = await s.execute(select(Generation).where(Generation.id == gen_id, Generation.user_id == user_id))
+        return r.scalar_one_or_none()
+
+
+async def get_current_gen_id(state: FSMContext, user_id: int) -> Optional[int]:
+    """user_id — id из БД (user из UserResolverMiddleware).
+    Порядок: FSM -> user_state(active_gen_id) -> БД(последняя)."""
     # 1) FSM
     data = await state.get_data()
     gen_id = data.get("current_gen_id")
     if gen_id:
         return gen_id
 
-    # 2) JSON по данному ключу
-    gen_id = _json_get_active_gen_id(user_key)
+    # 2) user_state (active_gen_id пишется и под db id)
+    gen_id = await _state_get_active_gen_id(user_id)
     if gen_id:
         return gen_id
 
-    # 3) если передан tg_id — найдём db id и проверим JSON там
+    # 3) Последняя генерация в БД (fallback)
     async with async_session() as s:
-        r2 = await s.execute(select(User.id).where(User.tg_id == user_key))
-        db_id = r2.scalar_one_or_none()
-        if db_id:
-            gen_id = _json_get_active_gen_id(db_id)
-            if gen_id:
-                return gen_id
-
-        # 4) Последняя генерация в БД (fallback)
-        base_id = db_id or user_key
         r = await s.execute(
             select(Generation.id)
-            .where(Generation.user_id == base_id)
+            .where(Generation.user_id == user_id)
             .order_by(Generation.id.desc())
+            .limit(1)
         )
         row = r.first()
         return row[0] if row else None
 
-async def get_user_settings_any(db_user_id: int, tg_user_id: Optional[int] = None) -> SimpleNamespace:
-    if tg_user_id is not None:
-        js = _json_get_settings_by_key(tg_user_id)
-        if js:
-            return js
-    js2 = _json_get_settings_by_key(db_user_id)
-    if js2:
-        return js2
-    try:
-        st = await get_or_create_user_settings(db_user_id)
-        return SimpleNamespace(
-            width=int(getattr(st, "width", 768)),
-            height=int(getattr(st, "height", 1152)),
-            steps=min(int(getattr(st, "steps", 20)), 20),
-            cfg_scale=min(float(getattr(st, "cfg_scale", 4.0)), 10.0),
-            model_id=getattr(st, "model_id", None),
-            sd_model_id=getattr(st, "sd_model_id", None),
-            clip_skip=getattr(st, "clip_skip", None),
-        )
-    except Exception:
-        return SimpleNamespace(width=768, height=1152, steps=20, cfg_scale=4.0)
-
 # ---------- Рендеры ----------
 def render_text_block_simple(gen: Generation, *, llm_model: Optional[str] = None) -> str:
     main_prompt = (gen.description or "").strip()
@@ -334,28 +217,24 @@ def render_text_block_simple(gen: Generation, *, llm_model: Optional[str] = None
 
 # ---------- utility: ensure generation ----------
 async def _ensure_generation_for_user(db_user_id: int, *, tg_user_id: int | None = None) -> int:
-    """Создаёт черновик генерации, возвращает её id и фиксирует его в JSON как active_gen_id."""
-    async with async_session() as s:
-        q = await s.execute(
-            insert(Generation)
-            .values(
-                user_id=db_user_id,
-                title="Custom generation",
-                description="",
-                tags_csv="",
-                prompt=SD_BASE,
-                negative_prompt=NEGATIVE_BASE,
-                style="custom",
-                status="text_ready",
-                image_cost_credits=0.0,
-            )
-            .returning(Generation.id)
-        )
-        gen_id = q.scalar_one()
-        await s.commit()
+    """
+    Возвращает id черновика генерации (нетронутый переиспользуется, иначе создаётся новый)
+    и фиксирует его в user_state как active_gen_id.
+    """
+    gen_id = await reuse_or_create_draft(
+        db_user_id,
+        title="Custom generation",
+        description="",
+        tags_csv="",
+        prompt=SD_BASE,
+        negative_prompt=NEGATIVE_BASE,
+        style="custom",
+        status="text_ready",
+        image_cost_credits=0.0,
+    )
 
-    # persist pointer in JSON for both keys (tg и db)
-    _json_set_active_gen_id_for_both(tg_user_id, db_user_id, gen_id)
+    # persist pointer in user_state for both keys (tg и db)
+    await _state_set_active_gen_id_for_both(tg_user_id, db_user_id, gen_id)
     return gen_id
 
 # ---------- Старт ----------
@@ -378,95 +257,77 @@ async def back_styles(cb: CallbackQuery):
 
 # ---------- Редактор: правка ОСНОВНОГО / SD / NEGATIVE ----------
 @router.callback_query(F.data == "editor:edit_main")
-async def editor_edit_main(cb: CallbackQuery, state: FSMContext):
-    u = await get_user(cb.from_user.id, cb.from_user.username)
-    gen_id = await get_current_gen_id(state, u.id)
+async def editor_edit_main(cb: CallbackQuery, state: FSMContext, user: User):
+    gen_id = await get_current_gen_id(state, user.id)
     if not gen_id:
-        gen_id = await _ensure_generation_for_user(u.id, tg_user_id=cb.from_user.id)
+        gen_id = await _ensure_generation_for_user(user.id, tg_user_id=cb.from_user.id)
         await set_current_gen(state, gen_id)
     await state.set_state(EditorStates.editing_main)
     await cb.message.answer("Пришлите текст для <b>Основного промпта</b> (заменит текущий).", parse_mode="HTML")
     await cb.answer()
 
 @router.message(EditorStates.editing_main)
-async def save_new_main_prompt(msg: Message, state: FSMContext):
-    u = await get_user(msg.from_user.id, msg.from_user.username)
-    gen_id = await get_current_gen_id(state, u.id)
+async def save_new_main_prompt(msg: Message, state: FSMContext, user: User):
+    gen_id = await get_current_gen_id(state, user.id)
     if not gen_id:
-        gen_id = await _ensure_generation_for_user(u.id, tg_user_id=msg.from_user.id)
+        gen_id = await _ensure_generation_for_user(user.id, tg_user_id=msg.from_user.id)
         await set_current_gen(state, gen_id)
 
     new_main = (msg.text or "").strip()
-    async with async_session() as s:
-        await s.execute(update(Generation).where(Generation.id == gen_id).values(description=new_main))
-        r = await s.execute(select(Generation).where(Generation.id == gen_id))
-        gen = r.scalar_one()
-        await s.commit()
+    gen = await update_generation(gen_id, description=new_main)
 
-    _json_set_active_gen_id_for_both(msg.from_user.id, u.id, gen_id)
+    await _state_set_active_gen_id_for_both(msg.from_user.id, user.id, gen_id)
     await msg.answer("Основной промпт обновлён ✅")
     await msg.answer(render_text_block_simple(gen), reply_markup=prompt_editor_kb(gen_id))
     await state.set_state(None)
 
 @router.callback_query(F.data == "editor:edit_sd")
 @router.callback_query(F.data == "editor:edit")  # алиас для совместимости
-async def editor_edit_sd(cb: CallbackQuery, state: FSMContext):
-    u = await get_user(cb.from_user.id, cb.from_user.username)
-    gen_id = await get_current_gen_id(state, u.id)
+async def editor_edit_sd(cb: CallbackQuery, state: FSMContext, user: User):
+    gen_id = await get_current_gen_id(state, user.id)
     if not gen_id:
-        gen_id = await _ensure_generation_for_user(u.id, tg_user_id=cb.from_user.id)
+        gen_id = await _ensure_generation_for_user(user.id, tg_user_id=cb.from_user.id)
         await set_current_gen(state, gen_id)
     await state.set_state(EditorStates.editing_sd)
     await cb.message.answer("Пришлите новый <b>SD-промпт</b> (заменит текущий).", parse_mode="HTML")
     await cb.answer()
 
 @router.message(EditorStates.editing_sd)
-async def save_new_sd_prompt(msg: Message, state: FSMContext):
-    u = await get_user(msg.from_user.id, msg.from_user.username)
-    gen_id = await get_current_gen_id(state, u.id)
+async def save_new_sd_prompt(msg: Message, state: FSMContext, user: User):
+    gen_id = await get_current_gen_id(state, user.id)
     if not gen_id:
-        gen_id = await _ensure_generation_for_user(u.id, tg_user_id=msg.from_user.id)
+        gen_id = await _ensure_generation_for_user(user.id, tg_user_id=msg.from_user.id)
         await set_current_gen(state, gen_id)
 
     new_prompt = (msg.text or "").strip()
-    async with async_session() as s:
-        await s.execute(update(Generation).where(Generation.id == gen_id).values(prompt=new_prompt))
-        r = await s.execute(select(Generation).where(Generation.id == gen_id))
-        gen = r.scalar_one()
-        await s.commit()
+    gen = await update_generation(gen_id, prompt=new_prompt)
 
-    _json_set_active_gen_id_for_both(msg.from_user.id, u.id, gen_id)
+    await _state_set_active_gen_id_for_both(msg.from_user.id, user.id, gen_id)
     await msg.answer("SD-промпт обновлён ✅")
     await msg.answer(render_text_block_simple(gen), reply_markup=prompt_editor_kb(gen_id))
     await state.set_state(None)
 
 @router.callback_query(F.data == "editor:edit_negative")
-async def editor_edit_negative(cb: CallbackQuery, state: FSMContext):
-    u = await get_user(cb.from_user.id, cb.from_user.username)
-    gen_id = await get_current_gen_id(state, u.id)
+async def editor_edit_negative(cb: CallbackQuery, state: FSMContext, user: User):
+    gen_id = await get_current_gen_id(state, user.id)
     if not gen_id:
-        gen_id = await _ensure_generation_for_user(u.id, tg_user_id=cb.from_user.id)
+        gen_id = await _ensure_generation_for_user(user.id, tg_user_id=cb.from_user.id)
         await set_current_gen(state, gen_id)
     await state.set_state(EditorStates.editing_negative)
     await cb.message.answer("Пришлите новый текст для <b>Negative</b> (заменит текущий).", parse_mode="HTML")
     await cb.answer()
 
 @router.message(EditorStates.editing_negative)
-async def save_new_negative(msg: Message, state: FSMContext):
-    u = await get_user(msg.from_user.id, msg.from_user.username)
-    gen_id = await get_current_gen_id(state, u.id)
+async def save_new_negative(msg: Message, state: FSMContext, user: User):
+    gen_id = await get_current_gen_id(state, user.id)
     if not gen_id:
-        gen_id = await _ensure_generation_for_user(u.id, tg_user_id=msg.from_user.id)
+        gen_id = await _ensure_generation_for_user(user.id, tg_user_id=msg.from_user.id)
         await set_current_gen(state, gen_id)
 
     new_neg = (msg.text or "").strip()
-    async with async_session() as s:
-        await s.execute(update(Generation).where(Generation.id == gen_id).values(negative_prompt=new_neg))
-        r = await s.execute(select(Generation).where(Generation.id == gen_id))
-        gen = r.scalar_one()
-        await s.commit()
+    gen = await update_generation(gen_id, negative_prompt=new_neg)
 
-    _json_set_active_gen_id_for_both(msg.from_user.id, u.id, gen_id)
+    await _state_set_active_gen_id_for_both(msg.from_user.id, user.id, gen_id)
     await msg.answer("Negative обновлён ✅")
     await msg.answer(render_text_block_simple(gen), reply_markup=prompt_editor_kb(gen_id))
     await state.set_state(None)
@@ -479,15 +340,14 @@ def _local_credits_estimate(width: int, height: int, steps: int, lora_count: int
     return mp * steps * per_mp_step * lora_factor
 
 @router.callback_query(F.data == "img:estimate")
-async def img_estimate(cb: CallbackQuery, state: FSMContext):
+async def img_estimate(cb: CallbackQuery, state: FSMContext, user: User):
     try:
-        u = await get_user(cb.from_user.id, cb.from_user.username)
-        gen_id = await get_current_gen_id(state, u.id)
+        gen_id = await get_current_gen_id(state, user.id)
         if not gen_id:
-            gen_id = await _ensure_generation_for_user(u.id, tg_user_id=cb.from_user.id)
+            gen_id = await _ensure_generation_for_user(user.id, tg_user_id=cb.from_user.id)
             await set_current_gen(state, gen_id)
 
-        st = await get_user_settings_any(db_user_id=u.id, tg_user_id=cb.from_user.id)
+        st = await get_gen_settings(user.id, tg_id=cb.from_user.id)
         data = await state.get_data()
         sel_loras: list[dict] = data.get("selected_loras") or []
         sel_count: int = int(data.get("image_count") or 1)
@@ -636,9 +496,8 @@ async def idea_manual(cb: CallbackQuery, state: FSMContext):
     await cb.answer()
 
 @router.message(IdeaStates.waiting_text)
-async def idea_manual_text(msg: Message, state: FSMContext):
+async def idea_manual_text(msg: Message, state: FSMContext, user: User):
     idea = (msg.text or "").strip()
-    u = await get_user(msg.from_user.id, msg.from_user.username)
 
     data = await state.get_data()
     if not data.get("selected_model_id") or not data.get("loras_ready"):
@@ -665,25 +524,22 @@ async def idea_manual_text(msg: Message, state: FSMContext):
     negative = NEGATIVE_BASE
     main_prompt = core
 
-    gen_id = await get_current_gen_id(state, u.id)
+    gen_id = await get_current_gen_id(state, user.id)
     if not gen_id:
-        gen_id = await _ensure_generation_for_user(u.id, tg_user_id=msg.from_user.id)
+        gen_id = await _ensure_generation_for_user(user.id, tg_user_id=msg.from_user.id)
         await set_current_gen(state, gen_id)
 
-    async with async_session() as s:
-        await s.execute(update(Generation).where(Generation.id == gen_id).values(
-            prompt=sd_prompt,
-            negative_prompt=negative,
-            description=main_prompt,
-            title="Custom generation",
-            status="text_ready",
-            tags_csv=f"llm:{model_used or 'unknown'}"
-        ))
-        await s.commit()
-        r = await s.execute(select(Generation).where(Generation.id == gen_id))
-        gen = r.scalar_one()
-
-    _json_set_active_gen_id_for_both(msg.from_user.id, u.id, gen_id)
+    gen = await update_generation(
+        gen_id,
+        prompt=sd_prompt,
+        negative_prompt=negative,
+        description=main_prompt,
+        title="Custom generation",
+        status="text_ready",
+        tags_csv=f"llm:{model_used or 'unknown'}",
+    )
+
+    await _state_set_active_gen_id_for_both(msg.from_user.id, user.id, gen_id)
     await msg.answer("Идея применена ✅")
     await msg.answer(render_text_block_simple(gen, llm_model=model_used), reply_markup=prompt_editor_kb(gen_id))
     await state.set_state(None)
@@ -696,43 +552,38 @@ async def prompt_manual(cb: CallbackQuery, state: FSMContext):
     await cb.answer()
 
 @router.message(PromptStates.waiting_main_prompt)
-async def prompt_manual_text(msg: Message, state: FSMContext):
+async def prompt_manual_text(msg: Message, state: FSMContext, user: User):
     main_prompt = (msg.text or "").strip()
     if not main_prompt:
         await msg.answer("Промпт пустой. Пришлите текст.")
         return
 
-    u = await get_user(msg.from_user.id, msg.from_user.username)
-    gen_id = await get_current_gen_id(state, u.id)
+    gen_id = await get_current_gen_id(state, user.id)
     if not gen_id:
-        gen_id = await _ensure_generation_for_user(u.id, tg_user_id=msg.from_user.id)
+        gen_id = await _ensure_generation_for_user(user.id, tg_user_id=msg.from_user.id)
         await set_current_gen(state, gen_id)
 
     sd_prompt = f"{SD_BASE}".strip().rstrip(",")
     negative = NEGATIVE_BASE
 
-    async with async_session() as s:
-        await s.execute(update(Generation).where(Generation.id == gen_id).values(
-            prompt=sd_prompt,
-            negative_prompt=negative,
-            description=main_prompt,
-            title="Custom generation",
-            status="text_ready",
-            tags_csv="manual:true"
-        ))
-        await s.commit()
-        r = await s.execute(select(Generation).where(Generation.id == gen_id))
-        gen = r.scalar_one()
-
-    _json_set_active_gen_id_for_both(msg.from_user.id, u.id, gen_id)
+    gen = await update_generation(
+        gen_id,
+        prompt=sd_prompt,
+        negative_prompt=negative,
+        description=main_prompt,
+        title="Custom generation",
+        status="text_ready",
+        tags_csv="manual:true",
+    )
+
+    await _state_set_active_gen_id_for_both(msg.from_user.id, user.id, gen_id)
     await msg.answer("Промпт принят ✅")
     await msg.answer(render_text_block_simple(gen), reply_markup=prompt_editor_kb(gen_id))
     await state.set_state(None)
 
 # --- Случайная идея (LLM) ---
 @router.callback_query(F.data == "idea:random")
-async def idea_random(cb: CallbackQuery, state: FSMContext):
-    u = await get_user(cb.from_user.id, cb.from_user.username)
+async def idea_random(cb: CallbackQuery, state: FSMContext, user: User):
     data = await state.get_data()
     if not data.get("selected_model_id") or not data.get("loras_ready"):
         await cb.answer("Сначала завершите выбор модели и LoRA.", show_alert=True)
@@ -756,40 +607,37 @@ async def idea_random(cb: CallbackQuery, state: FSMContext):
     negative = NEGATIVE_BASE
     main_prompt = core
 
-    gen_id = await get_current_gen_id(state, u.id)
+    gen_id = await get_current_gen_id(state, user.id)
     if not gen_id:
-        gen_id = await _ensure_generation_for_user(u.id, tg_user_id=cb.from_user.id)
+        gen_id = await _ensure_generation_for_user(user.id, tg_user_id=cb.from_user.id)
         await set_current_gen(state, gen_id)
 
-    async with async_session() as s:
-        await s.execute(update(Generation).where(Generation.id == gen_id).values(
-            prompt=sd_prompt,
-            negative_prompt=negative,
-            description=main_prompt,
-            title="Custom generation",
-            status="text_ready",
-            tags_csv=f"llm:{model_used or 'unknown'}"
-        ))
-        await s.commit()
-        r = await s.execute(select(Generation).where(Generation.id == gen_id))
-        gen = r.scalar_one()
-
-    _json_set_active_gen_id_for_both(cb.from_user.id, u.id, gen_id)
+    gen = await update_generation(
+        gen_id,
+        prompt=sd_prompt,
+        negative_prompt=negative,
+        description=main_prompt,
+        title="Custom generation",
+        status="text_ready",
+        tags_csv=f"llm:{model_used or 'unknown'}",
+    )
+
+    await _state_set_active_gen_id_for_both(cb.from_user.id, user.id, gen_id)
     await cb.message.answer("Случайная идея готова ✅")
     await cb.message.answer(render_text_block_simple(gen, llm_model=model_used), reply_markup=prompt_editor_kb(gen_id))
     await cb.answer()
 
 # ---------- Кол-во изображений ----------
 @router.callback_query(F.data == "count:open")
-async def count_open(cb: CallbackQuery, state: FSMContext):
-    u = await get_user(cb.from_user.id, cb.from_user.username)
-    gen_id = await get_current_gen_id(state, u.id)
+async def count_open(cb: CallbackQuery, state: FSMContext, user: User):
+    gen_id = await get_current_gen_id(state, user.id)
     if not gen_id:
         await cb.answer("Сначала укажите идею/промпт.", show_alert=True)
         return
-    async with async_session() as s:
-        r = await s.execute(select(Generation).where(Generation.id == gen_id))
-        gen = r.scalar_one()
+    gen = await _load_generation(gen_id, user.id)
+    if gen is None:
+        await cb.answer(ARCHIVED_MSG, show_alert=True)
+        return
     if not (gen.description and gen.description.strip()):
         await cb.answer("Сначала укажите основной промпт: «ввести идею», «случайная» или «ввести свой промпт».", show_alert=True)
         return
@@ -798,27 +646,27 @@ async def count_open(cb: CallbackQuery, state: FSMContext):
     await cb.answer()
 
 @router.callback_query(F.data.startswith("count:pick:"))
-async def count_pick(cb: CallbackQuery, state: FSMContext):
+async def count_pick(cb: CallbackQuery, state: FSMContext, user: User):
     n = int(cb.data.split(":")[-1])
     if n < 1 or n > 4:
         await cb.answer("Можно 1–4", show_alert=True)
         return
 
-    u = await get_user(cb.from_user.id, cb.from_user.username)
-    gen_id = await get_current_gen_id(state, u.id)
+    gen_id = await get_current_gen_id(state, user.id)
     if not gen_id:
         await cb.answer("Сначала укажите идею/промпт.", show_alert=True)
         return
-    async with async_session() as s:
-        r = await s.execute(select(Generation).where(Generation.id == gen_id))
-        gen = r.scalar_one()
+    gen = await _load_generation(gen_id, user.id)
+    if gen is None:
+        await cb.answer(ARCHIVED_MSG, show_alert=True)
+        return
     if not (gen.description and gen.description.strip()):
         await cb.answer("Сначала укажите основной промпт: «ввести идею», «случайная» или «ввести свой промпт».", show_alert=True)
         return
 
     await state.update_data(image_count=n)
 
-    st = await get_user_settings_any(db_user_id=u.id, tg_user_id=cb.from_user.id)
+    st = await get_gen_settings(user.id, tg_id=cb.from_user.id)
     data = await state.get_data()
     model_name = data.get("selected_model_name") or "—"
     sel_loras: list[dict] = data.get("selected_loras") or []
@@ -840,13 +688,10 @@ async def count_pick(cb: CallbackQuery, state: FSMContext):
     await cb.answer()
 
 # ---------- Tensor.Art ----------
-def _tensorart_client_from_creds(cred: ApiCredentials) -> TensorArtClient:
-    token = fernet_decrypt(cred.access_token_enc)
+def _tensorart_client_from_creds(cred: Creds) -> TensorArtClient:
     endpoint = getattr(settings, "TENSORART_REGION_URL", None) or getattr(settings, "TENSORART_ENDPOINT", None)
-    app_id = getattr(settings, "TENSORART_APP_ID", None)
-    if cred.meta_json and isinstance(cred.meta_json, dict):
-        app_id = cred.meta_json.get("app_id") or app_id
-    return TensorArtClient(api_key=token, region_url=endpoint, app_id=app_id)
+    app_id = cred.meta.get("app_id") or getattr(settings, "TENSORART_APP_ID", None)
+    return TensorArtClient(api_key=cred.access_token, region_url=endpoint, app_id=app_id)
 
 def _extract_progress(snapshot: dict) -> Optional[int]:
     job = snapshot.get("job") or {}
@@ -863,37 +708,28 @@ def _extract_progress(snapshot: dict) -> Optional[int]:
 
 # ---------- Запуск генерации ----------
 @router.callback_query(F.data.startswith("img:run"))
-async def img_run(cb: CallbackQuery, state: FSMContext):
+async def img_run(cb: CallbackQuery, state: FSMContext, user: User):
     parts = cb.data.split(":")
     gen_id = int(parts[2])
 
-    u = await get_user(cb.from_user.id, cb.from_user.username)
 
-    async with async_session() as s:
-        r = await s.execute(
-            select(Generation).where(Generation.id == gen_id, Generation.user_id == u.id)
-        )
-        gen = r.scalar_one()
+    gen = await _load_generation(gen_id, user.id)
+    if gen is None:
+        await cb.answer(ARCHIVED_MSG, show_alert=True)
+        return
 
     if not (gen.prompt and gen.prompt.strip()):
         await cb.message.answer("Сначала укажи идею промпта (шаг 3/4).")
         await cb.answer()
         return
 
-    async with async_session() as s:
-        r = await s.execute(
-            select(ApiCredentials).where(
-                ApiCredentials.user_id == u.id, ApiCredentials.service == "tensorart"
-            )
-        )
-        ta = r.scalar_one_or_none()
-
+    ta = await get_creds(user.id, "tensorart")
     if not ta:
         await cb.message.answer("Нет подключённого Tensor.Art. Добавьте в профиль.")
         await cb.answer()
         return
 
-    st = await get_user_settings_any(db_user_id=u.id, tg_user_id=cb.from_user.id)
+    st = await get_gen_settings(user.id, tg_id=cb.from_user.id)
     data = await state.get_data()
     selected_model_id: Optional[str] = data.get("selected_model_id") or None
     selected_loras: list[dict] = data.get("selected_loras") or []
@@ -905,8 +741,6 @@ async def img_run(cb: CallbackQuery, state: FSMContext):
     )
     loras: List[Tuple[str, float]] = [(x["id"], float(x.get("weight") or 0.8)) for x in selected_loras][:4]
 
-    client = _tensorart_client_from_creds(ta)
-
     try:
         stages = build_txt2img_stages(
             prompt=(gen.description or ""),         # основной промпт (от идеи/LLM)
@@ -921,49 +755,98 @@ async def img_run(cb: CallbackQuery, state: FSMContext):
             loras=loras or None,
             count=desired,
         )
-
-        job_id = await client.create_job(stages)
     except TensorArtError as e:
         await cb.message.answer(f"Ошибка Tensor.Art: {html.escape(str(e))}", parse_mode=None)
         await cb.answer()
-        await client.aclose()
-        return
-    except Exception as e:
-        await cb.message.answer(f"Не удалось создать задание: {html.escape(repr(e))}", parse_mode=None)
-        await cb.answer()
-        await client.aclose()
         return
 
-    progress_msg = await cb.message.answer("Генерация… 0%")
+    # дальше — в воркере очереди (создание задания, опрос, альбом); хендлер сразу отвечает
+    progress_msg = await cb.message.answer("Генерация… в очереди")
+    await submit_job(
+        "tensorart", run_tensorart_job,
+        run_id=uuid.uuid4().hex, gen_id=gen_id, user_id=user.id, tg_id=cb.from_user.id,
+        chat_id=progress_msg.chat.id, progress_msg_id=progress_msg.message_id,
+        stages=stages, desired=desired,
+    )
+    await cb.answer()
+
+
+TA_READY = {"succeeded", "completed", "done", "success", "finished"}
+TA_FAILED = {"failed", "error", "cancelled", "canceled"}
+TA_JOB_TIMEOUT = 600.0  # сек на основной опрос задания
+
+
+async def _remember_ta_run(tg_id: int, run_id: str, ta_job_id: Optional[str]) -> None:
+    """run_id -> id задания Tensor.Art в user_state: после рестарта воркер продолжит опрос, а не создаст новое."""
+    def _apply(doc: dict) -> None:
+        runs = doc.setdefault("ta_runs", {})
+        if ta_job_id:
+            runs[run_id] = ta_job_id
+        else:
+            runs.pop(run_id, None)
+            if not runs:
+                doc.pop("ta_runs", None)
+
+    await us_aupdate(tg_id, _apply)
+
+
+# вес в справедливой очереди — число кадров: пачка из 4 «стоит» как 4 одиночных
+@job_kind("tensorart.txt2img", priority=PRIORITY_NORMAL, cost=lambda kw: max(1, int(kw.get("desired") or 1)))
+async def run_tensorart_job(
+    *, run_id: str, gen_id: int, user_id: int, tg_id: int, chat_id: int, progress_msg_id: int,
+    stages: list, desired: int,
+) -> None:
+    """Задача очереди: задание Tensor.Art → опрос → сохранение кадров → альбом пользователю."""
+    bot = job_context["bot"]
+
+    async def progress(text: str) -> None:
+        try:
+            await bot.edit_message_text(text, chat_id=chat_id, message_id=progress_msg_id)
+        except TelegramBadRequest:
+            pass
+
+    ta = await get_creds(user_id, "tensorart")
+    if not ta:
+        await progress("Нет подключённого Tensor.Art. Добавьте в профиль.")
+        return
+    client = _tensorart_client_from_creds(ta)
 
     urls: List[str] = []
     try:
-        ready = {"succeeded", "completed", "done", "success", "finished"}
-        running = {"queued", "pending", "processing", "running", "waiting"}
+        job_id = ((await us_aget(tg_id)).get("ta_runs") or {}).get(run_id)
+        if not job_id:
+            try:
+                job_id = await client.create_job(stages)
+            except TensorArtError as e:
+                await progress(f"Ошибка Tensor.Art: {html.escape(str(e))}")
+                return
+            await _remember_ta_run(tg_id, run_id, job_id)
+        await progress("Генерация… 0%")
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + TA_JOB_TIMEOUT
         while True:
             snap = await client.get_job(job_id)
             job = snap.get("job") or {}
             status = (job.get("status") or snap.get("status") or "").lower()
 
             pr = _extract_progress(snap)
-            try:
-                if pr is not None:
-                    await progress_msg.edit_text(f"Генерация… {pr}%")
-            except TelegramBadRequest:
-                pass
+            if pr is not None:
+                await progress(f"Генерация… {pr}%")
 
-            if status in ready:
+            if status in TA_READY:
                 # Первая выборка ссылок
                 urls = list(dict.fromkeys(await client.get_result_urls(job_id) or []))
                 break
-            if status in running or not status:
-                await asyncio.sleep(2.0)
-                continue
+            if status in TA_FAILED:
+                raise TensorArtError(f"job {job_id}: {status}")
+            if loop.time() >= deadline:
+                raise TimeoutError(f"job {job_id}: no result in {int(TA_JOB_TIMEOUT)}s")
             await asyncio.sleep(2.0)
 
         # Доп. опрос — пока не соберём все desired ссылки (или не выйдем по тайм-ауту)
-        deadline = asyncio.get_event_loop().time() + 120.0  # ещё до 120с на добор
-        while len(urls) < desired and asyncio.get_event_loop().time() < deadline:
+        deadline = loop.time() + 120.0  # ещё до 120с на добор
+        while len(urls) < desired and loop.time() < deadline:
             await asyncio.sleep(2.0)
             more = await client.get_result_urls(job_id) or []
             # дедупликация, сохранение порядка
@@ -972,72 +855,69 @@ async def img_run(cb: CallbackQuery, state: FSMContext):
                 urls = merged
 
         if not urls:
-            # окончательный блокирующий фоллбэк
+            # окончательный фоллбэк
             urls = await client.wait_result_urls(job_id, poll_interval=2.0, timeout=180.0)
 
+    except asyncio.CancelledError:
+        raise  # остановка воркера — задача вернётся в очередь и продолжит опрос по ta_runs
     except Exception as e:
+        await _remember_ta_run(tg_id, run_id, None)
         try:
-            await progress_msg.edit_text(f"Ошибка генерации: {html.escape(str(e))}")
+            await bot.edit_message_text(f"Ошибка генерации: {html.escape(str(e))}", chat_id=chat_id, message_id=progress_msg_id)
         except TelegramBadRequest:
-            await cb.message.answer(f"Ошибка генерации: {html.escape(str(e))}")
-        await client.aclose()
-        await cb.answer()
+            try:
+                await bot.send_message(chat_id, f"Ошибка генерации: {html.escape(str(e))}")
+            except Exception:
+                log.exception("tensorart job %s: error report failed", run_id)
+        except Exception:
+            log.exception("tensorart job %s: error report failed", run_id)
         return
     finally:
         await client.aclose()
 
+    # ta_runs держим до конца доставки: отмена (рестарт) здесь — повтор продолжит с опроса, без новой оплаты;
+    # ошибки доставки сообщаем и не пробрасываем, чтобы очередь не повторила платную задачу
+    try:
+        await _deliver_tensorart_result(bot, gen_id=gen_id, tg_id=tg_id, chat_id=chat_id, urls=urls)
+        await progress("Готово ✅")
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        log.exception("tensorart job %s: delivery failed", run_id)
+        try:
+            await bot.send_message(chat_id, f"Изображения готовы, но отправить их не удалось: {html.escape(str(e))}")
+        except Exception:
+            log.exception("tensorart job %s: error report failed", run_id)
+    await _remember_ta_run(tg_id, run_id, None)
+
+
+async def _deliver_tensorart_result(bot, *, gen_id: int, tg_id: int, chat_id: int, urls: List[str]) -> None:
     main_url = urls[0] if urls else None
-    async with async_session() as s:
-        await s.execute(
-            update(Generation)
-            .where(Generation.id == gen_id)
-            .values(
-                image_url=main_url,
-                status="img_ready",
-            )
-        )
-        await s.commit()
+    await update_generation(gen_id, image_url=main_url, status="img_ready")
 
     # Сохраняем ВСЕ кадры для последующей публикации
-    try:
-        data_js = {}
-        if SETTINGS_JSON.exists():
-            data_js = json.loads(SETTINGS_JSON.read_text(encoding="utf-8") or "{}")
-        key = str(cb.from_user.id)
-        obj = data_js.get(key) or {}
-        obj["last_image_urls"] = list(urls or ([] if not main_url else [main_url]))[:4]
-        data_js[key] = obj
-        SETTINGS_JSON.write_text(json.dumps(data_js, ensure_ascii=False, indent=2), encoding="utf-8")
-    except Exception:
-        pass
+    await _state_upsert(tg_id, {"last_image_urls": list(urls or ([] if not main_url else [main_url]))[:4]})
 
     # Отправляем пользователю
-    try:
-        if len(urls) > 1:
-            media = []
-            for idx, uurl in enumerate(urls):
-                if idx == 0:
-                    media.append(InputMediaPhoto(media=uurl, caption="Изображения готовы ✅"))
-                else:
-                    media.append(InputMediaPhoto(media=uurl))
-            await cb.message.answer_media_group(media=media)
-            # Всегда отдельное сообщение с текстом + кнопкой публикации (чтобы не потерялось)
-            await cb.message.answer(
-                "Готово ✅\nХочешь опубликовать на DeviantArt? Нажми кнопку ниже:",
-                reply_markup=image_actions_kb()
-            )
-
-        elif main_url:
-            await cb.message.answer_photo(photo=main_url, caption="Изображение готово ✅", reply_markup=image_actions_kb())
-        else:
-            await cb.message.answer("Готово, но URL изображений не найден 🤔")
+    if len(urls) > 1:
+        media = []
+        for idx, uurl in enumerate(urls):
+            if idx == 0:
+                media.append(InputMediaPhoto(media=uurl, caption="Изображения готовы ✅"))
+            else:
+                media.append(InputMediaPhoto(media=uurl))
+        await bot.send_media_group(chat_id, media=media)
+        # Всегда отдельное сообщение с текстом + кнопкой публикации (чтобы не потерялось)
+        await bot.send_message(
+            chat_id,
+            "Готово ✅\nХочешь опубликовать на DeviantArt? Нажми кнопку ниже:",
+            reply_markup=image_actions_kb()
+        )
 
-        try:
-            await progress_msg.edit_text("Готово ✅")
-        except TelegramBadRequest:
-            pass
-    finally:
-        await cb.answer()
+    elif main_url:
+        await bot.send_photo(chat_id, photo=main_url, caption="Изображение готово ✅", reply_markup=image_actions_kb())
+    else:
+        await bot.send_message(chat_id, "Готово, но URL изображений не найден 🤔")
 
 
 
@@ -1067,18 +947,16 @@ async def _safe_show_editor(cb: CallbackQuery, text: str, gen_id: int):
     await cb.message.answer(text, reply_markup=prompt_editor_kb(gen_id))
 
 @router.callback_query(F.data == "back:editor")
-async def back_editor(cb: CallbackQuery, state: FSMContext):
-    u = await get_user(cb.from_user.id, cb.from_user.username)
-    gen_id = await get_current_gen_id(state, u.id)
+async def back_editor(cb: CallbackQuery, state: FSMContext, user: User):
+    gen_id = await get_current_gen_id(state, user.id)
     if not gen_id:
-        gen_id = await _ensure_generation_for_user(u.id, tg_user_id=cb.from_user.id)
+        gen_id = await _ensure_generation_for_user(user.id, tg_user_id=cb.from_user.id)
         await set_current_gen(state, gen_id)
-    async with async_session() as s:
-        r = await s.execute(
-            select(Generation).where(Generation.id == gen_id, Generation.user_id == u.id)
-        )
-        gen = r.scalar_one()
+    gen = await _load_generation(gen_id, user.id)
+    if gen is None:
+        await cb.answer(ARCHIVED_MSG, show_alert=True)
+        return
     llm_model = (await state.get_data()).get("last_llm_model")
     text = render_text_block_simple(gen, llm_model=llm_model)
-    _json_set_active_gen_id_for_both(cb.from_user.id, u.id, gen_id)
+    await _state_set_active_gen_id_for_both(cb.from_user.id, user.id, gen_id)
     await _safe_show_editor(cb, text, gen_id)
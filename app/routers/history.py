@@ -0,0 +1,104 @@
+from __future__ import annotations
+
+import html
+from typing import Any, Dict, List, Optional
+
+from aiogram import Router, F
+from aiogram.types import CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup, Message
+from aiogram.exceptions import TelegramBadRequest
+
+from app.keyboards import back_btn
+from app.models import User
+from app.services.generation_archive import generation_history, get_generation_any
+
+router = Router()
+
+PAGE_SIZE = 10
+
+
+def _safe_ack(cb: CallbackQuery):
+    try:
+        return cb.answer()
+    except TelegramBadRequest:
+        return None
+
+
+def _cut(value: Optional[str], n: int = 1000) -> str:
+    # четыре длинных поля должны влезть в одно сообщение Telegram (4096 символов)
+    s = value or ""
+    return html.escape(s if len(s) <= n else s[:n] + "…")
+
+
+def _label(g: Dict[str, Any]) -> str:
+    mark = "🗄 " if g["archived"] else ""
+    title = (g.get("title") or "").strip() or "без названия"
+    return f"{mark}#{g['id']} · {title[:40]} · {g['status']}"
+
+
+def _page_kb(items: List[Dict[str, Any]], has_more: bool, first: bool) -> InlineKeyboardMarkup:
+    rows = [[InlineKeyboardButton(text=_label(g), callback_data=f"history:show:{g['id']}")] for g in items]
+    nav: List[InlineKeyboardButton] = []
+    if not first:
+        nav.append(InlineKeyboardButton(text="⏮ В начало", callback_data="history:open"))
+    if has_more:
+        nav.append(InlineKeyboardButton(text="➡️", callback_data=f"history:page:{items[-1]['id']}"))
+    if nav:
+        rows.append(nav)
+    rows.append([back_btn("menu")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+async def _render_page(target: Message | CallbackQuery, user: User, before_id: Optional[int] = None) -> None:
+    # +1 запись — узнать, есть ли следующая страница (горячая таблица и архив вместе)
+    items = await generation_history(user.id, limit=PAGE_SIZE + 1, before_id=before_id)
+    has_more = len(items) > PAGE_SIZE
+    items = items[:PAGE_SIZE]
+    text = "📜 История генераций (🗄 — из архива)" if items else "📜 История генераций пуста."
+    kb = _page_kb(items, has_more, before_id is None)
+    if isinstance(target, Message):
+        await target.answer(text, reply_markup=kb)
+        return
+    try:
+        await target.message.edit_text(text, reply_markup=kb)
+    except TelegramBadRequest:
+        await target.message.answer(text, reply_markup=kb)
+
+
+@router.message(F.text == "/history")
+async def cmd_history(msg: Message, user: User):
+    await _render_page(msg, user)
+
+
+@router.callback_query(F.data == "history:open")
+async def open_history(cb: CallbackQuery, user: User):
+    await _safe_ack(cb)
+    await _render_page(cb, user)
+
+
+@router.callback_query(F.data.startswith("history:page:"))
+async def history_page(cb: CallbackQuery, user: User):
+    await _safe_ack(cb)
+    await _render_page(cb, user, int(cb.data.rsplit(":", 1)[1]))
+
+
+@router.callback_query(F.data.startswith("history:show:"))
+async def history_show(cb: CallbackQuery, user: User):
+    await _safe_ack(cb)
+    g = await get_generation_any(int(cb.data.rsplit(":", 1)[1]), user.id)
+    if g is None:
+        await cb.message.answer("Генерация не найдена.")
+        return
+    created = g["created_at"].strftime("%Y-%m-%d %H:%M") if g.get("created_at") else "—"
+    text = (
+        f"<b>#{g['id']}</b> · {html.escape(g['status'])} · {created}{' · 🗄 архив' if g['archived'] else ''}\n\n"
+        f"<b>Title:</b> {_cut(g.get('title'), 200)}\n\n"
+        f"<b>Description:</b>\n{_cut(g.get('description'))}\n\n"
+        f"<b>Tags:</b> {_cut(g.get('tags_csv'), 600)}\n\n"
+        f"<b>SD Prompt:</b>\n<code>{_cut(g.get('prompt'))}</code>"
+    )
+    if g.get("image_url"):
+        text += f"\n\n<b>Image:</b> {_cut(g['image_url'], 500)}"
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="⬅️ К истории", callback_data="history:open")],
+    ])
+    await cb.message.answer(text, reply_markup=kb)
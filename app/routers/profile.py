@@ -1,6 +1,5 @@
 from __future__ import annotations
 
-from typing import Optional
 from urllib.parse import urlencode
 
 from aiogram import Router, F
@@ -10,11 +9,12 @@ from aiogram.fsm.state import StatesGroup, State
 from aiogram.fsm.context import FSMContext
 from sqlalchemy import select, delete
 
-from app.db import async_session
 from app.models import User, ApiCredentials
 from app.keyboards import profile_kb
 from app.config import settings
 from app.crypto import fernet_encrypt
+from app.services.credentials import get_creds, invalidate_creds
+from app.services.db_writer import db_write
 
 router = Router()
 
@@ -32,34 +32,23 @@ async def _safe_ack(cb: CallbackQuery) -> None:
         pass
 
 
-async def _get_or_create_user(tg_id: int, username: Optional[str]) -> User:
-    async with async_session() as s:
-        res = await s.execute(select(User).where(User.tg_id == tg_id))
-        u = res.scalar_one_or_none()
-        if not u:
-            u = User(tg_id=tg_id, username=username)
-            s.add(u)
-            await s.commit()
-            await s.refresh(u)
-        return u
+async def _has_cred(user_id: int, service: str) -> bool:
+    return await get_creds(user_id, service) is not None
 
 
-async def _has_cred(user_id: int, service: str) -> bool:
-    async with async_session() as s:
-        res = await s.execute(
-            select(ApiCredentials).where(
-                ApiCredentials.user_id == user_id,
-                ApiCredentials.service == service,
-            )
+async def _delete_cred(s, user_id: int, service: str) -> None:
+    await s.execute(
+        delete(ApiCredentials).where(
+            ApiCredentials.user_id == user_id,
+            ApiCredentials.service == service,
         )
-        return res.scalar_one_or_none() is not None
+    )
 
 
 # ===== open profile =====
 @router.callback_query(F.data == "profile:open")
-async def open_profile(cb: CallbackQuery):
+async def open_profile(cb: CallbackQuery, user: User):
     await _safe_ack(cb)
-    user = await _get_or_create_user(cb.from_user.id, cb.from_user.username)
     da_ok = await _has_cred(user.id, "deviantart")
     ta_ok = await _has_cred(user.id, "tensorart")
 
@@ -92,20 +81,13 @@ async def connect_deviantart(cb: CallbackQuery):
 
 
 @router.callback_query(F.data == "profile:disconnect_da")
-async def disconnect_deviantart(cb: CallbackQuery):
+async def disconnect_deviantart(cb: CallbackQuery, user: User):
     await _safe_ack(cb)
-    user = await _get_or_create_user(cb.from_user.id, cb.from_user.username)
-    async with async_session() as s:
-        await s.execute(
-            delete(ApiCredentials).where(
-                ApiCredentials.user_id == user.id,
-                ApiCredentials.service == "deviantart",
-            )
-        )
-        await s.commit()
+    await db_write(_delete_cred, user.id, "deviantart")
+    invalidate_creds(user.id, "deviantart")
     await cb.message.answer("DeviantArt отключён.")
     # Обновим профиль
-    await open_profile(cb)
+    await open_profile(cb, user)
 
 
 # ===== Tensor.Art connect / disconnect =====
@@ -120,7 +102,7 @@ async def add_tensorart(cb: CallbackQuery, state: FSMContext):
 
 
 @router.message(ProfileStates.waiting_tensorart_key)
-async def save_tensorart_key(msg: Message, state: FSMContext):
+async def save_tensorart_key(msg: Message, state: FSMContext, user: User):
     raw = (msg.text or "").strip()
     token = raw
     # принимаем форматы: "Bearer XXX", "bearer XXX", или просто "XXX"
@@ -130,10 +112,9 @@ async def save_tensorart_key(msg: Message, state: FSMContext):
         await msg.answer("❌ Ключ выглядит подозрительно коротким. Пришлите ещё раз или /cancel.")
         return
 
-    user = await _get_or_create_user(msg.from_user.id, msg.from_user.username)
     enc = fernet_encrypt(token)
 
-    async with async_session() as s:
+    async def op(s) -> None:
         # проверим — есть ли уже запись
         res = await s.execute(
             select(ApiCredentials).where(
@@ -153,26 +134,21 @@ async def save_tensorart_key(msg: Message, state: FSMContext):
                 refresh_token_enc=None,
             )
             s.add(cred)
-        await s.commit()
+
+    await db_write(op)
+    invalidate_creds(user.id, "tensorart")
 
     await state.clear()
     await msg.answer("✅ Tensor.Art ключ сохранён. Теперь можно генерировать изображения!")
 
 
 @router.callback_query(F.data == "profile:disconnect_ta")
-async def disconnect_tensorart(cb: CallbackQuery):
+async def disconnect_tensorart(cb: CallbackQuery, user: User):
     await _safe_ack(cb)
-    user = await _get_or_create_user(cb.from_user.id, cb.from_user.username)
-    async with async_session() as s:
-        await s.execute(
-            delete(ApiCredentials).where(
-                ApiCredentials.user_id == user.id,
-                ApiCredentials.service == "tensorart",
-            )
-        )
-        await s.commit()
+    await db_write(_delete_cred, user.id, "tensorart")
+    invalidate_creds(user.id, "tensorart")
     await cb.message.answer("Tensor.Art отключён.")
-    await open_profile(cb)
+    await open_profile(cb, user)
 
 
 # ===== back to main menu =====
@@ -2,9 +2,7 @@ from __future__ import annotations
 
 import html
 import re
-import json
 import asyncio
-from pathlib import Path
 from typing import Optional, List, Dict, Any
 
 from aiogram import Router, F
@@ -16,18 +14,17 @@ import httpx
 from sqlalchemy import select
 
 from app.db import async_session
-from app.models import User, Generation, ApiCredentials
-from app.crypto import fernet_decrypt
+from app.models import User, Generation
 from app.keyboards import back_btn
 from app.services.deviantart import DeviantArtClient, DeviantArtError
 from app.services.ai_text import OpenAITextClient, DummyTextClient
-from app.services.gallery_prefs import get_galleries
-from app.user_storage import save_preview, read_preview
+from app.services.gallery_prefs import galleries_from_doc
+from app.services.user_state import NS_GALLERY, NS_SETTINGS, us_aget, us_aget_many, us_apatch
+from app.services.preview_render import MODE_PHOTOS, MODE_POST, preview_fields, render_preview
+from app.user_storage import save_preview
 
 router = Router()
 
-SETTINGS_JSON = Path(__file__).resolve().parent.parent / "user_settings.json"
-
 BUYERS_DESC = """\
 This adopt is generated by AI Midjourney
 After buy, you get a clean image without watermark.
@@ -45,18 +42,6 @@ class PublishStates(StatesGroup):
     waiting_desc = State()
 
 
-async def _get_user(tg_id: int, username: Optional[str]) -> User:
-    async with async_session() as s:
-        res = await s.execute(select(User).where(User.tg_id == tg_id))
-        u = res.scalar_one_or_none()
-        if not u:
-            u = User(tg_id=tg_id, username=username)
-            s.add(u)
-            await s.commit()
-            await s.refresh(u)
-        return u
-
-
 def _normalize_hashtags(tags: List[str]) -> List[str]:
     out: List[str] = []
     seen = set()
@@ -91,23 +76,6 @@ def _prepub_kb() -> InlineKeyboardMarkup:
     )
 
 
-async def _get_da_client_for_user(user_id: int) -> DeviantArtClient | None:
-    async with async_session() as s:
-        r = await s.execute(
-            select(ApiCredentials).where(
-                ApiCredentials.user_id == user_id,
-                ApiCredentials.service == "deviantart",
-            )
-        )
-        cred = r.scalar_one_or_none()
-        if not cred:
-            return None
-        access = fernet_decrypt(cred.access_token_enc)
-        refresh = fernet_decrypt(getattr(cred, "refresh_token_enc", "") or "") if getattr(
-            cred, "refresh_token_enc", None) else None
-        return DeviantArtClient(access_token=access, refresh_token=refresh, user_id=user_id)
-
-
 async def _download_image(url: str) -> tuple[bytes, str]:
     async with httpx.AsyncClient(timeout=90.0) as cli:
         r = await cli.get(url)
@@ -117,52 +85,43 @@ async def _download_image(url: str) -> tuple[bytes, str]:
         return r.content, f"image{ext}"
 
 
-def _read_last_urls_for_user(tg_user_id: int) -> List[str]:
-    try:
-        if SETTINGS_JSON.exists():
-            data = json.loads(SETTINGS_JSON.read_text(encoding="utf-8") or "{}")
-            obj = data.get(str(tg_user_id)) or {}
-            arr = obj.get("last_image_urls") or []
-            if isinstance(arr, list):
-                out = [u for u in arr if isinstance(u, str) and u.strip()]
-                return out[:20]
-    except Exception:
-        pass
+def _urls_from_state(obj: Dict[str, Any]) -> List[str]:
+    arr = (obj or {}).get("last_image_urls") or []
+    if isinstance(arr, list):
+        out = [u for u in arr if isinstance(u, str) and u.strip()]
+        return out[:20]
     return []
 
 
-def _save_pack_to_cache(tg_user_id: int, pack: Dict[str, Any]) -> None:
-    try:
-        data: Dict[str, Any] = {}
-        if SETTINGS_JSON.exists():
-            data = json.loads(SETTINGS_JSON.read_text(encoding="utf-8") or "{}")
-        obj = data.get(str(tg_user_id)) or {}
-        obj["last_da_pack"] = {
-            "title": pack.get("title") or "",
-            "description": pack.get("description") or "",
+def _pack_from_state(obj: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    pack = (obj or {}).get("last_da_pack")
+    if isinstance(pack, dict):
+        return {
+            "title": str(pack.get("title") or ""),
+            "description": str(pack.get("description") or ""),
             "hashtags": list(pack.get("hashtags") or []),
         }
-        data[str(tg_user_id)] = obj
-        SETTINGS_JSON.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+    return None
+
+
+async def _read_last_urls_for_user(tg_user_id: int) -> List[str]:
+    try:
+        return _urls_from_state(await us_aget(tg_user_id))
     except Exception:
-        pass
+        return []
 
 
-def _read_pack_from_cache(tg_user_id: int) -> Optional[Dict[str, Any]]:
+async def _save_pack_to_cache(tg_user_id: int, pack: Dict[str, Any]) -> None:
     try:
-        if SETTINGS_JSON.exists():
-            data = json.loads(SETTINGS_JSON.read_text(encoding="utf-8") or "{}")
-            obj = data.get(str(tg_user_id)) or {}
-            pack = obj.get("last_da_pack")
-            if isinstance(pack, dict):
-                return {
-                    "title": str(pack.get("title") or ""),
-                    "description": str(pack.get("description") or ""),
-                    "hashtags": list(pack.get("hashtags") or []),
-                }
+        await us_apatch(tg_user_id, {
+            "last_da_pack": {
+                "title": pack.get("title") or "",
+                "description": pack.get("description") or "",
+                "hashtags": list(pack.get("hashtags") or []),
+            }
+        })
     except Exception:
         pass
-    return None
 
 
 def _get_ai_client():
@@ -173,16 +132,15 @@ def _get_ai_client():
 
 
 @router.callback_query(F.data == "da:publish")
-async def da_publish_start(cb: CallbackQuery):
+async def da_publish_start(cb: CallbackQuery, user: User):
     try:
         wait_msg = await cb.message.answer("Готовлю предпросмотр…")
     except Exception:
         wait_msg = None
 
-    u = await _get_user(cb.from_user.id, cb.from_user.username)
     async with async_session() as s:
         r = await s.execute(
-            select(Generation).where(Generation.user_id == u.id).order_by(Generation.id.desc())
+            select(Generation).where(Generation.user_id == user.id).order_by(Generation.id.desc()).limit(1)
         )
         gen = r.scalars().first()
 
@@ -190,7 +148,7 @@ async def da_publish_start(cb: CallbackQuery):
         await cb.message.answer("Нет готовых изображений для публикации.")
         await cb.answer(); return
 
-    urls = _read_last_urls_for_user(cb.from_user.id)
+    urls = await _read_last_urls_for_user(cb.from_user.id)
     if not urls and getattr(gen, "image_url", None):
         urls = [gen.image_url]
 
@@ -217,19 +175,10 @@ async def da_publish_start(cb: CallbackQuery):
         except Exception:
             pass
 
-    _save_pack_to_cache(cb.from_user.id, pack)
-
-    tags_preview = " ".join((pack.get("hashtags") or [])[:30])
-    preview = f"""<b>DeviantArt — предпросмотр поста</b>
-<b>Кадров в пачке:</b> {len(urls)}
-<b>Title (нумерация при публикации):</b> {html.escape(pack.get('title',''))} (1), (2), …
-
-<b>Description:</b>
-<code>{html.escape((pack.get('description') or '')[:2000])}</code>
+    await _save_pack_to_cache(cb.from_user.id, pack)
 
-<b>Hashtags ({len(pack.get('hashtags') or [])}):</b> {tags_preview}"""
-
-    save_preview(cb.from_user.id, preview)
+    preview = preview_fields(pack, len(urls), MODE_POST)
+    await save_preview(cb.from_user.id, preview)
 
     try:
         if wait_msg:
@@ -237,7 +186,7 @@ async def da_publish_start(cb: CallbackQuery):
     except Exception:
         pass
 
-    await cb.message.answer(preview, reply_markup=_prepub_kb())
+    await cb.message.answer(render_preview(preview), reply_markup=_prepub_kb())
     await cb.answer()
 
 
@@ -265,51 +214,48 @@ async def receive_desc(msg: Message, state: FSMContext):
             pass
 
     urls = [f"tg://file_id/{pid}" for pid in photos]
-    _save_pack_to_cache(msg.from_user.id, pack)
-
-    preview = f"""<b>DeviantArt — предпросмотр</b>
-<b>Кадров в пачке:</b> {len(urls)}
-<b>Title (нумерация при публикации):</b> {html.escape(pack['title'])} (1), (2), …
-
-<b>Description:</b>
-<code>{html.escape(pack['description'][:2000])}</code>
-
-<b>Hashtags ({len(pack['hashtags'])}):</b> {" ".join(pack['hashtags'])}"""
+    await _save_pack_to_cache(msg.from_user.id, pack)
 
-    save_preview(msg.from_user.id, preview)
+    preview = preview_fields(pack, len(urls), MODE_PHOTOS)
+    await save_preview(msg.from_user.id, preview)
 
-    await msg.answer(preview, reply_markup=_prepub_kb())
+    await msg.answer(render_preview(preview), reply_markup=_prepub_kb())
     await state.clear()
 
 
 @router.callback_query(F.data == "da:do:publish")
-async def da_do_publish(cb: CallbackQuery):
-    u = await _get_user(cb.from_user.id, cb.from_user.username)
-    client = await _get_da_client_for_user(u.id)
+async def da_do_publish(cb: CallbackQuery, user: User):
+    client = await DeviantArtClient.for_user(user.id)
     if not client:
         await cb.message.answer("Сначала подключите DeviantArt в профиле.")
         await cb.answer(); return
 
     async with async_session() as s:
-        r = await s.execute(select(Generation).where(Generation.user_id == u.id).order_by(Generation.id.desc()))
+        r = await s.execute(
+            select(Generation).where(Generation.user_id == user.id).order_by(Generation.id.desc()).limit(1)
+        )
         gen = r.scalars().first()
     if not gen:
         await cb.message.answer("Нет готовых изображений для публикации.")
         await cb.answer(); return
 
-    urls = _read_last_urls_for_user(cb.from_user.id)
+    # одна выборка из user_state: URL + пачка (по tg id) и галереи (по db id)
+    docs = await us_aget_many([(NS_SETTINGS, cb.from_user.id), (NS_GALLERY, user.id)])
+    state_doc = docs[(NS_SETTINGS, str(cb.from_user.id))]
+
+    urls = _urls_from_state(state_doc)
     if not urls and getattr(gen, "image_url", None):
         urls = [gen.image_url]
     if not urls:
         await cb.message.answer("Не найдено URL изображений для пачки.")
         await cb.answer(); return
 
-    pack = _read_pack_from_cache(cb.from_user.id) or {}
+    pack = _pack_from_state(state_doc) or {}
     base_title = pack.get("title") or (getattr(gen, "title", None) or "Adoptable")
     description = pack.get("description") or (getattr(gen, "description", None) or getattr(gen, "prompt", ""))
     tags = _normalize_hashtags([t.lstrip('#') for t in (pack.get("hashtags") or [])]) or ["adoptable"]
 
-    prefs = get_galleries(u.id)
+    prefs = galleries_from_doc(docs[(NS_GALLERY, str(user.id))])
     gallery_ids = prefs.get("ids", [])  # если пусто → Featured
 
     results: List[str] = []
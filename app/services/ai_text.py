@@ -6,6 +6,8 @@ from typing import Optional, Dict, Any, List
 import httpx
 from tenacity import retry, wait_exponential, stop_after_attempt, retry_if_exception
 
+from app.services.rate_limits import limiter_for
+
 # ---------------- SD base (ГЛОБАЛЬНЫЕ НАСТРОЙКИ: добавляется в НАЧАЛО основного промпта при отправке в Tensor.Art) ----------------
 SD_BASE = (
     "score_9, score_8_up, score_7_up, score_6_up, highly detailed, intricate, "
@@ -184,7 +186,10 @@ class OpenAITextClient:
         self.model = (model or os.getenv("TEXT_MODEL") or "gpt-4o-mini").strip()
         fb_env = os.getenv("TEXT_MODEL_FALLBACKS", "")
         self.fallback_models: List[str] = [m.strip() for m in fb_env.split(",") if m.strip()]
-        self._client = httpx.AsyncClient(base_url=self.base_url, timeout=60.0)
+        self._limiter = limiter_for("openai", self.api_key)
+        self._client = httpx.AsyncClient(
+            base_url=self.base_url, timeout=60.0, event_hooks={"response": [self._limiter.on_response]},
+        )
         self.last_model_used: Optional[str] = None
 
     def _extract_text(self, data: Dict[str, Any]) -> str:
@@ -218,7 +223,8 @@ class OpenAITextClient:
             "Content-Type": "application/json",
             "Accept": "application/json",
         }
-        r = await self._client.post("chat/completions", headers=headers, json=payload)
+        async with self._limiter:
+            r = await self._client.post("chat/completions", headers=headers, json=payload)
         r.raise_for_status()
         return r.json()
 
@@ -1,125 +1,228 @@
 # app/services/autopost_store.py
 from __future__ import annotations
 
-import json
-import os
+import asyncio
+import atexit
+import copy
+import logging
+import threading
 import time
-from pathlib import Path
-from typing import Any, Dict, List, Optional, Tuple
-
-BASE_DIR = Path(__file__).resolve().parent.parent
-DATA_DIR = BASE_DIR / "data"
-DATA_DIR.mkdir(parents=True, exist_ok=True)
-STORE_JSON = DATA_DIR / "autopost_store.json"
-
-
-def _atomic_write(p: Path, payload: dict) -> None:
-    tmp = p.with_suffix(p.suffix + ".tmp")
-    tmp.write_text(json.dumps(payload, ensure_ascii=False, indent=2), encoding="utf-8")
-    os.replace(tmp, p)
-
-
-def _read_all() -> Dict[str, Any]:
-    if not STORE_JSON.exists():
-        return {}
-    try:
-        return json.loads(STORE_JSON.read_text(encoding="utf-8") or "{}")
-    except Exception:
-        return {}
-
-
-def _write_all(data: Dict[str, Any]) -> None:
-    _atomic_write(STORE_JSON, data)
-
-
-def ap_clear(user_id: int) -> None:
-    data = _read_all()
-    data[str(user_id)] = {
+from typing import Any, Dict, List, Optional, Set
+
+from app.config import settings
+from app.services.preview_render import render_preview
+from app.services.preview_store import KIND_AUTOPOST, get_preview, put_preview
+from app.services.user_state import (
+    NS_AUTOPOST, us_aget, us_delete_many, us_run_write, us_set_many, us_stale_keys,
+)
+
+log = logging.getLogger(__name__)
+
+# ---------- write-behind кэш ----------
+# Записи живут в памяти (подгружаются из user_state при первом обращении к юзеру);
+# изменения помечают юзера «грязным», а в хранилище уходят только грязные записи одной
+# транзакцией — по таймеру, при достижении порога или при остановке бота.
+_cache: Dict[str, Dict[str, Any]] = {}
+_dirty: Set[str] = set()
+_lock = threading.RLock()
+_flusher: Optional[asyncio.Task] = None
+_flush_now: Optional[asyncio.Event] = None
+
+
+async def _entry(key: str) -> Dict[str, Any]:
+    """Живая запись юзера; промах кэша читается из user_state в пуле, не в event loop."""
+    with _lock:
+        if key in _cache:
+            return _cache[key]
+    doc = await us_aget(key, NS_AUTOPOST)
+    with _lock:
+        # пока читали, запись мог создать другой апдейт — побеждает она
+        return _cache.setdefault(key, doc)
+
+
+def _empty_entry(ts: int) -> Dict[str, Any]:
+    return {
         "images": [],             # список tg_file_id
         "raw_name": "",
         "title": "",
         "keywords": "",
         "pack": {},               # {"title","description","hashtags":[]}
         "gallery_ids": [],
-        "last_preview": "",
-        "ts": int(time.time()),
+        "ts": ts,
     }
-    _write_all(data)
-
-
-def ap_add_image(user_id: int, tg_file_id: str) -> None:
-    data = _read_all()
-    obj = data.get(str(user_id))
-    if not obj:
-        ap_clear(user_id)
-        data = _read_all()
-        obj = data.get(str(user_id))
-    imgs: List[str] = list(obj.get("images") or [])
-    imgs.append(tg_file_id)
-    obj["images"] = imgs
-    obj["ts"] = int(time.time())
-    data[str(user_id)] = obj
-    _write_all(data)
-
-
-def ap_set_name(user_id: int, name: str) -> None:
-    data = _read_all()
-    obj = data.get(str(user_id)) or {}
-    obj["raw_name"] = name.strip()
-    obj["title"] = f'[OPEN!] ADOPTABLE - {obj["raw_name"]}'
-    obj["ts"] = int(time.time())
-    data[str(user_id)] = obj
-    _write_all(data)
-
-
-def ap_set_keywords(user_id: int, keywords: str) -> None:
-    data = _read_all()
-    obj = data.get(str(user_id)) or {}
-    obj["keywords"] = keywords.strip()
-    obj["ts"] = int(time.time())
-    data[str(user_id)] = obj
-    _write_all(data)
-
-
-def ap_set_pack(user_id: int, pack: Dict[str, Any]) -> None:
+
+
+async def _touch(key: str) -> None:
+    """Пометить юзера изменённым; при большом числе грязных записей — сбросить сразу."""
+    with _lock:
+        _dirty.add(key)
+        over = len(_dirty) >= settings.AUTOPOST_FLUSH_THRESHOLD
+    if not over:
+        return
+    if _flusher and not _flusher.done() and _flush_now is not None:
+        _flush_now.set()  # сброс сделает фоновая задача в пуле потоков
+    else:
+        await us_run_write(ap_flush)
+
+
+def ap_flush() -> int:
+    """
+    Сбрасывает грязные записи в user_state. Возвращает число сброшенных юзеров.
+    Под _lock — только снимок и очистка _dirty: запись идёт без блокировки, чтобы
+    хендлеры в event loop не ждали на _lock, пока пул пишет в SQLite.
+    """
+    with _lock:
+        if not _dirty:
+            return 0
+        docs = {k: copy.deepcopy(_cache.get(k) or {}) for k in _dirty}
+        _dirty.clear()
+    try:
+        us_set_many(docs, NS_AUTOPOST)
+    except BaseException:
+        with _lock:
+            _dirty.update(docs)  # не записали — сбросим в следующий раз
+        raise
+    return len(docs)
+
+
+async def _flush_loop(interval: float) -> None:
+    while True:
+        try:
+            await asyncio.wait_for(_flush_now.wait(), timeout=interval)
+        except asyncio.TimeoutError:
+            pass
+        _flush_now.clear()
+        try:
+            await us_run_write(ap_flush)
+        except Exception:
+            log.exception("autopost_store flush failed")
+
+
+def start_autopost_flusher(interval: Optional[float] = None) -> None:
+    global _flusher, _flush_now
+    if _flusher and not _flusher.done():
+        return
+    _flush_now = asyncio.Event()
+    _flusher = asyncio.create_task(_flush_loop(interval or settings.AUTOPOST_FLUSH_INTERVAL))
+
+
+async def stop_autopost_flusher() -> None:
+    global _flusher
+    if _flusher:
+        _flusher.cancel()
+        try:
+            await _flusher
+        except asyncio.CancelledError:
+            pass
+        _flusher = None
+    await us_run_write(ap_flush)
+
+
+# страховка на случай остановки без stop_autopost_flusher()
+atexit.register(ap_flush)
+
+
+async def ap_clear(user_id: int) -> None:
+    with _lock:
+        _cache[str(user_id)] = _empty_entry(int(time.time()))
+    await _touch(str(user_id))
+
+
+async def ap_add_image(user_id: int, tg_file_id: str) -> None:
+    key = str(user_id)
+    obj = await _entry(key)
+    with _lock:
+        if not obj:
+            obj = _cache[key] = _empty_entry(int(time.time()))
+        imgs: List[str] = list(obj.get("images") or [])
+        imgs.append(tg_file_id)
+        obj["images"] = imgs
+        obj["ts"] = int(time.time())
+    await _touch(key)
+
+
+async def ap_set_name(user_id: int, name: str) -> None:
+    key = str(user_id)
+    obj = await _entry(key)
+    with _lock:
+        obj["raw_name"] = name.strip()
+        obj["title"] = f'[OPEN!] ADOPTABLE - {obj["raw_name"]}'
+        obj["ts"] = int(time.time())
+    await _touch(key)
+
+
+async def ap_set_keywords(user_id: int, keywords: str) -> None:
+    key = str(user_id)
+    obj = await _entry(key)
+    with _lock:
+        obj["keywords"] = keywords.strip()
+        obj["ts"] = int(time.time())
+    await _touch(key)
+
+
+async def ap_set_pack(user_id: int, pack: Dict[str, Any]) -> None:
     # гарантируем, что заголовок = нашему title
-    data = _read_all()
-    obj = data.get(str(user_id)) or {}
-    obj["pack"] = dict(pack or {})
-    if obj.get("title"):
-        obj["pack"]["title"] = obj["title"]
-    obj["ts"] = int(time.time())
-    data[str(user_id)] = obj
-    _write_all(data)
-
-
-def ap_set_gallery_ids(user_id: int, gallery_ids: List[str]) -> None:
-    data = _read_all()
-    obj = data.get(str(user_id)) or {}
-    obj["gallery_ids"] = list(gallery_ids or [])
-    obj["ts"] = int(time.time())
-    data[str(user_id)] = obj
-    _write_all(data)
-
-
-def ap_set_preview(user_id: int, preview_html: str) -> None:
-    data = _read_all()
-    obj = data.get(str(user_id)) or {}
-    obj["last_preview"] = preview_html
-    obj["ts"] = int(time.time())
-    data[str(user_id)] = obj
-    _write_all(data)
-
-
-def ap_get(user_id: int) -> Dict[str, Any]:
-    data = _read_all()
-    return data.get(str(user_id)) or {
-        "images": [],
-        "raw_name": "",
-        "title": "",
-        "keywords": "",
-        "pack": {},
-        "gallery_ids": [],
-        "last_preview": "",
-        "ts": 0,
-    }
+    key = str(user_id)
+    obj = await _entry(key)
+    with _lock:
+        obj["pack"] = copy.deepcopy(dict(pack or {}))
+        if obj.get("title"):
+            obj["pack"]["title"] = obj["title"]
+        obj["ts"] = int(time.time())
+    await _touch(key)
+
+
+async def ap_set_gallery_ids(user_id: int, gallery_ids: List[str]) -> None:
+    key = str(user_id)
+    obj = await _entry(key)
+    with _lock:
+        obj["gallery_ids"] = list(gallery_ids or [])
+        obj["ts"] = int(time.time())
+    await _touch(key)
+
+
+def ap_sweep(older_than: int) -> int:
+    """
+    Удаляет черновики автопоста, не менявшиеся с older_than (по полю ts):
+    из кэша и из user_state. Возвращает число удалённых юзеров.
+    Выполняется в пуле (us_run_write); SQLite — вне _lock.
+    """
+    with _lock:
+        stale = {k for k, v in _cache.items() if int((v or {}).get("ts") or 0) < older_than}
+        for k in stale:
+            _cache.pop(k, None)
+            _dirty.discard(k)
+    # в хранилище — по времени последнего сброса; живые записи кэша не трогаем
+    candidates = us_stale_keys(NS_AUTOPOST, older_than)
+    with _lock:
+        stored = [k for k in candidates if k not in _cache]
+    us_delete_many(stored, NS_AUTOPOST)
+    return len(stale | set(stored))
+
+
+async def ap_set_preview(user_id: int, preview: Dict[str, Any]) -> None:
+    # предпросмотр (поля preview_fields) живёт в журнале (preview_store), в записи — только отметка времени
+    await put_preview(KIND_AUTOPOST, user_id, preview)
+    key = str(user_id)
+    obj = await _entry(key)
+    with _lock:
+        obj["ts"] = int(time.time())
+    await _touch(key)
+
+
+async def ap_get_preview(user_id: int) -> str:
+    """Последний предпросмотр автопоста; после ap_clear() (пустая пачка) — пустая строка."""
+    obj = await _entry(str(user_id))
+    with _lock:
+        if not obj.get("pack"):
+            return ""
+    return render_preview(await get_preview(KIND_AUTOPOST, user_id))
+
+
+async def ap_get(user_id: int) -> Dict[str, Any]:
+    # копия, чтобы вызывающий код не мутировал живую запись в обход _touch()
+    obj = await _entry(str(user_id))
+    with _lock:
+        if obj:
+            return copy.deepcopy(obj)
+    return _empty_entry(0)
@@ -0,0 +1,67 @@
+# app/services/credentials.py
+from __future__ import annotations
+
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, Optional, Tuple
+
+from sqlalchemy import select
+
+from app.config import settings
+from app.crypto import fernet_decrypt
+from app.db import async_session
+from app.models import ApiCredentials
+
+
+@dataclass(frozen=True)
+class Creds:
+    """Расшифрованные креды сервиса для юзера."""
+    access_token: Optional[str]
+    refresh_token: Optional[str]
+    meta: Dict[str, Any] = field(default_factory=dict)
+
+
+# (user_id, service) -> (expires_at, Creds). Отсутствие кредов не кэшируем:
+# только что подключённый сервис должен быть виден сразу.
+_cache: "OrderedDict[Tuple[int, str], Tuple[float, Creds]]" = OrderedDict()
+
+
+async def get_creds(user_id: int, service: str) -> Optional[Creds]:
+    key = (user_id, service)
+    hit = _cache.get(key)
+    if hit is not None and hit[0] > time.monotonic():
+        _cache.move_to_end(key)
+        return hit[1]
+
+    async with async_session() as s:
+        r = await s.execute(
+            select(ApiCredentials).where(
+                ApiCredentials.user_id == user_id,
+                ApiCredentials.service == service,
+            )
+        )
+        cred = r.scalar_one_or_none()
+    if cred is None:
+        _cache.pop(key, None)
+        return None
+
+    creds = Creds(
+        access_token=fernet_decrypt(cred.access_token_enc),
+        refresh_token=fernet_decrypt(cred.refresh_token_enc),
+        meta=dict(cred.meta_json) if isinstance(cred.meta_json, dict) else {},
+    )
+    _cache[key] = (time.monotonic() + settings.CREDS_CACHE_TTL, creds)
+    _cache.move_to_end(key)
+    while len(_cache) > settings.CREDS_CACHE_SIZE:
+        _cache.popitem(last=False)
+    return creds
+
+
+def invalidate_creds(user_id: int, service: Optional[str] = None) -> None:
+    """Сбросить кэш после записи/удаления кредов (service=None — все сервисы юзера)."""
+    if service is not None:
+        _cache.pop((user_id, service), None)
+        return
+    for key in [k for k in _cache if k[0] == user_id]:
+        _cache.pop(key, None)
@@ -0,0 +1,221 @@
+# app/services/db_writer.py
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional, TypeVar
+
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker
+
+from app.config import settings
+from app.db import async_session, create_writer_engine
+
+log = logging.getLogger(__name__)
+
+T = TypeVar("T")
+# операция записи: async def op(session, *args, **kwargs) — без commit, его делает db_write
+WriteOp = Callable[..., Awaitable[T]]
+
+# Сериализация записи (DB_SINGLE_WRITER=1): одна задача-писатель на процесс забирает
+# операции из очереди пачками до DB_WRITE_BATCH и выполняет их одной транзакцией,
+# каждую — в своём SAVEPOINT (ошибка одной операции не валит остальные).
+# Без флага db_write — обычная транзакция на вызов, с теми же ретраями и метриками.
+
+
+@dataclass
+class _Job:
+    fn: WriteOp
+    args: tuple
+    kwargs: dict
+    fut: asyncio.Future
+    enqueued: float = field(default_factory=time.perf_counter)
+
+
+_queue: Optional[asyncio.Queue] = None
+_task: Optional[asyncio.Task] = None
+_writer_engine: Optional[AsyncEngine] = None
+_writer_session: Optional[async_sessionmaker] = None
+
+_stats: Dict[str, float] = {
+    "ops": 0,
+    "transactions": 0,
+    "busy_retries": 0,
+    "busy_failures": 0,
+    "queue_wait_ms_total": 0.0,  # от постановки в очередь до начала транзакции
+    "queue_wait_ms_max": 0.0,
+    "txn_ms_total": 0.0,  # транзакция целиком: ожидание блокировки + операции + commit
+    "txn_ms_max": 0.0,
+}
+
+
+def _is_busy(exc: BaseException) -> bool:
+    if not isinstance(exc, OperationalError):
+        return False
+    msg = str(exc.orig if exc.orig is not None else exc).lower()
+    return "database is locked" in msg or "database is busy" in msg or "could not obtain lock" in msg
+
+
+def writer_stats() -> Dict[str, Any]:
+    """Счётчики записи этого процесса: ожидание в очереди/блокировки, ретраи на SQLITE_BUSY."""
+    out: Dict[str, Any] = dict(_stats)
+    out["mode"] = "single" if _task and not _task.done() else "direct"
+    out["queued"] = _queue.qsize() if _queue else 0
+    if _stats["ops"]:
+        out["queue_wait_ms_avg"] = round(_stats["queue_wait_ms_total"] / _stats["ops"], 3)
+    if _stats["transactions"]:
+        out["txn_ms_avg"] = round(_stats["txn_ms_total"] / _stats["transactions"], 3)
+        out["ops_per_txn"] = round(_stats["ops"] / _stats["transactions"], 2)
+    return out
+
+
+def _record_txn(t0: float) -> None:
+    ms = (time.perf_counter() - t0) * 1000
+    _stats["transactions"] += 1
+    _stats["txn_ms_total"] += ms
+    _stats["txn_ms_max"] = max(_stats["txn_ms_max"], ms)
+
+
+def _record_wait(job: _Job, started: float) -> None:
+    ms = (started - job.enqueued) * 1000
+    _stats["ops"] += 1
+    _stats["queue_wait_ms_total"] += ms
+    _stats["queue_wait_ms_max"] = max(_stats["queue_wait_ms_max"], ms)
+
+
+async def _backoff(attempt: int) -> None:
+    _stats["busy_retries"] += 1
+    await asyncio.sleep(settings.DB_BUSY_BACKOFF * (2 ** attempt))
+
+
+async def _run_direct(fn: WriteOp, args: tuple, kwargs: dict) -> Any:
+    for attempt in range(settings.DB_BUSY_RETRIES + 1):
+        t0 = time.perf_counter()
+        try:
+            async with async_session() as s:
+                result = await fn(s, *args, **kwargs)
+                await s.commit()
+        except OperationalError as e:
+            if _is_busy(e) and attempt < settings.DB_BUSY_RETRIES:
+                await _backoff(attempt)
+                continue
+            if _is_busy(e):
+                _stats["busy_failures"] += 1
+            raise
+        _record_txn(t0)
+        _stats["ops"] += 1
+        return result
+
+
+async def _run_batch(batch: List[_Job]) -> None:
+    for attempt in range(settings.DB_BUSY_RETRIES + 1):
+        t0 = time.perf_counter()
+        outcomes: List[tuple[bool, Any]] = []
+        try:
+            async with _writer_session() as s:
+                for job in batch:
+                    try:
+                        async with s.begin_nested():
+                            outcomes.append((True, await job.fn(s, *job.args, **job.kwargs)))
+                    except Exception as e:
+                        if _is_busy(e):
+                            raise
+                        outcomes.append((False, e))
+                await s.commit()
+        except Exception as e:
+            if _is_busy(e) and attempt < settings.DB_BUSY_RETRIES:
+                await _backoff(attempt)
+                continue
+            if _is_busy(e):
+                _stats["busy_failures"] += 1
+            for job in batch:
+                if not job.fut.done():
+                    job.fut.set_exception(e)
+            return
+        _record_txn(t0)
+        for job in batch:
+            _record_wait(job, t0)
+        # результаты отдаём только после commit — вызывающий код видит уже записанное
+        for job, (ok, value) in zip(batch, outcomes):
+            if job.fut.done():
+                continue
+            if ok:
+                job.fut.set_result(value)
+            else:
+                job.fut.set_exception(value)
+        return
+
+
+async def _writer_loop() -> None:
+    assert _queue is not None
+    window = settings.DB_WRITE_BATCH_WINDOW_MS / 1000
+    stopping = False
+    while not stopping:
+        first = await _queue.get()
+        if first is None:  # стоп-маркер от stop_db_writer
+            return
+        batch = [first]
+        deadline = time.perf_counter() + window
+        while len(batch) < settings.DB_WRITE_BATCH:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                job = await asyncio.wait_for(_queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if job is None:
+                stopping = True
+                break
+            batch.append(job)
+        batch = [j for j in batch if not j.fut.cancelled()]
+        if not batch:
+            continue
+        try:
+            await _run_batch(batch)
+        except Exception as e:  # не даём писателю умереть
+            log.exception("db writer batch failed")
+            for job in batch:
+                if not job.fut.done():
+                    job.fut.set_exception(e)
+
+
+async def db_write(fn: WriteOp, *args: Any, **kwargs: Any) -> Any:
+    """
+    Выполняет операцию записи fn(session, *args, **kwargs) и возвращает её результат.
+    fn не коммитит сама. С DB_SINGLE_WRITER — через очередь писателя (может попасть
+    в общую транзакцию с другими операциями), иначе — своей транзакцией.
+    """
+    if _task is None or _task.done():
+        return await _run_direct(fn, args, kwargs)
+    fut = asyncio.get_running_loop().create_future()
+    await _queue.put(_Job(fn, args, kwargs, fut))
+    return await fut
+
+
+def start_db_writer() -> None:
+    global _queue, _task, _writer_engine, _writer_session
+    if not settings.DB_SINGLE_WRITER or (_task and not _task.done()):
+        return
+    _writer_engine = create_writer_engine()
+    _writer_session = async_sessionmaker(_writer_engine, expire_on_commit=False, class_=AsyncSession, autoflush=False)
+    _queue = asyncio.Queue()
+    _task = asyncio.create_task(_writer_loop())
+
+
+async def stop_db_writer() -> None:
+    """Дописывает уже поставленные в очередь операции и останавливает писателя."""
+    global _task, _writer_engine
+    task, _task = _task, None  # новые db_write уже идут напрямую
+    if task:
+        await _queue.put(None)
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+    if _writer_engine is not None:
+        await _writer_engine.dispose()
+        _writer_engine = None
+    log.info("db writer stats: %s", writer_stats())
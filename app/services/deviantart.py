@@ -11,8 +11,9 @@ from sqlalchemy import select
 
 from app.config import settings
 from app.crypto import fernet_encrypt
-from app.db import async_session
 from app.models import ApiCredentials
+from app.services.credentials import get_creds, invalidate_creds
+from app.services.db_writer import db_write
 
 DA_API = "https://www.deviantart.com/api/v1/oauth2"
 DA_OAUTH = "https://www.deviantart.com/oauth2"
@@ -103,8 +104,27 @@ class DeviantArtClient:
             raise DeviantArtError("Empty access token")
         return await self._get_json(f"{DA_API}/user/whoami", headers={"Authorization": f"Bearer {self.access_token}"})
 
+    async def _reload_creds(self) -> bool:
+        """
+        Перечитать креды из БД мимо кэша. OAuth-callback идёт в процессе FastAPI и чистит только
+        свой кэш, так что после переподключения бот может держать старые токены до CREDS_CACHE_TTL.
+        True — в БД уже другой токен (переподключение или refresh другим клиентом), рефреш не нужен.
+        """
+        if not self.user_id:
+            return False
+        invalidate_creds(self.user_id, "deviantart")
+        creds = await get_creds(self.user_id, "deviantart")
+        if not creds or not creds.access_token or creds.access_token == self.access_token:
+            return False
+        self.access_token = creds.access_token
+        self.refresh_token = (creds.refresh_token or "").strip() or self.refresh_token
+        self._expires_at = None
+        return True
+
     async def _refresh_once(self) -> None:
         async with self._refresh_lock:
+            if await self._reload_creds():
+                return
             if not self.refresh_token:
                 raise DeviantArtError("Refresh token missing")
 
@@ -130,7 +150,7 @@ class DeviantArtClient:
                 await self._persist_tokens()
 
     async def _persist_tokens(self) -> None:
-        async with async_session() as s:
+        async def op(s) -> None:
             r = await s.execute(
                 select(ApiCredentials).where(
                     ApiCredentials.user_id == self.user_id,
@@ -142,7 +162,17 @@ class DeviantArtClient:
                 cred.access_token_enc = fernet_encrypt(self.access_token)
                 if self.refresh_token:
                     cred.refresh_token_enc = fernet_encrypt(self.refresh_token)
-                await s.commit()
+
+        await db_write(op)
+        invalidate_creds(self.user_id, "deviantart")
+
+    @classmethod
+    async def for_user(cls, user_id: int) -> Optional["DeviantArtClient"]:
+        """Клиент на кредах юзера (из кэша кредов); None — DeviantArt не подключён."""
+        creds = await get_creds(user_id, "deviantart")
+        if not creds:
+            return None
+        return cls(access_token=creds.access_token, refresh_token=creds.refresh_token, user_id=user_id)
 
     # ---------------- API ----------------
     async def gallery_folders(self) -> Dict[str, Any]:
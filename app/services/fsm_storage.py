@@ -0,0 +1,121 @@
+# app/services/fsm_storage.py
+from __future__ import annotations
+
+import json
+import time
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, KeyBuilder, StateType, StorageKey
+from sqlalchemy import and_, case, delete, or_, select
+
+from app.config import settings
+from app.db import async_session, dialect_insert
+from app.models import FsmRecord
+from app.services.db_writer import db_write
+
+
+def _json_default(obj: Any) -> Any:
+    # в FSM кладут set (выбранные галереи/лоры) — храним списком
+    if isinstance(obj, (set, frozenset)):
+        return sorted(obj, key=str)
+    raise TypeError(f"FSM data is not JSON serializable: {type(obj).__name__}")
+
+
+def _dumps(data: Dict[str, Any]) -> str:
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"), default=_json_default)
+
+
+async def purge_expired_fsm() -> int:
+    """Удаляет просроченные FSM-записи. Возвращает их число."""
+    now = time.time()
+
+    async def op(s) -> int:
+        res = await s.execute(
+            delete(FsmRecord).where(
+                and_(FsmRecord.expires_at.is_not(None), FsmRecord.expires_at <= now)
+            )
+        )
+        return int(res.rowcount or 0)
+
+    return await db_write(op)
+
+
+class SQLAlchemyStorage(BaseStorage):
+    """
+    aiogram FSM storage в таблице fsm_state на общем engine (SQLite/aiosqlite или Postgres).
+    Каждая запись живёт ttl секунд с последнего изменения; просроченная читается как пустая
+    и удаляется purge_expired(). Пустые записи (state=None, data={}) не хранятся вовсе.
+    """
+
+    def __init__(self, ttl: Optional[int] = None, key_builder: Optional[KeyBuilder] = None):
+        self.ttl = settings.FSM_TTL_SECONDS if ttl is None else ttl
+        self.key_builder = key_builder or DefaultKeyBuilder(with_destiny=True)
+
+    def _key(self, key: StorageKey) -> str:
+        return self.key_builder.build(key)
+
+    def _expires_at(self) -> Optional[float]:
+        return time.time() + self.ttl if self.ttl > 0 else None
+
+    @staticmethod
+    def _alive():
+        return or_(FsmRecord.expires_at.is_(None), FsmRecord.expires_at > time.time())
+
+    async def _upsert(self, k: str, column: str, value: Any) -> None:
+        now = time.time()
+        other, empty = ("data_json", "{}") if column == "state" else ("state", None)
+        expired = and_(FsmRecord.expires_at.is_not(None), FsmRecord.expires_at <= now)
+        stmt = dialect_insert(FsmRecord).values(key=k, **{column: value, "expires_at": self._expires_at()})
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[FsmRecord.key],
+            set_={
+                column: value,
+                # просроченная половина записи не должна «воскреснуть» вместе с новой
+                other: case((expired, empty), else_=getattr(FsmRecord, other)),
+                "expires_at": stmt.excluded.expires_at,
+            },
+        )
+        async def op(s) -> None:
+            await s.execute(stmt)
+            # state.clear() = set_state(None) + set_data({}) — пустую запись просто убираем
+            await s.execute(
+                delete(FsmRecord).where(
+                    FsmRecord.key == k, FsmRecord.state.is_(None), FsmRecord.data_json == "{}",
+                )
+            )
+
+        await db_write(op)
+
+    async def _row(self, key: StorageKey) -> Optional[FsmRecord]:
+        async with async_session() as s:
+            r = await s.execute(
+                select(FsmRecord).where(FsmRecord.key == self._key(key), self._alive())
+            )
+            return r.scalar_one_or_none()
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        value = state.state if isinstance(state, State) else state
+        await self._upsert(self._key(key), "state", value)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        row = await self._row(key)
+        return row.state if row else None
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        await self._upsert(self._key(key), "data_json", _dumps(data or {}))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        row = await self._row(key)
+        if not row:
+            return {}
+        try:
+            return json.loads(row.data_json or "{}")
+        except ValueError:
+            return {}
+
+    async def purge_expired(self) -> int:
+        return await purge_expired_fsm()
+
+    async def close(self) -> None:
+        return None
@@ -1,21 +1,20 @@
 # app/services/gallery_prefs.py
 from __future__ import annotations
 
-import json
-import os
-from pathlib import Path
-from typing import Dict, List, Tuple
+from typing import Any, Dict, List
 
-BASE_DIR = Path(__file__).resolve().parent.parent
-DATA_DIR = BASE_DIR / "data"
-DATA_DIR.mkdir(parents=True, exist_ok=True)
-GALLERY_JSON = DATA_DIR / "gallery_prefs.json"
+from app.services.user_state import NS_GALLERY, us_get, us_set
 
 
-def _atomic_write(p: Path, payload: dict) -> None:
-    tmp = p.with_suffix(p.suffix + ".tmp")
-    tmp.write_text(json.dumps(payload, ensure_ascii=False, indent=2), encoding="utf-8")
-    os.replace(tmp, p)
+def galleries_from_doc(obj: Dict[str, Any]) -> Dict[str, List[str]]:
+    """Нормализует документ namespace «gallery» в {"ids": [...], "names": [...]}."""
+    ids = list((obj or {}).get("ids") or [])
+    names = list((obj or {}).get("names") or [])
+    if len(ids) != len(names):
+        # самовосстановление: лишнее отбрасываем
+        n = min(len(ids), len(names))
+        ids, names = ids[:n], names[:n]
+    return {"ids": ids, "names": names}
 
 
 def get_galleries(user_id: int) -> Dict[str, List[str]]:
@@ -23,17 +22,7 @@ def get_galleries(user_id: int) -> Dict[str, List[str]]:
     Возвращает {"ids": [...], "names": [...]} либо пустые списки.
     """
     try:
-        if not GALLERY_JSON.exists():
-            return {"ids": [], "names": []}
-        data = json.loads(GALLERY_JSON.read_text(encoding="utf-8") or "{}")
-        obj = data.get(str(user_id)) or {}
-        ids = list(obj.get("ids") or [])
-        names = list(obj.get("names") or [])
-        if len(ids) != len(names):
-            # самовосстановление: лишнее отбрасываем
-            n = min(len(ids), len(names))
-            ids, names = ids[:n], names[:n]
-        return {"ids": ids, "names": names}
+        return galleries_from_doc(us_get(user_id, NS_GALLERY))
     except Exception:
         return {"ids": [], "names": []}
 
@@ -45,15 +34,7 @@ def set_galleries(user_id: int, ids: List[str], names: List[str]) -> None:
     if len(ids) != len(names):
         raise ValueError("ids and names length mismatch")
 
-    data: Dict[str, dict] = {}
-    if GALLERY_JSON.exists():
-        try:
-            data = json.loads(GALLERY_JSON.read_text(encoding="utf-8") or "{}")
-        except Exception:
-            data = {}
-
-    data[str(user_id)] = {"ids": list(ids), "names": list(names)}
-    _atomic_write(GALLERY_JSON, data)
+    us_set(user_id, {"ids": list(ids), "names": list(names)}, NS_GALLERY)
 
 
 # --- совместимость со старым кодом при желании ---
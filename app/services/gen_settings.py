@@ -0,0 +1,183 @@
+# app/services/gen_settings.py
+from __future__ import annotations
+
+import time
+from collections import OrderedDict
+from types import SimpleNamespace
+from typing import Any, Dict, Optional
+
+from sqlalchemy import or_, select, update
+
+from app.config import settings
+from app.db import async_session, dialect_insert
+from app.models import User, UserSettings
+from app.services.db_writer import db_write
+from app.services.user_state import NS_SETTINGS, us_items, us_meta_get, us_meta_set, us_run, us_run_write
+
+# ======= дефолты и нормализация =======
+ALLOWED_SIZES = {(768, 1152), (1024, 1024)}
+DEFAULT_WIDTH = 768
+DEFAULT_HEIGHT = 1152
+DEFAULT_STEPS = 20
+DEFAULT_CFG = 4.0
+
+FIELDS = ("width", "height", "steps", "cfg_scale", "model_id", "sd_model_id", "clip_skip")
+
+# user_id (БД) -> настройки; read-through на чтении, write-through на записи
+_cache: "OrderedDict[int, SimpleNamespace]" = OrderedDict()
+
+
+def _normalize_values(width: int, height: int, steps: int, cfg: float) -> tuple[int, int, int, float]:
+    w, h = int(width or 0), int(height or 0)
+    if (w, h) not in ALLOWED_SIZES:
+        if w == 768:
+            w, h = 768, 1152
+        elif w == 1024:
+            w, h = 1024, 1024
+        else:
+            w, h = DEFAULT_WIDTH, DEFAULT_HEIGHT
+    s = max(1, min(int(steps or DEFAULT_STEPS), 20))
+    c = max(1.0, min(float(cfg or DEFAULT_CFG), 10.0))
+    return w, h, s, c
+
+
+def _normalized(values: Dict[str, Any]) -> Dict[str, Any]:
+    out = dict(values)
+    out["width"], out["height"], out["steps"], out["cfg_scale"] = _normalize_values(
+        values.get("width"), values.get("height"), values.get("steps"), values.get("cfg_scale"),
+    )
+    return out
+
+
+def _env_defaults() -> Dict[str, Any]:
+    env_w = getattr(settings, "TENSORART_WIDTH", None)
+    env_h = getattr(settings, "TENSORART_HEIGHT", None)
+    env_steps = getattr(settings, "TENSORART_STEPS", None)
+    env_cfg = getattr(settings, "TENSORART_CFG", None)
+    return {
+        "width": int(env_w) if env_w is not None else DEFAULT_WIDTH,
+        "height": int(env_h) if env_h is not None else DEFAULT_HEIGHT,
+        "steps": int(env_steps) if env_steps is not None else DEFAULT_STEPS,
+        "cfg_scale": float(env_cfg) if env_cfg is not None else DEFAULT_CFG,
+        "model_id": getattr(settings, "TENSORART_MODEL_ID", None),
+    }
+
+
+LEGACY_MARKER = "imported:gen_settings"
+_IMPORT_CHUNK = 400  # юзеров на транзакцию / IN (...)
+
+
+def _legacy_docs() -> Dict[str, Dict[str, Any]]:
+    """user_key -> поля настроек генерации из старых документов user_state (где они были заданы)."""
+    out: Dict[str, Dict[str, Any]] = {}
+    for key, doc in us_items(NS_SETTINGS):
+        found = {f: doc[f] for f in FIELDS if doc.get(f) is not None}
+        if found:
+            out[key] = found
+    return out
+
+
+async def import_legacy_gen_settings() -> int:
+    """
+    Однократный перенос настроек генерации из user_state в UserSettings (отметка в user_state_meta).
+    Раньше JSON-значения были главнее таблицы (сначала по tg id, потом по db id), а строки с дефолтами
+    создавались заранее, — поэтому значения из user_state перекрывают уже существующие строки.
+    Возвращает число юзеров, чьи настройки перенесены.
+    """
+    if await us_run(us_meta_get, LEGACY_MARKER):
+        return 0
+    legacy = await us_run(_legacy_docs)
+    numeric = sorted({int(k) for k in legacy if k.lstrip("-").isdigit()})
+    picked: Dict[int, Dict[str, Any]] = {}
+    for i in range(0, len(numeric), _IMPORT_CHUNK):
+        chunk = numeric[i:i + _IMPORT_CHUNK]
+        async with async_session() as s:
+            rows = (await s.execute(
+                select(User.id, User.tg_id).where(or_(User.tg_id.in_(chunk), User.id.in_(chunk)))
+            )).all()
+        for user_id, tg_id in rows:
+            values = legacy.get(str(tg_id)) or legacy.get(str(user_id))
+            if values:
+                picked[user_id] = values
+
+    async def op(s, batch: Dict[int, Dict[str, Any]]) -> None:
+        existing = {
+            st.user_id: st for st in (await s.execute(
+                select(UserSettings).where(UserSettings.user_id.in_(list(batch)))
+            )).scalars()
+        }
+        for user_id, values in batch.items():
+            st = existing.get(user_id)
+            if st is None:
+                s.add(UserSettings(user_id=user_id, **_normalized({**_env_defaults(), **values})))
+            else:
+                for f, v in _normalized({**vars(_snapshot(st)), **values}).items():
+                    setattr(st, f, v)
+
+    ids = list(picked)
+    for i in range(0, len(ids), _IMPORT_CHUNK):
+        await db_write(op, {u: picked[u] for u in ids[i:i + _IMPORT_CHUNK]})
+    for user_id in ids:
+        _cache.pop(user_id, None)
+    await us_run_write(us_meta_set, LEGACY_MARKER, str(int(time.time())))
+    return len(ids)
+
+
+def _snapshot(st: UserSettings) -> SimpleNamespace:
+    return SimpleNamespace(**{f: getattr(st, f) for f in FIELDS})
+
+
+def _remember(user_id: int, ns: SimpleNamespace) -> SimpleNamespace:
+    _cache[user_id] = ns
+    _cache.move_to_end(user_id)
+    while len(_cache) > settings.USER_CACHE_SIZE:
+        _cache.popitem(last=False)
+    return SimpleNamespace(**vars(ns))  # копия: вызывающий код не портит кэш
+
+
+async def get_gen_settings(user_id: int, tg_id: Optional[int] = None) -> SimpleNamespace:
+    """
+    Настройки генерации юзера (width, height, steps, cfg_scale, model_id, sd_model_id, clip_skip).
+    Источник — таблица UserSettings; строка создаётся при первом обращении из дефолтов .env
+    (старые значения из user_state переносит import_legacy_gen_settings при старте).
+    """
+    hit = _cache.get(user_id)
+    if hit is not None:
+        _cache.move_to_end(user_id)
+        return SimpleNamespace(**vars(hit))
+
+    async with async_session() as s:
+        st = (await s.execute(select(UserSettings).where(UserSettings.user_id == user_id))).scalar_one_or_none()
+    if st is None:
+        values = _normalized(_env_defaults())
+
+        async def op(s) -> UserSettings:
+            await s.execute(
+                dialect_insert(UserSettings)
+                .values(user_id=user_id, **values)
+                .on_conflict_do_nothing(index_elements=[UserSettings.user_id])
+            )
+            return (await s.execute(select(UserSettings).where(UserSettings.user_id == user_id))).scalar_one()
+
+        st = await db_write(op)
+    else:
+        fixed = _normalized(vars(_snapshot(st)))
+        if any(fixed[f] != getattr(st, f) for f in ("width", "height", "steps", "cfg_scale")):
+            # старые строки с недопустимыми значениями чиним один раз, при первой загрузке
+            return await _write(user_id, fixed)
+    return _remember(user_id, _snapshot(st))
+
+
+async def update_gen_settings(user_id: int, tg_id: Optional[int] = None, **fields: Any) -> SimpleNamespace:
+    """Меняет поля настроек (с нормализацией) и сразу обновляет кэш."""
+    current = vars(await get_gen_settings(user_id, tg_id))
+    return await _write(user_id, _normalized({**current, **{k: v for k, v in fields.items() if k in FIELDS}}))
+
+
+async def _write(user_id: int, values: Dict[str, Any]) -> SimpleNamespace:
+    # запись настроек редкая (кнопки в панели) — UPDATE + SELECT в одной транзакции, без RETURNING
+    async def op(s) -> UserSettings:
+        await s.execute(update(UserSettings).where(UserSettings.user_id == user_id).values(**values))
+        return (await s.execute(select(UserSettings).where(UserSettings.user_id == user_id))).scalar_one()
+
+    return _remember(user_id, _snapshot(await db_write(op)))
@@ -0,0 +1,119 @@
+# app/services/generation_archive.py
+from __future__ import annotations
+
+import json
+import zlib
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import delete, func, select
+
+from app.config import settings
+from app.db import async_session
+from app.models import Generation, GenerationArchive, User
+from app.services.db_writer import db_write
+from app.services.generations import pinned_generation_ids
+
+# поля, которые уходят в сжатый payload (остальное — колонки архива)
+PAYLOAD_FIELDS = (
+    "title", "description", "tags_csv", "prompt", "negative_prompt",
+    "style", "image_url", "image_cost_credits",
+)
+
+
+def _pack(gen: Generation) -> bytes:
+    doc = {f: getattr(gen, f) for f in PAYLOAD_FIELDS}
+    return zlib.compress(json.dumps(doc, ensure_ascii=False, separators=(",", ":")).encode("utf-8"), 6)
+
+
+def _row_to_dict(gen: Generation) -> Dict[str, Any]:
+    d = {f: getattr(gen, f) for f in PAYLOAD_FIELDS}
+    d.update(id=gen.id, user_id=gen.user_id, status=gen.status, created_at=gen.created_at, archived=False)
+    return d
+
+
+def _archived_to_dict(row: GenerationArchive) -> Dict[str, Any]:
+    d = json.loads(zlib.decompress(row.payload).decode("utf-8"))
+    d.update(id=row.id, user_id=row.user_id, status=row.status, created_at=row.created_at, archived=True)
+    return d
+
+
+async def archive_old_generations(older_than_days: Optional[float] = None, batch: Optional[int] = None) -> int:
+    """
+    Переносит генерации старше older_than_days (по умолчанию GEN_ARCHIVE_DAYS) в generations_archive
+    пачками по batch строк, каждая пачка — одна транзакция. Последнюю генерацию юзера и те, на которые
+    указывает active_gen_id/current_gen_id (pinned_generation_ids), не трогаем. Возвращает число перенесённых строк.
+    """
+    days = settings.GEN_ARCHIVE_DAYS if older_than_days is None else older_than_days
+    size = batch or settings.GEN_ARCHIVE_BATCH
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    latest = select(func.max(Generation.id)).group_by(Generation.user_id)
+
+    async def op(s, rows: List[Generation]) -> None:
+        now = datetime.utcnow()
+        s.add_all(
+            GenerationArchive(
+                id=g.id, user_id=g.user_id, status=g.status,
+                created_at=g.created_at, archived_at=now, payload=_pack(g),
+            )
+            for g in rows
+        )
+        await s.execute(delete(Generation).where(Generation.id.in_([g.id for g in rows])))
+
+    moved, after = 0, 0
+    while True:
+        async with async_session() as s:
+            r = await s.execute(
+                select(Generation, User.tg_id)
+                .join(User, User.id == Generation.user_id)
+                .where(Generation.created_at < cutoff, Generation.id.not_in(latest), Generation.id > after)
+                .order_by(Generation.id)
+                .limit(size)
+            )
+            page = r.all()
+        if not page:
+            break
+        after = page[-1][0].id  # курсор по id: закреплённые строки не выбираются повторно
+        pinned = await pinned_generation_ids((g.id, g.user_id, tg_id) for g, tg_id in page)
+        rows = [g for g, _ in page if g.id not in pinned]
+        if rows:
+            await db_write(op, rows)
+        moved += len(rows)
+        if len(page) < size:
+            break
+    return moved
+
+
+async def generation_history(
+    user_id: int, *, limit: int = 20, before_id: Optional[int] = None,
+) -> List[Dict[str, Any]]:
+    """
+    История генераций юзера — горячая таблица и архив вместе, от новых к старым.
+    Пагинация: before_id = id последней записи предыдущей страницы.
+    """
+    async with async_session() as s:
+        hot_q = select(Generation).where(Generation.user_id == user_id)
+        cold_q = select(GenerationArchive).where(GenerationArchive.user_id == user_id)
+        if before_id is not None:
+            hot_q = hot_q.where(Generation.id < before_id)
+            cold_q = cold_q.where(GenerationArchive.id < before_id)
+        hot = (await s.execute(hot_q.order_by(Generation.id.desc()).limit(limit))).scalars().all()
+        cold = (await s.execute(cold_q.order_by(GenerationArchive.id.desc()).limit(limit))).scalars().all()
+    # id в таблицах перемешаны (закреплённые и последние старые строки остаются в горячей) — сливаем по id
+    out = [_row_to_dict(g) for g in hot] + [_archived_to_dict(a) for a in cold]
+    out.sort(key=lambda d: d["id"], reverse=True)
+    return out[:limit]
+
+
+async def get_generation_any(gen_id: int, user_id: int) -> Optional[Dict[str, Any]]:
+    """Генерация по id — из горячей таблицы или из архива."""
+    async with async_session() as s:
+        g = (await s.execute(
+            select(Generation).where(Generation.id == gen_id, Generation.user_id == user_id)
+        )).scalar_one_or_none()
+        if g is not None:
+            return _row_to_dict(g)
+        a = (await s.execute(
+            select(GenerationArchive).where(GenerationArchive.id == gen_id, GenerationArchive.user_id == user_id)
+        )).scalar_one_or_none()
+    return _archived_to_dict(a) if a is not None else None
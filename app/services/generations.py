@@ -0,0 +1,144 @@
+# app/services/generations.py
+from __future__ import annotations
+
+import json
+import sqlite3
+import time
+from datetime import datetime, timedelta
+from typing import Any, Iterable, Set, Tuple
+
+from sqlalchemy import delete, func, insert, or_, select, update
+
+from app.db import async_session, engine
+from app.models import FsmRecord, Generation, User
+from app.services.db_writer import db_write
+from app.services.user_state import NS_SETTINGS, us_aget_many
+
+_PIN_CHUNK = 200  # пользователей на запрос к user_state (по 2 ключа — в лимит параметров SQLite)
+
+# UPDATE ... RETURNING: Postgres — всегда, SQLite — с 3.35
+_HAS_RETURNING = engine.dialect.name == "postgresql" or (
+    engine.dialect.name == "sqlite" and sqlite3.sqlite_version_info >= (3, 35)
+)
+
+
+async def update_generation(gen_id: int, **values: Any) -> Generation:
+    """
+    Обновляет поля генерации и возвращает обновлённую строку — одним
+    UPDATE ... RETURNING, где он есть, иначе UPDATE + SELECT в той же транзакции.
+    """
+    stmt = update(Generation).where(Generation.id == gen_id).values(**values)
+
+    async def op(s) -> Generation:
+        if _HAS_RETURNING:
+            r = await s.execute(
+                stmt.returning(Generation).execution_options(synchronize_session=False)
+            )
+        else:
+            await s.execute(stmt)
+            r = await s.execute(select(Generation).where(Generation.id == gen_id))
+        return r.scalar_one()
+
+    return await db_write(op)
+
+
+async def reuse_or_create_draft(user_id: int, **defaults: Any) -> int:
+    """
+    id черновика генерации для юзера: берём последний нетронутый черновик
+    (text_ready, без картинки, все поля всё ещё равны defaults), иначе вставляем новый.
+    """
+    untouched = [getattr(Generation, k) == v for k, v in defaults.items()]
+
+    async def op(s) -> int:
+        r = await s.execute(
+            select(Generation.id)
+            .where(
+                Generation.user_id == user_id,
+                Generation.status == "text_ready",
+                Generation.image_url.is_(None),
+                *untouched,
+            )
+            .order_by(Generation.id.desc())
+            .limit(1)
+        )
+        gen_id = r.scalar_one_or_none()
+        if gen_id is not None:
+            # снова в работе — для ретеншна черновик «свежий», пока его не бросят ещё раз
+            await s.execute(update(Generation).where(Generation.id == gen_id).values(created_at=datetime.utcnow()))
+            return gen_id
+        q = await s.execute(
+            insert(Generation).values(user_id=user_id, **defaults).returning(Generation.id)
+        )
+        return q.scalar_one()
+
+    return await db_write(op)
+
+
+async def pinned_generation_ids(rows: Iterable[Tuple[int, int, int]]) -> Set[int]:
+    """
+    Из строк (gen_id, user_id, tg_id) — id, на которые ещё указывают: active_gen_id в user_state
+    (документ пишется и под tg_id, и под id из БД) или current_gen_id в живой FSM-записи.
+    Такие генерации ретеншн не трогает, иначе открытый редактор упадёт на NoResultFound.
+    """
+    rows = list(rows)
+    if not rows:
+        return set()
+    ids = {gen_id for gen_id, _, _ in rows}
+    pinned: Set[int] = set()
+
+    users = sorted({k for _, user_id, tg_id in rows for k in (user_id, tg_id) if k is not None})
+    for i in range(0, len(users), _PIN_CHUNK):
+        docs = await us_aget_many((NS_SETTINGS, k) for k in users[i:i + _PIN_CHUNK])
+        for doc in docs.values():
+            try:
+                pinned.add(int(doc.get("active_gen_id")))
+            except (TypeError, ValueError):
+                pass
+
+    async with async_session() as s:
+        fsm = (await s.execute(
+            select(FsmRecord.data_json).where(
+                or_(FsmRecord.expires_at.is_(None), FsmRecord.expires_at > time.time()),
+                FsmRecord.data_json.contains('"current_gen_id"'),
+            )
+        )).scalars().all()
+    for raw in fsm:
+        try:
+            pinned.add(int(json.loads(raw).get("current_gen_id")))
+        except (TypeError, ValueError, AttributeError):
+            pass
+    return pinned & ids
+
+
+async def purge_stale_drafts(older_than_days: float) -> int:
+    """
+    Удаляет брошенные черновики: text_ready без картинки, созданные раньше окна.
+    Не трогаем последнюю генерацию каждого юзера и те, на которые указывает
+    active_gen_id/current_gen_id (pinned_generation_ids). Возвращает число удалённых строк.
+    """
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+    latest = select(func.max(Generation.id)).group_by(Generation.user_id)
+    stale = (
+        Generation.status == "text_ready",
+        Generation.image_url.is_(None),
+        Generation.created_at < cutoff,
+        Generation.id.not_in(latest),
+    )
+    async with async_session() as s:
+        rows = (await s.execute(
+            select(Generation.id, Generation.user_id, User.tg_id)
+            .join(User, User.id == Generation.user_id)
+            .where(*stale)
+        )).all()
+    pinned = await pinned_generation_ids(rows)
+    doomed = [r.id for r in rows if r.id not in pinned]
+
+    async def op(s, chunk) -> int:
+        # условия повторяем: черновик могли тронуть, пока собирали pinned
+        res = await s.execute(delete(Generation).where(Generation.id.in_(chunk), *stale))
+        return int(res.rowcount or 0)
+
+    deleted = 0
+    for i in range(0, len(doomed), _PIN_CHUNK):
+        deleted += await db_write(op, doomed[i:i + _PIN_CHUNK])
+    return deleted
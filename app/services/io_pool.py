@@ -0,0 +1,50 @@
+# app/services/io_pool.py
+from __future__ import annotations
+
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, TypeVar
+
+from app.config import settings
+
+T = TypeVar("T")
+
+# Ограниченный пул для файлового/SQLite I/O: хэндлеры aiogram не блокируют event loop
+_executor: Optional[ThreadPoolExecutor] = None
+_write_locks: Dict[str, asyncio.Lock] = {}
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=max(1, settings.IO_POOL_WORKERS),
+            thread_name_prefix="io",
+        )
+    return _executor
+
+
+async def run_io(fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """Выполнить синхронную I/O-функцию в пуле и дождаться результата."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_executor(), functools.partial(fn, *args, **kwargs))
+
+
+async def run_write(resource: str, fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """
+    То же, что run_io, но записи в один ресурс (файл) идут строго по очереди:
+    ждущие писатели не занимают потоки пула и не мешают чтениям.
+    """
+    lock = _write_locks.get(resource)
+    if lock is None:
+        lock = _write_locks[resource] = asyncio.Lock()
+    async with lock:
+        return await run_io(fn, *args, **kwargs)
+
+
+def shutdown_io_pool() -> None:
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
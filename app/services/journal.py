@@ -0,0 +1,203 @@
+# app/services/journal.py
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from app.config import settings
+from app.services.io_pool import run_io, run_write
+
+log = logging.getLogger(__name__)
+
+
+class Journal:
+    """
+    Append-only лог JSON-записей: одна строка {"k": key, "t": ts, "v": value} на запись.
+    Запись = дописать строку (O(размер записи)); чтение = seek по индексу key -> (offset, length).
+    Удаление — строка с "v": null. Перезаписанные/удалённые строки копятся как мусор,
+    compact() переписывает файл только живыми записями.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._fh = None
+        self._index: Dict[str, Tuple[int, int, int]] = {}  # key -> (offset, length, ts)
+        self._size = 0
+        self._live = 0
+
+    # ---------- открытие / индекс ----------
+    def _ensure_open(self) -> None:
+        if self._fh is not None:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._fh = open(self.path, "a+b")
+        self._rebuild_index()
+
+    def _rebuild_index(self) -> None:
+        self._index.clear()
+        self._live = 0
+        self._fh.seek(0)
+        offset = 0
+        for line in self._fh:
+            length = len(line)
+            if not line.endswith(b"\n"):
+                # хвост от прерванной записи — отрезаем
+                self._fh.truncate(offset)
+                break
+            try:
+                rec = json.loads(line)
+                key = str(rec["k"])
+            except Exception:
+                offset += length
+                continue
+            old = self._index.pop(key, None)
+            if old:
+                self._live -= old[1]
+            if rec.get("v") is not None:
+                self._index[key] = (offset, length, int(rec.get("t") or 0))
+                self._live += length
+            offset += length
+        self._size = offset
+        self._fh.seek(0, os.SEEK_END)
+
+    def open(self) -> None:
+        """Открывает (и при необходимости создаёт) файл журнала и строит индекс."""
+        with self._lock:
+            self._ensure_open()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._fh is not None:
+                self._fh.close()
+                self._fh = None
+
+    # ---------- API ----------
+    def get(self, key: str) -> Any:
+        with self._lock:
+            self._ensure_open()
+            pos = self._index.get(key)
+            if not pos:
+                return None
+            self._fh.seek(pos[0])
+            raw = self._fh.read(pos[1])
+            self._fh.seek(0, os.SEEK_END)
+        try:
+            return json.loads(raw).get("v")
+        except Exception:
+            return None
+
+    def put(self, key: str, value: Any) -> None:
+        self._append(key, value)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._ensure_open()
+            if key not in self._index:
+                return
+        self._append(key, None)
+
+    def items(self) -> Iterator[Tuple[str, int]]:
+        """(key, ts последней записи) для живых ключей."""
+        with self._lock:
+            self._ensure_open()
+            snapshot = [(k, v[2]) for k, v in self._index.items()]
+        return iter(snapshot)
+
+    def _append(self, key: str, value: Any) -> None:
+        ts = int(time.time())
+        line = (json.dumps({"k": key, "t": ts, "v": value}, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+        with self._lock:
+            self._ensure_open()
+            offset = self._size
+            self._fh.write(line)
+            self._fh.flush()
+            self._size += len(line)
+            old = self._index.pop(key, None)
+            if old:
+                self._live -= old[1]
+            if value is not None:
+                self._index[key] = (offset, len(line), ts)
+                self._live += len(line)
+
+    # ---------- компакция ----------
+    def garbage_bytes(self) -> int:
+        with self._lock:
+            self._ensure_open()
+            return self._size - self._live
+
+    def needs_compaction(self) -> bool:
+        garbage = self.garbage_bytes()
+        return (
+            garbage >= settings.JOURNAL_COMPACT_MIN_BYTES
+            and garbage >= self._size * settings.JOURNAL_COMPACT_RATIO
+        )
+
+    def compact(self) -> int:
+        """Переписывает файл только живыми записями. Возвращает число освобождённых байт."""
+        with self._lock:
+            self._ensure_open()
+            before = self._size
+            tmp = self.path.with_suffix(self.path.suffix + ".tmp")
+            with open(tmp, "wb") as out:
+                for offset, length, _ts in sorted(self._index.values()):
+                    self._fh.seek(offset)
+                    out.write(self._fh.read(length))
+                out.flush()
+                os.fsync(out.fileno())
+            self._fh.close()
+            os.replace(tmp, self.path)
+            self._fh = open(self.path, "a+b")
+            self._rebuild_index()
+            return before - self._size
+
+    # ---------- async-обёртки (I/O в пуле, записи по очереди) ----------
+    async def aget(self, key: str) -> Any:
+        return await run_io(self.get, key)
+
+    async def aput(self, key: str, value: Any) -> None:
+        await run_write(str(self.path), self.put, key, value)
+
+    async def adelete(self, key: str) -> None:
+        await run_write(str(self.path), self.delete, key)
+
+
+_compactor: Optional[asyncio.Task] = None
+
+
+async def _compact_loop(journals: List[Journal], interval: float) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        for j in journals:
+            try:
+                if await run_io(j.needs_compaction):
+                    freed = await run_write(str(j.path), j.compact)
+                    log.info("journal %s compacted, freed %d bytes", j.path.name, freed)
+            except Exception:
+                log.exception("journal %s compaction failed", j.path.name)
+
+
+def start_journal_compactor(*journals: Journal, interval: Optional[float] = None) -> None:
+    global _compactor
+    if _compactor and not _compactor.done():
+        return
+    _compactor = asyncio.create_task(
+        _compact_loop(list(journals), interval or settings.JOURNAL_COMPACT_INTERVAL)
+    )
+
+
+async def stop_journal_compactor() -> None:
+    global _compactor
+    if _compactor:
+        _compactor.cancel()
+        try:
+            await _compactor
+        except asyncio.CancelledError:
+            pass
+        _compactor = None
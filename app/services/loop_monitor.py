@@ -0,0 +1,77 @@
+# app/services/loop_monitor.py
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Deque, Dict, Optional
+
+from app.config import settings
+
+log = logging.getLogger(__name__)
+
+# Замер задержки event loop: таймер просыпается каждые interval секунд;
+# насколько позже он проснулся — столько loop был занят синхронной работой.
+_samples: Deque[float] = deque(maxlen=2048)
+_task: Optional[asyncio.Task] = None
+
+
+def _percentile(sorted_vals: list[float], q: float) -> float:
+    if not sorted_vals:
+        return 0.0
+    idx = min(len(sorted_vals) - 1, int(round(q * (len(sorted_vals) - 1))))
+    return sorted_vals[idx]
+
+
+def loop_lag_stats() -> Dict[str, float]:
+    """Статистика задержки (мс) по последним замерам."""
+    vals = sorted(_samples)
+    return {
+        "samples": float(len(vals)),
+        "p50_ms": _percentile(vals, 0.50) * 1000,
+        "p99_ms": _percentile(vals, 0.99) * 1000,
+        "max_ms": (vals[-1] if vals else 0.0) * 1000,
+    }
+
+
+async def _monitor(interval: float, report_every: float, warn_ms: float) -> None:
+    last_report = time.perf_counter()
+    while True:
+        t0 = time.perf_counter()
+        await asyncio.sleep(interval)
+        lag = max(0.0, time.perf_counter() - t0 - interval)
+        _samples.append(lag)
+        if lag * 1000 >= warn_ms:
+            log.warning("event loop stalled for %.1f ms", lag * 1000)
+        now = time.perf_counter()
+        if report_every and now - last_report >= report_every:
+            last_report = now
+            st = loop_lag_stats()
+            log.info(
+                "event loop lag: p50=%.1fms p99=%.1fms max=%.1fms (n=%d)",
+                st["p50_ms"], st["p99_ms"], st["max_ms"], int(st["samples"]),
+            )
+            _samples.clear()
+
+
+def start_loop_monitor() -> None:
+    global _task
+    if _task and not _task.done():
+        return
+    _task = asyncio.create_task(_monitor(
+        settings.LOOP_LAG_INTERVAL,
+        settings.LOOP_LAG_REPORT_INTERVAL,
+        settings.LOOP_LAG_WARN_MS,
+    ))
+
+
+async def stop_loop_monitor() -> None:
+    global _task
+    if _task:
+        _task.cancel()
+        try:
+            await _task
+        except asyncio.CancelledError:
+            pass
+        _task = None
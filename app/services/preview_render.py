@@ -0,0 +1,51 @@
+# app/services/preview_render.py
+from __future__ import annotations
+
+import html
+from typing import Any, Dict, List
+
+# Предпросмотр хранится структурой (см. preview_fields), HTML собирается только при показе.
+MODE_POST = "post"          # обычный постинг из последней генерации (da_publish_start)
+MODE_PHOTOS = "photos"      # постинг своих фото (receive_desc)
+MODE_AUTOPOST = "autopost"  # автопост / кастомный пост
+
+_HEADERS = {
+    MODE_POST: "DeviantArt — предпросмотр поста",
+    MODE_PHOTOS: "DeviantArt — предпросмотр",
+    MODE_AUTOPOST: "DeviantArt — предпросмотр кастомного поста",
+}
+
+DESC_PREVIEW_CHARS = 2000
+HASHTAGS_PREVIEW_MAX = 30
+
+
+def preview_fields(pack: Dict[str, Any], frames: int, mode: str) -> Dict[str, Any]:
+    """Поля предпросмотра из пачки (title/description/hashtags) — то, что пишется в журнал."""
+    tags = list(pack.get("hashtags") or [])
+    return {
+        "mode": mode,
+        "title": str(pack.get("title") or "Adoptable"),
+        "description": str(pack.get("description") or "")[:DESC_PREVIEW_CHARS],
+        "hashtags": [str(t) for t in tags[:HASHTAGS_PREVIEW_MAX]],
+        "hashtags_total": len(tags),  # в заголовке — настоящее число, показываем не больше HASHTAGS_PREVIEW_MAX
+        "frames": int(frames),
+    }
+
+
+def render_preview(preview: Any) -> str:
+    """
+    HTML предпросмотра для Telegram. Строку (старый формат журнала — уже готовый HTML)
+    возвращает как есть.
+    """
+    if not isinstance(preview, dict):
+        return str(preview or "")
+    tags: List[str] = list(preview.get("hashtags") or [])
+    header = _HEADERS.get(str(preview.get("mode")), _HEADERS[MODE_POST])
+    return (
+        f"<b>{header}</b>\n"
+        f"<b>Кадров в пачке:</b> {int(preview.get('frames') or 0)}\n"
+        f"<b>Title (нумерация при публикации):</b> {html.escape(str(preview.get('title') or ''))} (1), (2), …\n\n"
+        "<b>Description:</b>\n"
+        f"<code>{html.escape(str(preview.get('description') or ''))}</code>\n\n"
+        f"<b>Hashtags ({int(preview.get('hashtags_total') or len(tags))}):</b> {html.escape(' '.join(tags))}"
+    )
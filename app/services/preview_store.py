@@ -0,0 +1,87 @@
+# app/services/preview_store.py
+from __future__ import annotations
+
+from typing import Any, Dict
+
+from app.config import settings
+from app.services.journal import Journal
+from app.services.user_state import (
+    DATA_DIR, NS_AUTOPOST, NS_CUSTOM, NS_PREVIEW, us_delete_many, us_items, us_set_many,
+)
+
+# Предпросмотры пишутся часто, читаются редко — храним их в append-only журнале,
+# а не в документах user_state: запись стоит O(запись), а не O(документ/файл).
+PREVIEW_JOURNAL = DATA_DIR / "previews.journal"
+previews = Journal(PREVIEW_JOURNAL)
+
+KIND_POST = "post"          # обычный постинг (publish)
+KIND_CUSTOM = "custom"      # кастомные посты (user_storage_custom)
+KIND_AUTOPOST = "autopost"  # автопост
+
+
+def _key(kind: str, user_id: int | str) -> str:
+    return f"{kind}:{user_id}"
+
+
+def _cap(value: Any) -> Any:
+    # больше, чем влезает в одно сообщение Telegram, хранить смысла нет
+    limit = settings.PREVIEW_MAX_CHARS
+    if isinstance(value, str) and len(value) > limit:
+        return value[:limit]
+    if isinstance(value, dict) and len(str(value.get("description") or "")) > limit:
+        return {**value, "description": str(value["description"])[:limit]}
+    return value
+
+
+async def put_preview(kind: str, user_id: int | str, value: Any) -> None:
+    await previews.aput(_key(kind, user_id), _cap(value))
+
+
+async def get_preview(kind: str, user_id: int | str) -> Any:
+    return await previews.aget(_key(kind, user_id))
+
+
+async def drop_preview(kind: str, user_id: int | str) -> None:
+    await previews.adelete(_key(kind, user_id))
+
+
+def sweep_previews(older_than: int) -> int:
+    """Удаляет предпросмотры, записанные раньше older_than. Возвращает их число."""
+    stale = [k for k, ts in previews.items() if ts < older_than]
+    for k in stale:
+        previews.delete(k)
+    return len(stale)
+
+
+def migrate_previews_from_state() -> int:
+    """
+    Однократный перенос предпросмотров из user_state в журнал
+    (выполняется, только пока файла журнала ещё нет). Перенесённые поля
+    из документов user_state убираются, пустые документы удаляются.
+    """
+    if PREVIEW_JOURNAL.exists():
+        return 0
+    n = 0
+    moved = []
+    for ns, field, kind in (
+        (NS_PREVIEW, "last_preview_text", KIND_POST),
+        (NS_CUSTOM, "last_preview_text", KIND_CUSTOM),
+        (NS_AUTOPOST, "last_preview", KIND_AUTOPOST),
+    ):
+        stripped: Dict[str, Dict[str, Any]] = {}
+        for user_key, doc in us_items(ns):
+            if field not in doc:
+                continue
+            val = doc.pop(field)
+            if val:
+                previews.put(_key(kind, user_key), _cap(val))
+                n += 1
+            stripped[user_key] = doc
+        moved.append((ns, stripped))
+    previews.open()  # создаёт журнал, даже если переносить нечего
+
+    # чистим user_state только после того, как всё легло в журнал
+    for ns, stripped in moved:
+        us_set_many({k: d for k, d in stripped.items() if d}, ns)
+        us_delete_many([k for k, d in stripped.items() if not d], ns)
+    return n
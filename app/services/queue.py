@@ -1,41 +1,426 @@
+# app/services/queue.py
+from __future__ import annotations
+
 import asyncio
-from aiolimiter import AsyncLimiter
+import json
+import logging
+import os
+import socket
+import time
+import uuid
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, Optional, Union
+
+from sqlalchemy import case, delete, func, select, update
+
+from app.config import settings
+from app.db import async_session
+from app.models import Job
+from app.services.db_writer import db_write
+from app.services.scheduler import PRIORITY_NORMAL, Candidate, DrrScheduler
+
+log = logging.getLogger(__name__)
+
+# Лимиты запросов — не здесь, а на API-ключ в клиентах провайдеров (app/services/rate_limits.py):
+# задача может ждать провайдера, но не чужую квоту. Одновременность — JOB_PROVIDER_CAPS.
 
-job_queue: asyncio.Queue = asyncio.Queue()
-lim_openai = AsyncLimiter(60, 60)       # 60 req/min
-lim_tensorart = AsyncLimiter(30, 60)
-lim_replicate = AsyncLimiter(30, 60)
+# Задачи живут в таблице jobs и переживают рестарт. Обработчик задачи — async-функция,
+# зарегистрированная под именем (kind); в БД пишется только имя и JSON с аргументами.
+JobFunc = Callable[..., Awaitable[Any]]
+_kinds: Dict[str, "_KindSpec"] = {}
+_names: Dict[JobFunc, str] = {}
+
+# объекты процесса, нужные обработчикам (bot и т.п.) — заполняет app/bot.py при старте
+job_context: Dict[str, Any] = {}
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
 
 _workers: list[asyncio.Task] = []
+_scaler: Optional[asyncio.Task] = None
+_busy = 0  # воркеров, выполняющих задачу прямо сейчас
+_waits: deque[tuple[float, float]] = deque(maxlen=1000)  # (monotonic, ожидание задачи до старта, с)
+_scheduler = DrrScheduler.from_settings()
+_wakeup = asyncio.Event()
+
+# задача готова к запуску с момента постановки/возврата в очередь или с run_after (ретрай с паузой)
+_ready_since = case((Job.run_after > Job.updated_at, Job.run_after), else_=Job.updated_at)
+
+
+@dataclass(frozen=True)
+class _KindSpec:
+    func: JobFunc
+    priority: int
+    user_arg: Optional[str]
+    cost: Union[float, Callable[[Dict[str, Any]], float]]
+
+
+def job_kind(
+    name: str,
+    *,
+    priority: int = PRIORITY_NORMAL,
+    user_arg: Optional[str] = "user_id",
+    cost: Union[float, Callable[[Dict[str, Any]], float]] = 1.0,
+) -> Callable[[JobFunc], JobFunc]:
+    """
+    Декоратор: регистрирует обработчик задач вида name.
+    priority — класс (PRIORITY_*), user_arg — kwarg с id пользователя для справедливой очереди,
+    cost — вес задачи в DRR (число или функция от kwargs, например по числу кадров).
+    """
+    def deco(func: JobFunc) -> JobFunc:
+        if name in _kinds and _kinds[name].func is not func:
+            raise ValueError(f"job kind {name!r} already registered")
+        _kinds[name] = _KindSpec(func, priority, user_arg, cost)
+        _names[func] = name
+        return func
+    return deco
+
+
+def _kind_of(func: str | JobFunc) -> str:
+    name = func if isinstance(func, str) else _names.get(func)
+    if not name or name not in _kinds:
+        raise ValueError(f"unknown job kind: {func!r} (register it with @job_kind)")
+    return name
+
+
+async def submit_job(provider: str, func: str | JobFunc, *args, **kwargs) -> int:
+    """
+    Ставит задачу в очередь. func — имя вида или зарегистрированная функция;
+    args/kwargs должны сериализоваться в JSON. Возвращает id задачи.
+    """
+    kind = _kind_of(func)
+    spec = _kinds[kind]
+    payload = json.dumps({"args": list(args), "kwargs": kwargs}, ensure_ascii=False, separators=(",", ":"))
+    now = time.time()
+    job = Job(
+        kind=kind, provider=provider or None, payload_json=payload, status="queued",
+        attempts=0, max_attempts=settings.JOB_MAX_ATTEMPTS, run_after=0.0,
+        user_id=kwargs.get(spec.user_arg) if spec.user_arg else None,
+        priority=spec.priority,
+        cost=float(spec.cost(kwargs) if callable(spec.cost) else spec.cost),
+        created_at=now, updated_at=now,
+    )
+
+    async def op(s) -> int:
+        s.add(job)
+        await s.flush()
+        return job.id
+
+    job_id = await db_write(op)
+    _wakeup.set()
+    return job_id
+
+
+# ---------- аренда ----------
+async def _claim() -> Optional[Job]:
+    """
+    Выбирает задачу планировщиком (классы приоритета, DRR по пользователям, лимиты
+    на пользователя/провайдера) и забирает её через UPDATE ... WHERE status='queued' —
+    кто первым обновил строку, тот и владелец (работает и между процессами).
+    """
+    now = time.time()
+
+    async def op(s) -> Optional[Job]:
+        running = Job.status == "running"
+        by_user = dict((await s.execute(
+            select(Job.user_id, func.count()).where(running).group_by(Job.user_id).execution_options(db_background=True)
+        )).all())
+        by_provider = dict((await s.execute(
+            select(Job.provider, func.count()).where(running).group_by(Job.provider).execution_options(db_background=True)
+        )).all())
+        by_provider = {k or "": v for k, v in by_provider.items()}
+        # головы очередей (пользователь, приоритет, провайдер): тяжёлый пользователь даёт одну строку, а не тысячу
+        heads = (await s.execute(
+            select(func.min(Job.id))
+            .where(Job.status == "queued", Job.run_after <= now)
+            .group_by(Job.user_id, Job.priority, Job.provider)
+            .execution_options(db_background=True)
+        )).scalars().all()
+        if not heads:
+            return None
+        rows = (await s.execute(
+            select(Job.id, Job.user_id, Job.provider, Job.priority, Job.cost, _ready_since.label("ready"))
+            .where(Job.id.in_(heads))
+            .execution_options(db_background=True)
+        )).all()
+        cands = [Candidate(r.id, r.user_id, r.provider, r.priority, r.cost or 1.0) for r in rows]
+        ready = {r.id: r.ready for r in rows}
+
+        while cands:
+            c = _scheduler.pick(cands, by_user, by_provider)
+            if c is None:
+                return None
+            res = await s.execute(
+                update(Job)
+                .where(Job.id == c.job_id, Job.status == "queued")
+                .values(
+                    status="running", leased_by=WORKER_ID, lease_expires_at=now + settings.JOB_LEASE_SECONDS,
+                    attempts=Job.attempts + 1, updated_at=now,
+                )
+                .execution_options(synchronize_session=False, db_background=True)
+            )
+            if res.rowcount == 1:
+                _waits.append((time.monotonic(), max(0.0, now - (ready[c.job_id] or now))))
+                return (await s.execute(select(Job).where(Job.id == c.job_id))).scalar_one()
+            _scheduler.refund(c)
+            cands.remove(c)
+        return None
+
+    return await db_write(op)
+
+
+async def _heartbeat(job_id: int, work: asyncio.Future, lost: asyncio.Event) -> None:
+    """
+    Продлевает аренду, пока задача выполняется. Аренду перехватили (истекла и задачу вернули
+    в очередь) или продлить не удаётся до её истечения — останавливаем задачу: её уже может
+    выполнять другой воркер, а для платных провайдеров второй прогон — это вторая оплата.
+    """
+    every = max(1.0, settings.JOB_LEASE_SECONDS / 3)
+    expires = time.time() + settings.JOB_LEASE_SECONDS
+    while True:
+        await asyncio.sleep(every)
+        now = time.time()
+
+        async def op(s) -> int:
+            res = await s.execute(
+                update(Job)
+                .where(Job.id == job_id, Job.status == "running", Job.leased_by == WORKER_ID)
+                .values(lease_expires_at=now + settings.JOB_LEASE_SECONDS, updated_at=now)
+                .execution_options(synchronize_session=False, db_background=True)
+            )
+            return res.rowcount
+
+        try:
+            renewed = await db_write(op)
+        except Exception:
+            log.exception("job %s: lease renewal failed", job_id)
+            if time.time() + every < expires:
+                continue  # аренда ещё действует — попробуем на следующем шаге
+            renewed = 0
+        if renewed:
+            expires = now + settings.JOB_LEASE_SECONDS
+            continue
+        log.warning("job %s: lease lost, stopping the job", job_id)
+        lost.set()
+        work.cancel()
+        return
+
+
+async def _finish(job_id: int, **values: Any) -> None:
+    values["updated_at"] = time.time()
+
+    async def op(s) -> None:
+        await s.execute(
+            update(Job)
+            .where(Job.id == job_id, Job.leased_by == WORKER_ID)
+            .values(leased_by=None, lease_expires_at=None, **values)
+            .execution_options(synchronize_session=False)
+        )
+
+    await db_write(op)
+    _wakeup.set()  # освободился слот пользователя/провайдера — пусть воркеры перепланируют
+
+
+async def requeue_expired_leases() -> int:
+    """Возвращает в очередь задачи, чей воркер пропал (аренда истекла); исчерпавшие попытки — failed."""
+    now = time.time()
+
+    async def op(s) -> int:
+        expired = (Job.status == "running") & (Job.lease_expires_at < now)
+        failed = await s.execute(
+            update(Job)
+            .where(expired, Job.attempts >= Job.max_attempts)
+            .values(status="failed", leased_by=None, lease_expires_at=None,
+                    last_error="lease expired", updated_at=now)
+            .execution_options(synchronize_session=False, db_background=True)
+        )
+        res = await s.execute(
+            update(Job)
+            .where(expired)
+            .values(status="queued", leased_by=None, lease_expires_at=None, updated_at=now)
+            .execution_options(synchronize_session=False, db_background=True)
+        )
+        return int(res.rowcount or 0) + int(failed.rowcount or 0)
+
+    n = await db_write(op)
+    if n:
+        log.info("requeued %d job(s) with expired leases", n)
+        _wakeup.set()
+    return n
+
+
+async def purge_finished_jobs(older_than_days: float) -> int:
+    """Удаляет done/failed задачи старше окна. Возвращает число строк."""
+    cutoff = time.time() - older_than_days * 86400
+
+    async def op(s) -> int:
+        res = await s.execute(
+            delete(Job).where(Job.status.in_(("done", "failed")), Job.updated_at < cutoff)
+        )
+        return int(res.rowcount or 0)
+
+    return await db_write(op)
+
+
+# ---------- воркеры ----------
+async def _run(job: Job) -> None:
+    spec = _kinds.get(job.kind)
+    if spec is None:
+        await _finish(job.id, status="failed", last_error=f"unknown job kind {job.kind!r}")
+        return
+    payload = json.loads(job.payload_json or "{}")
+    work = asyncio.ensure_future(spec.func(*payload.get("args", []), **payload.get("kwargs", {})))
+    lost = asyncio.Event()
+    hb = asyncio.create_task(_heartbeat(job.id, work, lost))
+    try:
+        await work
+    except asyncio.CancelledError:
+        if lost.is_set() and not asyncio.current_task().cancelling():
+            return  # задачу остановил _heartbeat: она уже не наша, в БД ничего не пишем
+        # остановка процесса — задачу вернём в очередь, попытка не считается
+        await _finish(job.id, status="queued", attempts=Job.attempts - 1)
+        raise
+    except Exception as e:
+        log.exception("job %s (%s) failed, attempt %d/%d", job.id, job.kind, job.attempts, job.max_attempts)
+        if job.attempts < job.max_attempts:
+            delay = settings.JOB_RETRY_BACKOFF * (2 ** (job.attempts - 1))
+            await _finish(job.id, status="queued", run_after=time.time() + delay, last_error=repr(e)[:2000])
+        else:
+            await _finish(job.id, status="failed", last_error=repr(e)[:2000])
+    else:
+        await _finish(job.id, status="done", last_error=None)
+    finally:
+        hb.cancel()
+
 
 async def worker():
+    global _busy
+    me = asyncio.current_task()
+    last_requeue = time.monotonic()
+    idle_since = time.monotonic()
     while True:
-        job = await job_queue.get()
+        if time.monotonic() - last_requeue >= settings.JOB_LEASE_SECONDS:
+            last_requeue = time.monotonic()
+            try:
+                await requeue_expired_leases()
+            except Exception:
+                log.exception("requeue of expired jobs failed")
         try:
-            provider = job.get("provider")
-            func = job["func"]
-            args = job.get("args", [])
-            kwargs = job.get("kwargs", {})
-            if provider == "openai":
-                async with lim_openai:
-                    await func(*args, **kwargs)
-            elif provider == "tensorart":
-                async with lim_tensorart:
-                    await func(*args, **kwargs)
-            elif provider == "replicate":
-                async with lim_replicate:
-                    await func(*args, **kwargs)
-            else:
-                await func(*args, **kwargs)
+            job = await _claim()
+        except Exception:
+            log.exception("job claim failed")
+            job = None
+        if job is None:
+            idle = time.monotonic() - idle_since
+            if idle >= settings.JOB_WORKER_IDLE_GRACE and len(_workers) > settings.JOB_WORKERS_MIN:
+                _workers.remove(me)
+                log.info("autoscale: worker retired after %.0fs idle, %d left", idle, len(_workers))
+                return
+            _wakeup.clear()
+            try:
+                await asyncio.wait_for(_wakeup.wait(), settings.JOB_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        _busy += 1
+        try:
+            await _run(job)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # _run сам ловит ошибки задачи; сюда попадает отказ БД в _finish — воркер должен жить дальше,
+            # а задача вернётся в очередь по истечении аренды
+            log.exception("job %s: worker error", job.id)
         finally:
-            job_queue.task_done()
+            _busy -= 1
+            idle_since = time.monotonic()
 
-def start_workers(n=3):
-    global _workers
-    if _workers:
-        return
+
+def _spawn(n: int) -> None:
     for _ in range(n):
         _workers.append(asyncio.create_task(worker()))
 
-async def submit_job(provider: str, func, *args, **kwargs):
-    await job_queue.put({"provider": provider, "func": func, "args": args, "kwargs": kwargs})
+
+def _reap() -> None:
+    """Убирает из пула завершившиеся воркеры (упавшие — с логом), чтобы автоскейлер их заменил."""
+    dead = [t for t in _workers if t.done()]
+    for t in dead:
+        _workers.remove(t)
+        exc = "cancelled" if t.cancelled() else t.exception()
+        log.error("autoscale: worker died (%s), %d left", exc, len(_workers))
+
+
+def _wait_p95(window: float) -> float:
+    """p95 ожидания задач, стартовавших за последние window секунд (в этом процессе)."""
+    cutoff = time.monotonic() - window
+    waits = sorted(w for t, w in _waits if t >= cutoff)
+    return waits[min(len(waits) - 1, int(len(waits) * 0.95))] if waits else 0.0
+
+
+async def _queue_depth() -> tuple[int, float]:
+    """(готовых к запуску задач, возраст самой старой из них в секундах) — по всей БД."""
+    now = time.time()
+    async with async_session() as s:
+        depth, oldest = (await s.execute(
+            select(func.count(), func.min(_ready_since))
+            .where(Job.status == "queued", Job.run_after <= now)
+            .execution_options(db_background=True)
+        )).one()
+    return int(depth or 0), max(0.0, now - oldest) if oldest else 0.0
+
+
+async def _autoscale() -> None:
+    """
+    Раз в JOB_SCALE_INTERVAL: если все воркеры заняты, а очередь не пуста и ожидание (p95 стартов
+    за последние секунды или возраст самой старой задачи) выше JOB_WAIT_SLO — добавляем воркеров,
+    не больше чем удваивая пул за шаг и не выше JOB_WORKERS_MAX. Если воркеры простаивают при
+    непустой очереди, задачи упёрлись в лимиты (пользователь/провайдер) — расти бессмысленно.
+    Уменьшение — сами воркеры, простоявшие JOB_WORKER_IDLE_GRACE (см. worker()).
+    """
+    window = max(30.0, settings.JOB_SCALE_INTERVAL * 10)
+    while True:
+        await asyncio.sleep(settings.JOB_SCALE_INTERVAL)
+        _reap()
+        try:
+            depth, oldest = await _queue_depth()
+        except Exception:
+            log.exception("autoscale: queue depth query failed")
+            depth, oldest = 0, 0.0  # до минимума пул восстанавливаем и без этих цифр
+        n, p95 = len(_workers), _wait_p95(window)
+        if n < settings.JOB_WORKERS_MIN:
+            add = settings.JOB_WORKERS_MIN - n
+            reason = "below minimum"
+        elif depth and _busy >= n and n < settings.JOB_WORKERS_MAX and max(p95, oldest) > settings.JOB_WAIT_SLO:
+            add = min(depth, n, settings.JOB_WORKERS_MAX - n)
+            reason = f"wait over SLO {settings.JOB_WAIT_SLO:.0f}s"
+        else:
+            continue
+        _spawn(add)
+        log.info(
+            "autoscale: %d -> %d workers (%s; depth=%d oldest=%.1fs p95=%.1fs busy=%d)",
+            n, len(_workers), reason, depth, oldest, p95, _busy,
+        )
+
+
+async def start_workers(n: Optional[int] = None):
+    """Стартует n воркеров (по умолчанию JOB_WORKERS_MIN) и автоскейлер до JOB_WORKERS_MAX."""
+    global _scaler
+    if _workers:
+        return
+    await requeue_expired_leases()  # задачи, брошенные прошлым запуском
+    _spawn(max(1, n if n is not None else settings.JOB_WORKERS_MIN))
+    _scaler = asyncio.create_task(_autoscale())  # и при MAX == MIN: заменяет упавших воркеров
+    log.info("job workers: %d started, autoscale up to %d", len(_workers), settings.JOB_WORKERS_MAX)
+
+
+async def stop_workers():
+    global _workers, _scaler
+    tasks = ([_scaler] if _scaler else []) + list(_workers)
+    _scaler, _workers = None, []
+    for t in tasks:
+        t.cancel()
+    for t in tasks:
+        try:
+            await t
+        except asyncio.CancelledError:
+            pass
@@ -0,0 +1,176 @@
+# app/services/rate_limits.py
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import logging
+import re
+import time
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional, Tuple
+
+import httpx
+from aiolimiter import AsyncLimiter
+
+from app.config import settings
+
+log = logging.getLogger(__name__)
+
+# Квоты провайдеров — на API-ключ, поэтому и лимитер — на (провайдер, отпечаток ключа):
+# один пользователь, выбравший свою квоту, не тормозит остальных. Сам ключ в реестре не хранится.
+
+_FALLBACK = (30.0, 60.0)
+
+
+def parse_limits(raw: str) -> Dict[str, Tuple[float, float]]:
+    """'openai=60/60,tensorart=30/60' -> {'openai': (60.0, 60.0), ...} (запросов / за секунд)."""
+    out: Dict[str, Tuple[float, float]] = {}
+    for part in (raw or "").split(","):
+        name, _, value = part.partition("=")
+        rate, _, period = value.partition("/")
+        if name.strip() and rate.strip():
+            out[name.strip()] = (float(rate), float(period or 60))
+    return out
+
+
+def fingerprint(api_key: str) -> str:
+    return hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()[:16]
+
+
+_DURATION = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+def _duration(raw: str) -> Optional[float]:
+    """Секунды из '12', '1.5', '6m0s', '20ms', '1h2m3s' (формат x-ratelimit-reset-* у OpenAI)."""
+    s = (raw or "").strip().lower()
+    try:
+        return float(s)
+    except ValueError:
+        pass
+    parts = _DURATION.findall(s)
+    if not parts or "".join(n + u for n, u in parts) != s:
+        return None
+    return sum(float(n) * _UNITS[u] for n, u in parts)
+
+
+def _retry_after(raw: str) -> Optional[float]:
+    """Retry-After: секунды или HTTP-дата."""
+    sec = _duration(raw)
+    if sec is not None:
+        return sec
+    try:
+        return parsedate_to_datetime(raw).timestamp() - time.time()
+    except (TypeError, ValueError):
+        return None
+
+
+def _header(headers: httpx.Headers, *names: str) -> Optional[str]:
+    for n in names:
+        v = headers.get(n)
+        if v:
+            return v.split(",")[0].strip()
+    return None
+
+
+class KeyLimiter:
+    """
+    Лимитер одного ключа: AsyncLimiter с базовой квотой из конфига плюс «заморозка» до момента,
+    который сообщил провайдер (Retry-After на 429/503, remaining=0 + reset). Лимит из заголовков
+    заменяет базовый на лету.
+    """
+
+    def __init__(self, provider: str, rate: float, period: float):
+        self.provider = provider
+        self.period = period
+        self._limiter = AsyncLimiter(rate, period)
+        self.blocked_until = 0.0  # monotonic
+        self.last_used = time.monotonic()
+
+    @property
+    def rate(self) -> float:
+        return self._limiter.max_rate
+
+    async def acquire(self) -> None:
+        while True:
+            wait = self.blocked_until - time.monotonic()
+            if wait <= 0:
+                break
+            await asyncio.sleep(wait)
+        await self._limiter.acquire()
+        self.last_used = time.monotonic()
+
+    async def __aenter__(self) -> "KeyLimiter":
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        return None
+
+    def _block(self, seconds: float, why: str) -> None:
+        seconds = min(max(seconds, 0.0), settings.RATE_LIMIT_MAX_BLOCK)
+        until = time.monotonic() + seconds
+        if until > self.blocked_until:
+            self.blocked_until = until
+            log.info("%s: key throttled for %.1fs (%s)", self.provider, seconds, why)
+
+    def observe(self, response: httpx.Response) -> None:
+        """Подстраивается под ответ провайдера (заголовки x-ratelimit-*/ratelimit-*/Retry-After)."""
+        h = response.headers
+        self.last_used = time.monotonic()
+        if response.status_code in (429, 503):
+            sec = _retry_after(h.get("retry-after") or "")
+            self._block(sec if sec is not None else settings.RATE_LIMIT_DEFAULT_BLOCK, f"HTTP {response.status_code}")
+
+        limit = _header(h, "x-ratelimit-limit-requests", "ratelimit-limit", "x-ratelimit-limit")
+        try:
+            limit_n = float(limit) if limit else 0.0
+        except ValueError:
+            limit_n = 0.0
+        if limit_n > 0 and limit_n != self._limiter.max_rate:
+            # периоды в заголовках не единообразны — окно оставляем из конфига
+            self._limiter = AsyncLimiter(limit_n, self.period)
+
+        remaining = _header(h, "x-ratelimit-remaining-requests", "ratelimit-remaining", "x-ratelimit-remaining")
+        if remaining is not None and remaining.strip() in ("0", "0.0"):
+            reset = _duration(_header(h, "x-ratelimit-reset-requests", "ratelimit-reset", "x-ratelimit-reset") or "")
+            if reset is not None:
+                # x-ratelimit-reset иногда — unix-время, а не интервал
+                if reset > 10**9:
+                    reset -= time.time()
+                self._block(reset, "remaining=0")
+
+    async def on_response(self, response: httpx.Response) -> None:
+        """Хук httpx (event_hooks={'response': [...]})."""
+        self.observe(response)
+
+
+_registry: "OrderedDict[Tuple[str, str], KeyLimiter]" = OrderedDict()
+_limits: Dict[str, Tuple[float, float]] = parse_limits(settings.RATE_LIMITS)
+
+
+def limiter_for(provider: str, api_key: str) -> KeyLimiter:
+    """Лимитер для (провайдер, ключ). Реестр — LRU; простаивающие дольше RATE_LIMITER_IDLE_SECONDS вытесняются."""
+    key = (provider, fingerprint(api_key))
+    lim = _registry.get(key)
+    if lim is not None:
+        _registry.move_to_end(key)
+        return lim
+    rate, period = _limits.get(provider, _FALLBACK)
+    lim = KeyLimiter(provider, rate, period)
+    _registry[key] = lim
+    _evict()
+    return lim
+
+
+def _evict() -> None:
+    now = time.monotonic()
+    idle = settings.RATE_LIMITER_IDLE_SECONDS
+    # с головы — самые давно запрошенные; простаивающий ключ под заморозкой (Retry-After) держим,
+    # пока она действует, — иначе новый лимитер сразу снова упрётся в 429
+    for key, lim in list(_registry.items()):
+        stale = now - lim.last_used > idle and lim.blocked_until <= now
+        if len(_registry) > settings.RATE_LIMITER_CACHE_SIZE or stale:
+            del _registry[key]
+
@@ -1,14 +1,18 @@
 import asyncio, httpx
 
+from app.services.rate_limits import limiter_for
+
 class ReplicateClient:
     def __init__(self, api_token: str):
         self.headers = {"Authorization": f"Token {api_token}", "Content-Type": "application/json"}
+        self._limiter = limiter_for("replicate", api_token)
 
     async def generate(self, model_version: str, prompt: str) -> str:
-        async with httpx.AsyncClient(timeout=30) as client:
-            r = await client.post("https://api.replicate.com/v1/predictions",
-                                  json={"version": model_version, "input": {"prompt": prompt}},
-                                  headers=self.headers)
+        async with httpx.AsyncClient(timeout=30, event_hooks={"response": [self._limiter.on_response]}) as client:
+            async with self._limiter:
+                r = await client.post("https://api.replicate.com/v1/predictions",
+                                      json={"version": model_version, "input": {"prompt": prompt}},
+                                      headers=self.headers)
             r.raise_for_status()
             pred = r.json()
             url = pred["urls"]["get"]
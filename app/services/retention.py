@@ -0,0 +1,93 @@
+# app/services/retention.py
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from typing import Any, Dict, Optional
+
+from app.config import settings
+from app.services.autopost_store import ap_sweep
+from app.services.fsm_storage import purge_expired_fsm
+from app.services.generation_archive import archive_old_generations
+from app.services.generations import purge_stale_drafts
+from app.services.io_pool import run_write
+from app.services.preview_store import previews, sweep_previews
+from app.services.queue import purge_finished_jobs
+from app.services.user_state import NS_SETTINGS, us_get_many, us_run_write, us_stale_keys, us_update
+
+log = logging.getLogger(__name__)
+
+# черновые поля настроек: нужны только до публикации, дальше — мусор
+DRAFT_SETTINGS_FIELDS = ("last_image_urls", "last_da_pack")
+_SCAN_CHUNK = 400  # ключей на us_get_many (по 2 параметра — в лимит SQLite)
+
+_sweeper: Optional[asyncio.Task] = None
+
+
+def sweep_settings_drafts(older_than: int) -> int:
+    """Убирает last_image_urls/last_da_pack из давно не менявшихся настроек."""
+    stripped = 0
+
+    def _strip(doc: Dict[str, Any]) -> None:
+        nonlocal stripped
+        popped = [doc.pop(f, None) for f in DRAFT_SETTINGS_FIELDS]
+        if any(v is not None for v in popped):
+            stripped += 1
+
+    keys = us_stale_keys(NS_SETTINGS, older_than)
+    for i in range(0, len(keys), _SCAN_CHUNK):
+        docs = us_get_many((NS_SETTINGS, k) for k in keys[i:i + _SCAN_CHUNK])
+        # пишем только документы с черновыми полями: иначе us_update освежает updated_at
+        # и каждый проход переписывает все старые настройки впустую
+        for (_, key), doc in docs.items():
+            if any(doc.get(f) is not None for f in DRAFT_SETTINGS_FIELDS):
+                us_update(key, _strip, NS_SETTINGS)
+    return stripped
+
+
+async def sweep_once(ttl_days: Optional[float] = None) -> Dict[str, int]:
+    """Один проход ретеншна: автопост-черновики, черновые поля настроек, предпросмотры, черновики и архив генераций, задачи, FSM."""
+    ttl = settings.DRAFT_TTL_DAYS if ttl_days is None else ttl_days
+    report: Dict[str, int] = {}
+    if ttl > 0:  # DRAFT_TTL_DAYS=0 — черновики не чистим
+        cutoff = int(time.time() - ttl * 86400)
+        report["autopost"] = await us_run_write(ap_sweep, cutoff)
+        report["settings"] = await us_run_write(sweep_settings_drafts, cutoff)
+        report["previews"] = await run_write(str(previews.path), sweep_previews, cutoff)
+    if settings.GEN_DRAFT_TTL_DAYS > 0:
+        report["generation_drafts"] = await purge_stale_drafts(settings.GEN_DRAFT_TTL_DAYS)
+    if settings.GEN_ARCHIVE_DAYS > 0:
+        report["generations_archived"] = await archive_old_generations()
+    if settings.JOB_KEEP_DAYS > 0:
+        report["jobs"] = await purge_finished_jobs(settings.JOB_KEEP_DAYS)
+    report["fsm"] = await purge_expired_fsm()  # у FSM свой TTL (FSM_TTL_SECONDS)
+    log.info("retention sweep (ttl=%sd): %s", ttl, report)
+    return report
+
+
+async def _sweep_loop(interval: float) -> None:
+    while True:
+        try:
+            await sweep_once()
+        except Exception:
+            log.exception("retention sweep failed")
+        await asyncio.sleep(interval)
+
+
+def start_retention_sweeper(interval: Optional[float] = None) -> None:
+    global _sweeper
+    if _sweeper and not _sweeper.done():
+        return
+    _sweeper = asyncio.create_task(_sweep_loop(interval or settings.RETENTION_SWEEP_INTERVAL))
+
+
+async def stop_retention_sweeper() -> None:
+    global _sweeper
+    if _sweeper:
+        _sweeper.cancel()
+        try:
+            await _sweeper
+        except asyncio.CancelledError:
+            pass
+        _sweeper = None
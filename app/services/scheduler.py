@@ -0,0 +1,117 @@
+# app/services/scheduler.py
+from __future__ import annotations
+
+from collections import deque
+from dataclasses import dataclass
+from typing import Deque, Dict, Hashable, Iterable, Mapping, Optional
+
+from app.config import settings
+
+# Классы приоритета задач: меньше — раньше. Строгий порядок между классами,
+# внутри класса — deficit round-robin по пользователям.
+PRIORITY_INTERACTIVE = 0   # короткие текстовые задачи, пользователь ждёт ответа
+PRIORITY_NORMAL = 10       # генерация изображений
+PRIORITY_BULK = 20         # пакетная публикация и прочее фоновое
+
+
+@dataclass(frozen=True)
+class Candidate:
+    """Готовая к запуску задача — голова очереди (user, priority, provider)."""
+    job_id: int
+    user: Hashable
+    provider: Optional[str]
+    priority: int
+    cost: float = 1.0
+
+
+def parse_caps(raw: str) -> Dict[str, int]:
+    """'tensorart=4,openai=8' -> {'tensorart': 4, 'openai': 8}."""
+    caps: Dict[str, int] = {}
+    for part in (raw or "").split(","):
+        name, _, value = part.partition("=")
+        if name.strip() and value.strip():
+            caps[name.strip()] = int(value)
+    return caps
+
+
+class DrrScheduler:
+    """
+    Deficit round-robin по пользователям. Каждый пользователь в кольце при проходе получает
+    quantum·weight «кредита» и запускает свою самую старую задачу, когда кредит покрывает её cost.
+    Пользователь, упёршийся в max_per_user, или задача провайдера, упёршегося в свой лимит,
+    пропускаются без начисления. Состояние — в памяти процесса; счётчики запущенных задач
+    передаются снаружи (из БД — общие для всех процессов).
+    """
+
+    def __init__(
+        self,
+        *,
+        quantum: float = 1.0,
+        max_per_user: int = 0,
+        provider_caps: Optional[Mapping[str, int]] = None,
+        weights: Optional[Mapping[Hashable, float]] = None,
+    ):
+        self.quantum = quantum if quantum > 0 else 1.0
+        self.max_per_user = max_per_user
+        self.provider_caps = dict(provider_caps or {})
+        self.weights = dict(weights or {})
+        self._deficit: Dict[Hashable, float] = {}
+        self._ring: Deque[Hashable] = deque()
+
+    @classmethod
+    def from_settings(cls) -> "DrrScheduler":
+        return cls(
+            quantum=settings.JOB_DRR_QUANTUM,
+            max_per_user=settings.JOB_MAX_PER_USER,
+            provider_caps=parse_caps(settings.JOB_PROVIDER_CAPS),
+        )
+
+    def _allowed(self, c: Candidate, by_user: Mapping[Hashable, int], by_provider: Mapping[str, int]) -> bool:
+        if self.max_per_user and by_user.get(c.user, 0) >= self.max_per_user:
+            return False
+        cap = self.provider_caps.get(c.provider or "")
+        return not cap or by_provider.get(c.provider or "", 0) < cap
+
+    def pick(
+        self,
+        candidates: Iterable[Candidate],
+        running_by_user: Mapping[Hashable, int],
+        running_by_provider: Mapping[str, int],
+    ) -> Optional[Candidate]:
+        cands = list(candidates)
+        queued_users = {c.user for c in cands}
+        eligible = [c for c in cands if self._allowed(c, running_by_user, running_by_provider)]
+        if not eligible:
+            return None
+        top = min(c.priority for c in eligible)
+        heads: Dict[Hashable, Candidate] = {}
+        for c in sorted(eligible, key=lambda c: c.job_id):
+            if c.priority == top:
+                heads.setdefault(c.user, c)
+
+        # кольцо: новые пользователи — в конец, без очереди — вон (их кредит сгорает, как в DRR)
+        for u in list(self._ring):
+            if u not in queued_users:
+                self._ring.remove(u)
+                self._deficit.pop(u, None)
+        for u in heads:
+            if u not in self._deficit:
+                self._deficit[u] = 0.0
+                self._ring.append(u)
+
+        while True:
+            u = self._ring[0]
+            head = heads.get(u)
+            if head is None:  # ждёт (лимит/другой класс) — пропускаем без начисления
+                self._ring.rotate(-1)
+                continue
+            if self._deficit[u] >= head.cost:
+                self._deficit[u] -= head.cost
+                return head
+            self._deficit[u] += self.quantum * max(self.weights.get(u, 1.0), 0.01)
+            self._ring.rotate(-1)
+
+    def refund(self, c: Candidate) -> None:
+        """Задачу выбрали, но забрать не удалось (перехватил другой процесс) — возвращаем кредит."""
+        if c.user in self._deficit:
+            self._deficit[c.user] += c.cost
@@ -0,0 +1,172 @@
+# app/services/sqlite_maintenance.py
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Any, Dict, Optional
+
+from app.config import settings
+from app.db import engine, idle_seconds
+from app.services.io_pool import run_io
+
+log = logging.getLogger(__name__)
+
+# Обслуживание общего data.db (бот + FastAPI):
+#  - PRAGMA optimize раз в SQLITE_OPTIMIZE_INTERVAL;
+#  - wal_checkpoint(TRUNCATE), когда процесс DB_IDLE_SECONDS не ходил в БД и WAL не пуст —
+#    короткий WAL = меньше страниц, которые читателям приходится искать в журнале.
+# Итоги последнего checkpoint/optimize бот пишет в <db>.maint.json рядом с БД: /stats/db
+# отдаёт FastAPI-процесс, а обслуживание делает бот.
+_task: Optional[asyncio.Task] = None
+_last_checkpoint: Dict[str, Any] = {}
+_last_optimize: float = 0.0
+
+
+def _is_sqlite() -> bool:
+    return engine.dialect.name == "sqlite"
+
+
+def _wal_path() -> Optional[str]:
+    db = engine.url.database
+    if not db or db == ":memory:":
+        return None
+    return os.path.abspath(db) + "-wal"
+
+
+def _state_path() -> Optional[str]:
+    db = engine.url.database
+    if not db or db == ":memory:":
+        return None
+    return os.path.abspath(db) + ".maint.json"
+
+
+def _save_state() -> None:
+    path = _state_path()
+    if not path:
+        return
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"last_checkpoint": _last_checkpoint or None, "last_optimize": _last_optimize or None}, f)
+    os.replace(tmp, path)
+
+
+def _load_state() -> Dict[str, Any]:
+    path = _state_path()
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (TypeError, OSError, ValueError):
+        return {}
+
+
+def _wal_bytes() -> int:
+    path = _wal_path()
+    try:
+        return os.path.getsize(path) if path else 0
+    except OSError:
+        return 0
+
+
+async def checkpoint(mode: str = "TRUNCATE") -> Dict[str, Any]:
+    """
+    PRAGMA wal_checkpoint(mode). busy=1 — не дождались читателей/писателей,
+    log — кадров в WAL, checkpointed — из них перенесено в БД.
+    """
+    t0 = time.perf_counter()
+    async with engine.connect() as conn:
+        row = (await conn.exec_driver_sql(f"PRAGMA wal_checkpoint({mode})")).fetchone()
+    busy, log_frames, done = (int(x) for x in row) if row else (0, 0, 0)
+    _last_checkpoint.update(
+        mode=mode, busy=busy, log_frames=log_frames, checkpointed=done,
+        at=time.time(), ms=round((time.perf_counter() - t0) * 1000, 2),
+    )
+    await run_io(_save_state)
+    return dict(_last_checkpoint)
+
+
+async def optimize() -> None:
+    global _last_optimize
+    async with engine.connect() as conn:
+        await conn.exec_driver_sql("PRAGMA optimize")
+    _last_optimize = time.time()
+    await run_io(_save_state)
+
+
+async def wal_stats() -> Dict[str, Any]:
+    """
+    Размер WAL и отставание чекпоинта. Отставание меряется на запросе: wal_checkpoint(PASSIVE)
+    (не ждёт ни читателей, ни писателей) возвращает кадры в WAL и сколько из них уже в БД.
+    Последний checkpoint(TRUNCATE)/optimize — из <db>.maint.json, его пишет бот.
+    """
+    if not _is_sqlite():
+        return {"sqlite": False}
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(db_background=True)
+        row = (await conn.exec_driver_sql("PRAGMA wal_checkpoint(PASSIVE)")).fetchone()
+    busy, log_frames, done = (int(x) for x in row) if row else (0, 0, 0)
+    shared = await run_io(_load_state)
+    cp = dict(_last_checkpoint) or shared.get("last_checkpoint") or {}
+    opt = _last_optimize or shared.get("last_optimize") or 0.0
+    now = time.time()
+    return {
+        "sqlite": True,
+        "wal_bytes": _wal_bytes(),
+        "idle_s": round(idle_seconds(), 1),
+        # кадры WAL, которые сейчас не перенести в БД (их держат читатели); -1 — не WAL
+        "checkpoint_lag_frames": log_frames - done if log_frames >= 0 else None,
+        "wal_frames": log_frames,
+        "checkpoint_busy": busy,
+        "last_checkpoint": cp or None,
+        "checkpoint_age_s": round(now - cp["at"], 1) if cp else None,
+        "optimize_age_s": round(now - opt, 1) if opt else None,
+    }
+
+
+async def maintain_once() -> Dict[str, Any]:
+    """Один проход: optimize по расписанию, checkpoint(TRUNCATE) в простое."""
+    report: Dict[str, Any] = {}
+    if settings.SQLITE_OPTIMIZE_INTERVAL > 0 and time.time() - _last_optimize >= settings.SQLITE_OPTIMIZE_INTERVAL:
+        await optimize()
+        report["optimize"] = True
+    if idle_seconds() >= settings.DB_IDLE_SECONDS and _wal_bytes() > 0:
+        cp = await checkpoint("TRUNCATE")
+        report["checkpoint"] = cp
+        if cp["busy"]:
+            log.info("WAL checkpoint busy: %d/%d frames", cp["checkpointed"], cp["log_frames"])
+    return report
+
+
+async def _loop(interval: float) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await maintain_once()
+        except Exception:
+            log.exception("sqlite maintenance failed")
+
+
+def start_sqlite_maintenance(interval: Optional[float] = None) -> None:
+    global _task
+    if not _is_sqlite() or (_task and not _task.done()):
+        return
+    _task = asyncio.create_task(_loop(interval or settings.DB_MAINTENANCE_INTERVAL))
+
+
+async def stop_sqlite_maintenance() -> None:
+    global _task
+    if _task:
+        _task.cancel()
+        try:
+            await _task
+        except asyncio.CancelledError:
+            pass
+        _task = None
+    if _is_sqlite():
+        # при остановке — последний optimize (рекомендация SQLite для долгоживущих соединений)
+        try:
+            await optimize()
+        except Exception:
+            log.exception("PRAGMA optimize on shutdown failed")
@@ -8,6 +8,8 @@ from typing import Any, Dict, Iterable, List, Optional, Tuple
 import logging
 import httpx
 
+from app.services.rate_limits import limiter_for
+
 logger = logging.getLogger(__name__)
 
 class TensorArtError(RuntimeError):
@@ -48,9 +50,12 @@ class TensorArtClient:
         self.base_url = (region_url or "https://ap-east-1.tensorart.cloud").rstrip("/")
         self.api_key = api_key
         self.app_id = app_id
+        # квота Tensor.Art — на ключ: лимитер общий для всех клиентов с этим ключом
+        self._limiter = limiter_for("tensorart", api_key)
         self._client = httpx.AsyncClient(
             base_url=self.base_url,
             timeout=timeout,
+            event_hooks={"response": [self._limiter.on_response]},
         )
 
     async def aclose(self) -> None:
@@ -202,7 +207,8 @@ class TensorArtClient:
 
         # Живые кандидаты на создание
         paths = ("/v1/jobs",)
-        data = await self._post_candidates(paths, payload)
+        async with self._limiter:  # опросы статуса не лимитируем — квота на создание заданий
+            data = await self._post_candidates(paths, payload)
 
         # Нормализуем возможные ответы и извлекаем job_id
         job_id = (
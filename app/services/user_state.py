@@ -0,0 +1,386 @@
+# app/services/user_state.py
+from __future__ import annotations
+
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+
+from app.services.io_pool import run_io, run_write
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+DATA_DIR = BASE_DIR / "data"
+DATA_DIR.mkdir(parents=True, exist_ok=True)
+STATE_DB = DATA_DIR / "user_state.db"
+
+# Namespaces: один документ на (ns, юзер)
+NS_SETTINGS = "settings"    # общие настройки, active_gen_id, last_image_urls, last_da_pack
+NS_CUSTOM = "custom"        # кастомные посты (галереи, предпросмотр)
+NS_PREVIEW = "preview"      # предпросмотр обычного постинга
+NS_AUTOPOST = "autopost"    # черновик автопоста
+NS_GALLERY = "gallery"      # выбранные галереи DeviantArt
+
+# Старые JSON-файлы, которые раньше переписывались целиком на каждый клик
+LEGACY_JSON: Dict[str, Path] = {
+    NS_SETTINGS: BASE_DIR / "user_settings.json",
+    NS_CUSTOM: BASE_DIR / "user_settings_custom.json",
+    NS_PREVIEW: DATA_DIR / "post_preview.json",
+    NS_AUTOPOST: DATA_DIR / "autopost_store.json",
+    NS_GALLERY: DATA_DIR / "gallery_prefs.json",
+}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_state (
+    ns         TEXT    NOT NULL,
+    user_key   TEXT    NOT NULL,
+    doc        TEXT    NOT NULL,
+    updated_at INTEGER NOT NULL,
+    PRIMARY KEY (ns, user_key)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS user_state_meta (
+    key   TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+def _dumps(obj: Dict[str, Any]) -> str:
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+
+def _loads(raw: Optional[str]) -> Dict[str, Any]:
+    if not raw:
+        return {}
+    try:
+        obj = json.loads(raw)
+    except Exception:
+        return {}
+    return obj if isinstance(obj, dict) else {}
+
+
+class UserStateStore:
+    """
+    Пер-юзерные JSON-документы в SQLite.
+    Одна запись = (namespace, user_key); patch трогает только строку этого юзера
+    и выполняется в BEGIN IMMEDIATE, поэтому конкурентные хэндлеры не затирают друг друга.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(
+                str(self.path),
+                timeout=30,
+                isolation_level=None,  # транзакции открываем сами
+                check_same_thread=False,
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=5000")
+            conn.executescript(_SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    # ---------- чтение ----------
+    def get(self, user_key: int | str, ns: str = NS_SETTINGS) -> Dict[str, Any]:
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT doc FROM user_state WHERE ns = ? AND user_key = ?",
+                (ns, str(user_key)),
+            ).fetchone()
+        return _loads(row[0]) if row else {}
+
+    def get_many(self, keys: Iterable[Tuple[str, int | str]]) -> Dict[Tuple[str, str], Dict[str, Any]]:
+        """
+        Несколько документов одним запросом: [(ns, user_key), ...] -> {(ns, "user_key"): doc}.
+        Отсутствующие записи возвращаются как {}.
+        """
+        pairs = [(ns, str(k)) for ns, k in keys]
+        out: Dict[Tuple[str, str], Dict[str, Any]] = {p: {} for p in pairs}
+        if not pairs:
+            return out
+        where = " OR ".join(["(ns = ? AND user_key = ?)"] * len(pairs))
+        params = [x for p in pairs for x in p]
+        with self._lock:
+            rows = self._connect().execute(
+                f"SELECT ns, user_key, doc FROM user_state WHERE {where}", params
+            ).fetchall()
+        for ns, key, raw in rows:
+            out[(ns, key)] = _loads(raw)
+        return out
+
+    def items(self, ns: str) -> list[Tuple[str, Dict[str, Any]]]:
+        """Все документы namespace (для миграций и обслуживающих задач)."""
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT user_key, doc FROM user_state WHERE ns = ?", (ns,)
+            ).fetchall()
+        return [(k, _loads(raw)) for k, raw in rows]
+
+    def stale_keys(self, ns: str, older_than: int) -> list[str]:
+        """Ключи namespace, которые не менялись с момента older_than (unix time)."""
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT user_key FROM user_state WHERE ns = ? AND updated_at < ?",
+                (ns, int(older_than)),
+            ).fetchall()
+        return [r[0] for r in rows]
+
+    # ---------- запись ----------
+    def update(
+        self,
+        user_key: int | str,
+        fn: Callable[[Dict[str, Any]], Optional[Dict[str, Any]]],
+        ns: str = NS_SETTINGS,
+    ) -> Dict[str, Any]:
+        """
+        Транзакционный read-modify-write одной записи.
+        fn получает текущий документ (или {}), может изменить его на месте или вернуть новый.
+        """
+        key = str(user_key)
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(
+                    "SELECT doc FROM user_state WHERE ns = ? AND user_key = ?",
+                    (ns, key),
+                ).fetchone()
+                doc = _loads(row[0]) if row else {}
+                res = fn(doc)
+                if res is not None:
+                    doc = res
+                conn.execute(
+                    "INSERT INTO user_state (ns, user_key, doc, updated_at) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (ns, user_key) DO UPDATE SET doc = excluded.doc, updated_at = excluded.updated_at",
+                    (ns, key, _dumps(doc), int(time.time())),
+                )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return doc
+
+    def patch(self, user_key: int | str, patch: Dict[str, Any], ns: str = NS_SETTINGS) -> Dict[str, Any]:
+        """Слияние верхнего уровня: как dict.update, но только для одного юзера."""
+        return self.update(user_key, lambda doc: doc.update(patch), ns)
+
+    def set(self, user_key: int | str, doc: Dict[str, Any], ns: str = NS_SETTINGS) -> None:
+        with self._lock:
+            self._connect().execute(
+                "INSERT INTO user_state (ns, user_key, doc, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (ns, user_key) DO UPDATE SET doc = excluded.doc, updated_at = excluded.updated_at",
+                (ns, str(user_key), _dumps(dict(doc or {})), int(time.time())),
+            )
+
+    def set_many(self, docs: Dict[int | str, Dict[str, Any]], ns: str) -> None:
+        """Запись нескольких документов одного namespace одной транзакцией."""
+        if not docs:
+            return
+        now = int(time.time())
+        rows = [(ns, str(k), _dumps(dict(v or {})), now) for k, v in docs.items()]
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.executemany(
+                    "INSERT INTO user_state (ns, user_key, doc, updated_at) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (ns, user_key) DO UPDATE SET doc = excluded.doc, updated_at = excluded.updated_at",
+                    rows,
+                )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+    def delete(self, user_key: int | str, ns: str = NS_SETTINGS) -> None:
+        with self._lock:
+            self._connect().execute(
+                "DELETE FROM user_state WHERE ns = ? AND user_key = ?",
+                (ns, str(user_key)),
+            )
+
+    def delete_many(self, user_keys: Iterable[int | str], ns: str) -> int:
+        keys = [(ns, str(k)) for k in user_keys]
+        if not keys:
+            return 0
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                cur = conn.executemany("DELETE FROM user_state WHERE ns = ? AND user_key = ?", keys)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return max(cur.rowcount, 0)
+
+    # ---------- отметки однократных шагов ----------
+    def meta_get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._connect().execute("SELECT value FROM user_state_meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def meta_set(self, key: str, value: str) -> None:
+        with self._lock:
+            self._connect().execute(
+                "INSERT OR REPLACE INTO user_state_meta (key, value) VALUES (?, ?)", (key, value),
+            )
+
+    # ---------- импорт старых JSON ----------
+    def import_json(self, path: Path, ns: str = NS_SETTINGS, *, force: bool = False) -> int:
+        """
+        Однократный импорт файла вида {"<user_key>": {...}} в namespace.
+        Уже существующие записи не перезаписываются. Возвращает число импортированных юзеров.
+        """
+        path = Path(path)
+        marker = f"imported:{ns}:{path.name}"
+        with self._lock:
+            conn = self._connect()
+            if not force and conn.execute(
+                "SELECT 1 FROM user_state_meta WHERE key = ?", (marker,)
+            ).fetchone():
+                return 0
+
+            data: Dict[str, Any] = {}
+            if path.exists():
+                try:
+                    data = json.loads(path.read_text(encoding="utf-8") or "{}")
+                except Exception:
+                    data = {}
+
+            now = int(time.time())
+            rows = [
+                (ns, str(k), _dumps(v), now)
+                for k, v in (data.items() if isinstance(data, dict) else [])
+                if isinstance(v, dict)
+            ]
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                cur = conn.executemany(
+                    "INSERT INTO user_state (ns, user_key, doc, updated_at) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (ns, user_key) DO NOTHING",
+                    rows,
+                )
+                conn.execute(
+                    "INSERT OR REPLACE INTO user_state_meta (key, value) VALUES (?, ?)",
+                    (marker, str(now)),
+                )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            return max(cur.rowcount, 0)
+
+
+_store = UserStateStore(STATE_DB)
+
+
+def us_get(user_key: int | str, ns: str = NS_SETTINGS) -> Dict[str, Any]:
+    return _store.get(user_key, ns)
+
+
+def us_patch(user_key: int | str, patch: Dict[str, Any], ns: str = NS_SETTINGS) -> Dict[str, Any]:
+    return _store.patch(user_key, patch, ns)
+
+
+def us_update(
+    user_key: int | str,
+    fn: Callable[[Dict[str, Any]], Optional[Dict[str, Any]]],
+    ns: str = NS_SETTINGS,
+) -> Dict[str, Any]:
+    return _store.update(user_key, fn, ns)
+
+
+def us_get_many(keys: Iterable[Tuple[str, int | str]]) -> Dict[Tuple[str, str], Dict[str, Any]]:
+    return _store.get_many(keys)
+
+
+def us_items(ns: str) -> list[Tuple[str, Dict[str, Any]]]:
+    return _store.items(ns)
+
+
+def us_stale_keys(ns: str, older_than: int) -> list[str]:
+    return _store.stale_keys(ns, older_than)
+
+
+def us_set(user_key: int | str, doc: Dict[str, Any], ns: str = NS_SETTINGS) -> None:
+    _store.set(user_key, doc, ns)
+
+
+def us_set_many(docs: Dict[int | str, Dict[str, Any]], ns: str) -> None:
+    _store.set_many(docs, ns)
+
+
+def us_delete(user_key: int | str, ns: str = NS_SETTINGS) -> None:
+    _store.delete(user_key, ns)
+
+
+def us_delete_many(user_keys: Iterable[int | str], ns: str) -> int:
+    return _store.delete_many(user_keys, ns)
+
+
+def us_meta_get(key: str) -> Optional[str]:
+    return _store.meta_get(key)
+
+
+def us_meta_set(key: str, value: str) -> None:
+    _store.meta_set(key, value)
+
+
+# ---------- async-фасад: всё I/O хранилища — в пуле потоков, записи — по очереди ----------
+async def us_run(fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+    """Чтение (или любая синхронная функция поверх хранилища) вне event loop."""
+    return await run_io(fn, *args, **kwargs)
+
+
+async def us_run_write(fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+    """Запись вне event loop; записи в user_state.db сериализуются."""
+    return await run_write(str(_store.path), fn, *args, **kwargs)
+
+
+async def us_aget(user_key: int | str, ns: str = NS_SETTINGS) -> Dict[str, Any]:
+    return await us_run(_store.get, user_key, ns)
+
+
+async def us_aget_many(keys: Iterable[Tuple[str, int | str]]) -> Dict[Tuple[str, str], Dict[str, Any]]:
+    return await us_run(_store.get_many, list(keys))
+
+
+async def us_apatch(user_key: int | str, patch: Dict[str, Any], ns: str = NS_SETTINGS) -> Dict[str, Any]:
+    return await us_run_write(_store.patch, user_key, patch, ns)
+
+
+async def us_aupdate(
+    user_key: int | str,
+    fn: Callable[[Dict[str, Any]], Optional[Dict[str, Any]]],
+    ns: str = NS_SETTINGS,
+) -> Dict[str, Any]:
+    return await us_run_write(_store.update, user_key, fn, ns)
+
+
+async def us_aset(user_key: int | str, doc: Dict[str, Any], ns: str = NS_SETTINGS) -> None:
+    await us_run_write(_store.set, user_key, doc, ns)
+
+
+def migrate_legacy_json() -> Dict[str, int]:
+    """Импорт всех старых JSON-хранилищ (каждое — один раз; повторные вызовы — no-op)."""
+    return {ns: _store.import_json(path, ns) for ns, path in LEGACY_JSON.items()}
+
+
+if __name__ == "__main__":
+    # python -m app.services.user_state — ручной запуск импорта
+    for ns, n in migrate_legacy_json().items():
+        print(f"{ns}: imported {n} users")
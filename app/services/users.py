@@ -0,0 +1,56 @@
+# app/services/users.py
+from __future__ import annotations
+
+from collections import OrderedDict
+from typing import Optional
+
+from sqlalchemy import select
+
+from app.config import settings
+from app.db import async_session, dialect_insert
+from app.models import User
+from app.services.db_writer import db_write
+
+# tg_id -> User (отсоединённый от сессии; expire_on_commit=False, так что поля доступны)
+_cache: "OrderedDict[int, User]" = OrderedDict()
+
+
+def _remember(u: User) -> User:
+    _cache[u.tg_id] = u
+    _cache.move_to_end(u.tg_id)
+    while len(_cache) > settings.USER_CACHE_SIZE:
+        _cache.popitem(last=False)
+    return u
+
+
+async def resolve_user(tg_id: int, username: Optional[str] = None) -> User:
+    """
+    User по tg_id: из LRU-кэша, иначе SELECT, иначе создание одним
+    INSERT ... ON CONFLICT (tg_id) DO NOTHING RETURNING (гонка двух апдейтов безопасна).
+    """
+    u = _cache.get(tg_id)
+    if u is not None:
+        _cache.move_to_end(tg_id)
+        return u
+
+    async with async_session() as s:
+        u = (await s.execute(select(User).where(User.tg_id == tg_id))).scalar_one_or_none()
+    if u is None:
+        async def op(s) -> User:
+            stmt = (
+                dialect_insert(User)
+                .values(tg_id=tg_id, username=username)
+                .on_conflict_do_nothing(index_elements=[User.tg_id])
+                .returning(User)
+            )
+            u = (await s.execute(stmt)).scalar_one_or_none()
+            if u is None:  # успел создать параллельный апдейт
+                u = (await s.execute(select(User).where(User.tg_id == tg_id))).scalar_one()
+            return u
+
+        u = await db_write(op)
+    return _remember(u)
+
+
+def forget_user(tg_id: int) -> None:
+    _cache.pop(tg_id, None)
@@ -1,42 +1,28 @@
 from __future__ import annotations
-import json
-from pathlib import Path
 from typing import Any, Dict
 
-CUSTOM_JSON = Path(__file__).resolve().parent / "user_settings_custom.json"
+from app.services.preview_render import render_preview
+from app.services.preview_store import KIND_CUSTOM, get_preview, put_preview
+from app.services.user_state import NS_CUSTOM, us_get, us_set
 
 def read_custom_data(user_id: int) -> Dict[str, Any]:
-    """Чтение данных кастомных постов из user_settings_custom.json"""
-    if not CUSTOM_JSON.exists():
-        return {}
+    """Чтение данных кастомных постов из user_state (namespace «custom»)"""
     try:
-        data = json.loads(CUSTOM_JSON.read_text(encoding="utf-8") or "{}")
-        return data.get(str(user_id), {}) or {}
+        return us_get(user_id, NS_CUSTOM)
     except Exception:
         return {}
 ...
 
 def save_custom_data(user_id: int, obj: Dict[str, Any]) -> None:
-    """Сохранение данных кастомных постов в user_settings_custom.json"""
-    data: Dict[str, Any] = {}
-    if CUSTOM_JSON.exists():
-        try:
-            data = json.loads(CUSTOM_JSON.read_text(encoding="utf-8") or "{}")
-        except Exception:
-            data = {}
-    data[str(user_id)] = obj
-    CUSTOM_JSON.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+    """Сохранение данных кастомных постов в user_state (namespace «custom»)"""
+    us_set(user_id, obj, NS_CUSTOM)
 
-def save_custom_preview(user_id: int, preview_text: str) -> None:
-    """Сохраняет последний предпросмотр кастомного поста"""
-    obj = read_custom_data(user_id)
-    obj["last_preview_text"] = preview_text
-    save_custom_data(user_id, obj)
+async def save_custom_preview(user_id: int, preview: Dict[str, Any]) -> None:
+    """Сохраняет последний предпросмотр кастомного поста (поля preview_fields, журнал предпросмотров)"""
+    await put_preview(KIND_CUSTOM, user_id, preview)
 
-def read_custom_preview(user_id: int) -> str:
+async def read_custom_preview(user_id: int) -> str:
     """
-    Возвращает последний сохранённый предпросмотр для кастомных постов
-    из user_settings_custom.json (ключ last_preview_text).
+    Возвращает последний сохранённый предпросмотр для кастомных постов.
     """
-    data = read_custom_data(user_id)
-    return str(data.get("last_preview_text", "❌ Предпросмотр не найден."))
+    return render_preview(await get_preview(KIND_CUSTOM, user_id)) or "❌ Предпросмотр не найден."
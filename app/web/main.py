@@ -7,9 +7,13 @@ import httpx
 from sqlalchemy import select
 
 from app.config import settings
-from app.db import async_session, init_db
-from app.models import User, ApiCredentials
+from app.db import init_db
+from app.models import ApiCredentials
 from app.crypto import fernet_encrypt
+from app.services.credentials import invalidate_creds
+from app.services.db_writer import db_write, start_db_writer, stop_db_writer, writer_stats
+from app.services.sqlite_maintenance import wal_stats
+from app.services.users import resolve_user
 
 # (опционально) если у тебя есть свой кодировщик/декодер state
 try:
@@ -38,11 +42,21 @@ def error_html(msg: str) -> str:
 async def _startup():
     # гарантируем, что таблицы созданы
     await init_db()
+    start_db_writer()
+
+@app.on_event("shutdown")
+async def _shutdown():
+    await stop_db_writer()
 
 @app.get("/healthz")
 async def healthz():
     return {"ok": True}
 
+@app.get("/stats/db")
+async def stats_db():
+    # размер WAL общего data.db (чекпоинты делает процесс бота) + счётчики записи этого процесса
+    return {**await wal_stats(), "writer": writer_stats()}
+
 @app.get("/oauth/deviantart/callback")
 async def deviantart_callback(
     code: str | None = Query(None),
@@ -101,19 +115,13 @@ async def deviantart_callback(
         return HTMLResponse(error_html(f"no access_token in response: {payload}"), status_code=400)
 
     # 4) найдём или создадим пользователя по tg_id
-    async with async_session() as s:
-        r = await s.execute(select(User).where(User.tg_id == tg_id))
-        user = r.scalar_one_or_none()
-        if not user:
-            user = User(tg_id=tg_id, username=None)
-            s.add(user)
-            await s.commit()
-            await s.refresh(user)
-
-        # 5) сохраним/обновим креды DA
-        access_enc = fernet_encrypt(access_token)
-        refresh_enc = fernet_encrypt(refresh_token) if refresh_token else ""
+    user = await resolve_user(tg_id)
 
+    # 5) сохраним/обновим креды DA
+    access_enc = fernet_encrypt(access_token)
+    refresh_enc = fernet_encrypt(refresh_token) if refresh_token else ""
+
+    async def save_creds(s) -> None:
         r2 = await s.execute(
             select(ApiCredentials).where(ApiCredentials.user_id == user.id, ApiCredentials.service == "deviantart")
         )
@@ -131,7 +139,10 @@ async def deviantart_callback(
                     refresh_token_enc=refresh_enc,
                 )
             )
-        await s.commit()
+
+    await db_write(save_creds)
+    # кэш этого процесса; бот перечитает креды из БД на первом отказе DeviantArt (DeviantArtClient._reload_creds)
+    invalidate_creds(user.id, "deviantart")
 
     # 6) уведомим пользователя в TG (не критично если не получится)
     try: